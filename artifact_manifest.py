@@ -0,0 +1,188 @@
+"""
+Artifact manifest module, containing the database of files produced from each workout.
+"""
+import os
+import time
+from helpers import Helpers as helpers
+from state_store import Database
+
+class ArtifactManifest(Database):
+  """
+  #### Description
+  This class keeps track of the files produced from each workout, such as its gpx track, on a SQLite database.
+  Each artifact is recorded along with its path, size, hash, and the version of the source it was produced from, keyed by workout ID and kind,
+  so deciding whether a workout still needs processing neither depends on its name nor touches the filesystem.
+  #### Available functions
+  - `close()`: commits any pending writes and closes the database
+  - `commit()`: commits any pending writes to disk
+  - `count(kind: str = "gpx") -> int`: returns how many artifacts of a kind are recorded
+  - `forget(workout_id: int, kind: str = None)`: removes a workout's artifacts from the manifest
+  - `get(workout_id: int, kind: str = "gpx") -> dict`: returns a recorded artifact
+  - `has(workout_id: int, kind: str = "gpx") -> bool`: checks whether an artifact has already been produced for a workout
+  - `reconcile(paths: list, kind: str = "gpx", extension: str = ".gpx") -> int`: rebuilds the manifest from the files found on disk
+  - `record(workout_id: int, path: str, size: int, sha256: str, source_version: str, kind: str = "gpx")`: records an artifact. Committed on the next batch
+  - `source_version(workout_id: int, kind: str = "gpx") -> str`: returns the version of the source an artifact was produced from
+  - `workouts(kind: str = "gpx") -> set`: returns the IDs of the workouts an artifact of a kind is recorded for
+  #### Notes
+  Shares the state database with `StateStore`, on a table of its own. Safe to be used from several threads at once.
+  """
+
+  def __init__(self, db_file: str, batch_size: int = 50, metrics = None):
+    """
+    #### Parameters
+    - `db_file`: full path to the database file. Created if missing
+    - `batch_size`: how many artifacts to buffer before committing them to disk
+    - `metrics`: a `Metrics` to record how long writes take on. Optional
+    """
+    super().__init__(db_file=db_file, batch_size=batch_size, metrics=metrics)
+    self._db.execute("CREATE TABLE IF NOT EXISTS artifacts (workout_id INTEGER NOT NULL, kind TEXT NOT NULL, path TEXT NOT NULL, size INTEGER, " \
+                     "sha256 TEXT, source_version TEXT, created_at INTEGER NOT NULL, PRIMARY KEY (workout_id, kind))")
+    self._produced = {(x[0], x[1]): x[2] for x in self._db.execute("SELECT workout_id, kind, source_version FROM artifacts")}
+
+  def has(self, workout_id: int, kind: str = "gpx") -> bool:
+    """
+    #### Description
+    Checks whether an artifact has already been produced for a workout
+    #### Parameters
+    - `workout_id`: the workout's ID
+    - `kind`: the kind of artifact, such as `gpx`
+    #### Returns
+    `True` if recorded, `False` otherwise
+    """
+    with self._lock:
+      return (int(workout_id), kind) in self._produced
+
+  def get(self, workout_id: int, kind: str = "gpx") -> dict:
+    """
+    #### Description
+    Returns a recorded artifact
+    #### Parameters
+    - `workout_id`: the workout's ID
+    - `kind`: the kind of artifact, such as `gpx`
+    #### Returns
+    A dict containing `path`, `size`, `sha256`, `source_version` and `created_at`, or `None` if not recorded
+    """
+    with self._lock:
+      self.commit()
+      row = self._db.execute("SELECT path, size, sha256, source_version, created_at FROM artifacts WHERE workout_id = ? AND kind = ?",
+                             (int(workout_id), kind)).fetchone()
+    if row is None:
+      return None
+    return dict(zip(["path", "size", "sha256", "source_version", "created_at"], row))
+
+  def source_version(self, workout_id: int, kind: str = "gpx") -> str:
+    """
+    #### Description
+    Returns the version of the source an artifact was produced from, without touching the database
+    #### Parameters
+    - `workout_id`: the workout's ID
+    - `kind`: the kind of artifact, such as `gpx`
+    #### Returns
+    The source version, or `None` if unknown or not recorded
+    """
+    with self._lock:
+      return self._produced.get((int(workout_id), kind))
+
+  def count(self, kind: str = "gpx") -> int:
+    """
+    #### Description
+    Returns how many artifacts of a kind are recorded
+    #### Parameters
+    - `kind`: the kind of artifact, such as `gpx`
+    #### Returns
+    The amount of recorded artifacts
+    """
+    with self._lock:
+      return sum(1 for x in self._produced if x[1] == kind)
+
+  def workouts(self, kind: str = "gpx") -> set:
+    """
+    #### Description
+    Returns the IDs of the workouts an artifact of a kind is recorded for
+    #### Parameters
+    - `kind`: the kind of artifact, such as `gpx`
+    #### Returns
+    A set with the workouts' IDs
+    """
+    with self._lock:
+      return {x[0] for x in self._produced if x[1] == kind}
+
+  def record(self, workout_id: int, path: str, size: int, sha256: str, source_version: str, kind: str = "gpx"):
+    """
+    #### Description
+    Records an artifact produced from a workout, replacing any previous one of the same kind. It'll be written to disk along with the rest of its batch
+    #### Parameters
+    - `workout_id`: the workout's ID
+    - `path`: full path of the produced file
+    - `size`: size of the produced file, in bytes
+    - `sha256`: hex digest of the produced file's contents
+    - `source_version`: identifies the version of the source it was produced from, so changes to it can be detected
+    - `kind`: the kind of artifact, such as `gpx`
+    """
+    with self._lock:
+      self._produced[(int(workout_id), kind)] = source_version
+      self._pending.append((int(workout_id), kind, path, size, sha256, source_version, int(time.time())))
+      if len(self._pending) >= self._batch_size:
+        self.commit()
+
+  def forget(self, workout_id: int, kind: str = None):
+    """
+    #### Description
+    Removes a workout's artifacts from the manifest, so they'll be produced again. Files on disk are left untouched
+    #### Parameters
+    - `workout_id`: the workout's ID
+    - `kind`: the kind of artifact to forget. All of them if `None`
+    """
+    with self._lock:
+      self.commit()
+      if kind is None:
+        self._produced = {k: v for k, v in self._produced.items() if k[0] != int(workout_id)}
+        self._db.execute("DELETE FROM artifacts WHERE workout_id = ?", (int(workout_id),))
+      else:
+        self._produced.pop((int(workout_id), kind), None)
+        self._db.execute("DELETE FROM artifacts WHERE workout_id = ? AND kind = ?", (int(workout_id), kind))
+
+  def reconcile(self, paths: list, kind: str = "gpx", extension: str = ".gpx") -> int:
+    """
+    #### Description
+    Rebuilds the manifest from the files found on disk, replacing whatever was recorded for that kind of artifact
+    #### Parameters
+    - `paths`: a list where each item represents a full path for a folder to look for artifacts on. Missing folders are ignored
+    - `kind`: the kind of artifact to rebuild, such as `gpx`
+    - `extension`: extension of the files holding that kind of artifact
+    #### Returns
+    The amount of artifacts found
+    #### Notes
+    Files are matched to workouts by the ID their name starts with, so renamed workouts are still matched to theirs.
+    Their source version is unknown, so it's left empty. If a workout has several files, the first one found is kept
+    """
+    found = {}
+    for path in paths:
+      if not os.path.isdir(path):
+        continue
+      for entry in os.scandir(path):
+        workout_id = entry.name.split("-")[0]
+        if not entry.is_file() or not entry.name.endswith(extension) or not workout_id.isdigit() or int(workout_id) in found:
+          continue
+        size, sha256 = helpers.file_digest(self, entry.path)
+        found[int(workout_id)] = (int(workout_id), kind, entry.path, size, sha256, None, int(entry.stat().st_mtime))
+
+    with self._lock:
+      self.commit()
+      with self._transaction():
+        self._db.execute("DELETE FROM artifacts WHERE kind = ?", (kind,))
+        self._db.executemany("INSERT INTO artifacts VALUES (?, ?, ?, ?, ?, ?, ?)", found.values())
+      self._produced = {k: v for k, v in self._produced.items() if k[1] != kind} | {(x, kind): None for x in found}
+    return len(found)
+
+  def commit(self):
+    """
+    #### Description
+    Commits any pending writes to disk, in a single transaction
+    """
+    with self._lock:
+      if not self._pending:
+        return
+      with self._transaction():
+        self._db.executemany("INSERT OR REPLACE INTO artifacts VALUES (?, ?, ?, ?, ?, ?, ?)", self._pending)
+      self._pending = []
@@ -0,0 +1,233 @@
+"""
+Athlete daemon module, containing the scheduler that keeps many athletes in sync under a single API app's ratelimits.
+"""
+import json
+import os
+import subprocess
+import sys
+import time
+from coordination import QuotaLedger
+from helpers import Helpers as helpers
+from state_store import Database
+
+class AthleteSchedule(Database):
+  """
+  #### Description
+  This class keeps track of when each athlete was last synced, and how it went, so the daemon can pick up where it left off after a restart.
+  #### Available functions
+  - `commit()`: does nothing. Every change is written right away
+  - `get(name: str) -> dict`: returns an athlete's sync history
+  - `record(name: str, started: float, status: str, requests: int)`: records how an athlete's sync went
+  #### Notes
+  Syncs are `synced` if everything was downloaded, `incomplete` if the athlete's share of the ratelimit budget ran out first, or `failed`.
+  """
+
+  def __init__(self, db_file: str):
+    """
+    #### Parameters
+    - `db_file`: full path to the database file. Created if missing
+    """
+    super().__init__(db_file=db_file)
+    self._db.execute("CREATE TABLE IF NOT EXISTS athletes (name TEXT PRIMARY KEY, last_started INTEGER, last_synced INTEGER, last_status TEXT, " \
+                     "last_requests INTEGER, total_requests INTEGER NOT NULL DEFAULT 0, runs INTEGER NOT NULL DEFAULT 0)")
+
+  def get(self, name: str) -> dict:
+    """
+    #### Description
+    Returns an athlete's sync history
+    #### Parameters
+    - `name`: the athlete's folder name
+    #### Returns
+    A dict containing `last_started`, `last_synced`, `last_status`, `last_requests`, `total_requests` and `runs`. Times are `None` if never synced
+    """
+    with self._lock:
+      row = self._db.execute("SELECT last_started, last_synced, last_status, last_requests, total_requests, runs FROM athletes WHERE name = ?",
+                             (name,)).fetchone()
+    return dict(zip(["last_started", "last_synced", "last_status", "last_requests", "total_requests", "runs"], row or (None, None, None, None, 0, 0)))
+
+  def record(self, name: str, started: float, status: str, requests: int):
+    """
+    #### Description
+    Records how an athlete's sync went. Only syncs with nothing left to download count as the athlete's last sync
+    #### Parameters
+    - `name`: the athlete's folder name
+    - `started`: when the sync started, as a unix timestamp
+    - `status`: either `synced`, `incomplete` or `failed`
+    - `requests`: how many requests the sync used
+    """
+    with self._lock, self._transaction():
+      self._db.execute("INSERT INTO athletes (name, total_requests, runs) VALUES (?, 0, 0) ON CONFLICT (name) DO NOTHING", (name,))
+      self._db.execute("UPDATE athletes SET last_started = ?, last_synced = CASE WHEN ? = 'synced' THEN ? ELSE last_synced END, last_status = ?, " \
+                       "last_requests = ?, total_requests = total_requests + ?, runs = runs + 1 WHERE name = ?",
+                       (int(started), status, int(started), status, int(requests), int(requests), name))
+
+  def commit(self):
+    """
+    #### Description
+    Does nothing. Every change is written right away
+    """
+
+# Scheduling settings, plus the paths and databases they're applied with.
+# pylint: disable=too-many-instance-attributes
+class AthleteDaemon:
+  """
+  #### Description
+  This class keeps many athletes in sync, each on its own settings folder, drawing from a single API app's ratelimits.
+  Athletes are synced one at a time, stalest first, and each sync may only spend an even share of the budget left, so no athlete starves the rest.
+  Athletes whose share ran out before finishing stay the stalest, so they're next in line once the budget is back.
+  #### Available functions
+  - `athletes() -> list`: returns the athletes ready to be synced
+  - `due(now: float = None) -> list`: returns the athletes due for a sync, stalest first
+  - `run()`: syncs athletes as they're due, until interrupted
+  - `run_once() -> int`: syncs every athlete due, as far as the budget allows
+  - `share(athletes: int) -> int`: returns how many requests an athlete's sync may spend, out of the budget left
+  - `sync(name: str, share: int) -> str`: runs an athlete's sync
+  #### Notes
+  Every athlete has a folder under `<daemon folder>/athletes`, used as its settings folder. Athletes are only picked up once set up, and their tokens retrieved.
+  Syncs run `run.py` for each athlete, so tokens are refreshed, and workouts downloaded and extracted, exactly as when run by hand.
+  The budget is tracked on a `QuotaLedger`, which exporters run by hand may share too, through `--quota-ledger`.
+  """
+  INCOMPLETE_EXIT_CODE = 3
+
+  def __init__(self, daemon_dir: str, sync_interval: int = 3600, min_share: int = 20, poll_interval: int = 60):
+    """
+    #### Parameters
+    - `daemon_dir`: folder holding the athletes' folders, the schedule and the quota ledger
+    - `sync_interval`: seconds between an athlete's syncs
+    - `min_share`: fewest requests worth starting a sync with. With less budget than this left, the daemon waits for the next window
+    - `poll_interval`: seconds between checks for athletes due, while there's none
+    """
+    self.daemon_dir = daemon_dir
+    self.athletes_dir = f"{daemon_dir}/athletes"
+    self.ledger_file = f"{daemon_dir}/quota.db"
+    self.sync_interval = sync_interval
+    self.min_share = max(int(min_share), 1)
+    self.poll_interval = poll_interval
+    self.run_file = f"{os.path.dirname(os.path.realpath(__file__))}/run.py"
+    os.makedirs(self.athletes_dir, exist_ok=True)
+    self.schedule = AthleteSchedule(db_file=f"{daemon_dir}/schedule.db")
+    self.ledger = QuotaLedger(db_file=self.ledger_file)
+
+  def athletes(self) -> list:
+    """
+    #### Description
+    Returns the athletes ready to be synced, which are those whose folder has a config file and a refresh token on its secrets file
+    #### Returns
+    A sorted list with the athletes' folder names
+    """
+    ready = []
+    for name in sorted(os.listdir(self.athletes_dir)):
+      secrets_file = f"{self.athletes_dir}/{name}/secrets.json"
+      if not os.path.exists(f"{self.athletes_dir}/{name}/config.json") or not os.path.exists(secrets_file):
+        continue
+      with open(secrets_file, mode="r", encoding="utf8") as f:
+        # Syncing an athlete without tokens would start the interactive oauth flow
+        if json.loads(f.read()).get("strava_refresh_token"):
+          ready.append(name)
+    return ready
+
+  def due(self, now: float = None) -> list:
+    """
+    #### Description
+    Returns the athletes due for a sync, which are those not fully synced for `sync_interval` seconds
+    #### Parameters
+    - `now`: unix timestamp to check against. Defaults to the current time
+    #### Returns
+    A list with the athletes' folder names, never synced ones first, then the rest from the least recently fully synced.
+    Ties go to whichever was least recently tried, so athletes with a backlog take turns
+    #### Notes
+    Failed syncs are only retried after `sync_interval` seconds, so an athlete whose tokens were revoked doesn't eat up the budget.
+    """
+    now = time.time() if now is None else now
+    due = []
+    for name in AthleteDaemon.athletes(self):
+      history = self.schedule.get(name)
+      if history["last_status"] == "failed" and now - history["last_started"] < self.sync_interval:
+        continue
+      if history["last_synced"] is None or now - history["last_synced"] >= self.sync_interval:
+        due.append((history["last_synced"] or 0, history["last_started"] or 0, name))
+    return [x[2] for x in sorted(due)]
+
+  def share(self, athletes: int) -> int:
+    """
+    #### Description
+    Returns how many requests an athlete's sync may spend, splitting what's left of the 15-minute and daily budgets evenly between the athletes due
+    #### Parameters
+    - `athletes`: how many athletes are still due
+    #### Returns
+    The amount of requests, or `0` if there's less than `min_share` left. `min_share` while the ratelimits are still unknown
+    """
+    lim_15, lim_daily, u_15, u_daily = self.ledger.usage()
+    if lim_15 is None or lim_daily is None:
+      return self.min_share
+    left = min(lim_15 - u_15, lim_daily - u_daily)
+    if left < self.min_share:
+      return 0
+    return max(left // max(int(athletes), 1), self.min_share)
+
+  def sync(self, name: str, share: int) -> str:
+    """
+    #### Description
+    Runs an athlete's sync, then records how it went
+    #### Parameters
+    - `name`: the athlete's folder name
+    - `share`: how many requests the sync may spend on downloads. Listing the athlete's workouts isn't capped, so it's never left half done
+    #### Returns
+    Either `synced`, `incomplete` or `failed`
+    """
+    print(f"\033[94mℹ️  Syncing \033[37m{name}\033[94m, with a budget of {share} requests\033[0m", flush=True)
+    used_before = self.ledger.usage()[3]
+    started = time.time()
+    result = subprocess.run([sys.executable, self.run_file, "--settings-dir", f"{self.athletes_dir}/{name}",
+                             "--quota-ledger", self.ledger_file, "--max-requests", str(share)], stdin=subprocess.DEVNULL, check=False)
+    match result.returncode:
+      case 0:
+        status = "synced"
+      case AthleteDaemon.INCOMPLETE_EXIT_CODE:
+        status = "incomplete"
+      case _:
+        status = "failed"
+    # The daily usage resets at midnight UTC, so a sync running through it can't tell how much it used before
+    requests = max(self.ledger.usage()[3] - used_before, 0)
+    self.schedule.record(name, started=started, status=status, requests=requests)
+    print(f"\033[{'92m✅' if status == 'synced' else '93m🟡' if status == 'incomplete' else '91m🚫'} {name}: {status}, {requests} requests used\033[0m\n", flush=True)
+    return status
+
+  def run_once(self) -> int:
+    """
+    #### Description
+    Syncs every athlete due, stalest first, as far as the budget allows
+    #### Returns
+    How many athletes were synced, successfully or not
+    """
+    due = AthleteDaemon.due(self)
+    for synced, name in enumerate(due):
+      share = AthleteDaemon.share(self, len(due) - synced)
+      if share == 0:
+        return synced
+      AthleteDaemon.sync(self, name, share)
+    return len(due)
+
+  def run(self):
+    """
+    #### Description
+    Syncs athletes as they're due, until interrupted. Waits for the next ratelimit window whenever the budget runs out
+    """
+    print(f"\033[94mℹ️  Keeping {len(AthleteDaemon.athletes(self))} athletes in sync from \033[37m\"{self.daemon_dir}\"\033[94m. Press ^C to stop\033[0m")
+    try:
+      while True:
+        synced = AthleteDaemon.run_once(self)
+        if AthleteDaemon.due(self) and AthleteDaemon.share(self, 1) == 0:
+          lim_15, lim_daily, u_15, u_daily = self.ledger.usage()
+          window = 86400 if lim_daily - u_daily < self.min_share else 900
+          wait = helpers.seconds_to_next_window(self, window=window) + 1
+          print(f"\033[33m⏰ Ratelimit budget spent ({u_15}/{lim_15} on this 15 minutes, {u_daily}/{lim_daily} today). " \
+                f"Resuming in {helpers.format_duration(self, wait)}\033[0m", flush=True)
+          time.sleep(wait)
+        elif synced == 0:
+          time.sleep(self.poll_interval)
+    except KeyboardInterrupt:
+      print("\n\033[94mℹ️  Stopped\033[0m")
+    finally:
+      self.ledger.close()
+      self.schedule.close()
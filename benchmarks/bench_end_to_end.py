@@ -0,0 +1,133 @@
+"""
+End-to-end benchmark, running the exporter against a local mock of strava's API for athletes of several sizes.
+Run from the repo's root folder: `python3 benchmarks/bench_end_to_end.py --sizes 1000 10000 50000`
+Reports requests sent, wall time, bytes written and track extraction throughput. Nothing is sent to strava.
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+from mock_strava import MockStrava
+
+RUN_PY = f"{os.path.dirname(os.path.dirname(os.path.realpath(__file__)))}/run.py"
+
+def folder_size(path: str) -> tuple:
+  """
+  Returns how many files there are under `path`, and how many bytes they take
+  """
+  files, size = 0, 0
+  for root, _, names in os.walk(path):
+    for name in names:
+      files += 1
+      size += os.path.getsize(os.path.join(root, name))
+  return files, size
+
+def write_settings(settings_dir: str, workdir: str, strava_url: str, options: dict):
+  """
+  Writes the config and secrets files the exporter reads, pointing it at the mock
+  """
+  for path in (settings_dir, f"{workdir}/tracks", f"{workdir}/workouts"):
+    os.makedirs(path, exist_ok=True)
+  config = {"tracks_output_path": f"{workdir}/tracks", "workouts_output_path": f"{workdir}/workouts", "strava_url": strava_url}
+  config.update(options)
+  with open(f"{settings_dir}/config.json", mode="w", encoding="utf8") as f:
+    f.write(json.dumps(config))
+  with open(f"{settings_dir}/secrets.json", mode="w", encoding="utf8") as f:
+    f.write(json.dumps({"strava_access_token": MockStrava.ACCESS_TOKEN, "strava_refresh_token": MockStrava.REFRESH_TOKEN,
+                        "strava_client_id": "1", "strava_client_secret": "mock-client-secret"}))
+
+def run_exporter(settings_dir: str, extra_args: list) -> dict:
+  """
+  Runs the exporter to completion, timing it as a whole and its track extraction stage
+  """
+  started = time.perf_counter()
+  extraction_started = None
+  with subprocess.Popen([sys.executable, RUN_PY, "--settings-dir", settings_dir] + extra_args,
+                        stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True, encoding="utf8", errors="replace") as proc:
+    tail = []
+    for line in proc.stdout:
+      if extraction_started is None and "Extracting tracks" in line:
+        extraction_started = time.perf_counter()
+      tail = (tail + [line])[-20:]
+    returncode = proc.wait()
+  finished = time.perf_counter()
+  if returncode != 0:
+    print("".join(tail))
+  return {"returncode": returncode, "wall": finished - started, "extraction": finished - (extraction_started or finished)}
+
+def bench(size: int, args: argparse.Namespace) -> dict:
+  """
+  Runs the exporter once against a mock athlete with `size` workouts, then once more with nothing new to sync
+  """
+  mock = MockStrava(activities=size, points=args.points, latency=args.latency, error_rate=args.error_rate, throttle_rate=args.throttle_rate,
+                    token_lifetime=args.token_lifetime)
+  strava_url = mock.start()
+  try:
+    with tempfile.TemporaryDirectory(prefix="strava-bench-", dir=args.tmp) as workdir:
+      settings_dir = f"{workdir}/settings"
+      write_settings(settings_dir, workdir, strava_url, {"download_workers": args.workers, "extract_workers": args.extract_workers,
+                                                          "workouts_storage": args.storage, "fetch_streams": args.streams})
+      cold = run_exporter(settings_dir, ["--full-sync"])
+      cold_counts = mock.counts()
+      warm = run_exporter(settings_dir, [])
+      warm_counts = mock.counts()
+      tracks, track_bytes = folder_size(f"{workdir}/tracks")
+      _, workout_bytes = folder_size(f"{workdir}/workouts")
+      _, state_bytes = folder_size(settings_dir)
+  finally:
+    mock.stop()
+  requests_sent = sum(v for k, v in cold_counts.items() if isinstance(k, str) and k != "bytes_sent")
+  return {
+    "size": size,
+    "ok": cold["returncode"] == 0 and warm["returncode"] == 0,
+    "requests": requests_sent,
+    "by_endpoint": {k: v for k, v in cold_counts.items() if k != "bytes_sent"},
+    "warm_requests": sum(v for k, v in warm_counts.items() if isinstance(k, str) and k != "bytes_sent") - requests_sent,
+    "wall": cold["wall"],
+    "warm_wall": warm["wall"],
+    "received": cold_counts["bytes_sent"],
+    "written": track_bytes + workout_bytes + state_bytes,
+    "tracks": tracks,
+    "tracks_per_second": tracks / cold["extraction"] if cold["extraction"] > 0 else 0.0,
+  }
+
+def main():
+  """
+  Benchmarks every size asked for, then prints a report
+  """
+  parser = argparse.ArgumentParser(description="Runs the exporter end to end against a local mock of strava's API")
+  parser.add_argument("--sizes", type=int, nargs="+", default=[1000, 10000, 50000], help="how many workouts the mock athletes have")
+  parser.add_argument("--points", type=int, default=500, help="how many points detailed tracks have")
+  parser.add_argument("--workers", type=int, default=4, help="download workers")
+  parser.add_argument("--extract-workers", type=int, default=os.cpu_count() or 1, help="track extraction workers")
+  parser.add_argument("--storage", choices=["files", "archive"], default="files", help="where workouts are stored")
+  parser.add_argument("--streams", action="store_true", help="download streams as well")
+  parser.add_argument("--latency", type=float, default=0.0, help="seconds every mock response is delayed by")
+  parser.add_argument("--error-rate", type=float, default=0.0, help="share of requests answered with a 500, which are retried")
+  parser.add_argument("--throttle-rate", type=float, default=0.0, help="share of requests answered with a 429. Each one pauses the exporter until the next quarter hour")
+  parser.add_argument("--token-lifetime", type=int, help="seconds the mock's access tokens are good for. Tokens are refreshed an hour before expiring, so use more than 3600")
+  parser.add_argument("--tmp", help="folder to create the exporter's folders on. Defaults to the system's temporary folder")
+  parser.add_argument("--json", action="store_true", help="print the report as JSON")
+  args = parser.parse_args()
+
+  results = []
+  for size in args.sizes:
+    print(f"⏳ Benchmarking {size} workouts...", file=sys.stderr, flush=True)
+    results.append(bench(size, args))
+
+  if args.json:
+    print(json.dumps(results, indent=2, default=str))
+    return
+  for x in results:
+    status = "✅" if x["ok"] else "❌"
+    print(f"{status} {x['size']} workouts: {x['requests']} requests in {x['wall']:.1f}s, {x['received'] / 2**20:.1f} MiB received, "
+          f"{x['written'] / 2**20:.1f} MiB written, {x['tracks']} tracks at {x['tracks_per_second']:.0f}/s. "
+          f"Re-run: {x['warm_requests']} requests in {x['warm_wall']:.1f}s")
+  if not all(x["ok"] for x in results):
+    sys.exit(1)
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,28 @@
+"""
+Microbenchmark for the batch polyline decoder, timing it against `polyline.decode`. Its output is checked by `check_polyline_decoder.py`.
+Run from the repo's root folder: `python3 benchmarks/bench_polyline_decoder.py`
+"""
+import os
+import random
+import sys
+import timeit
+import polyline
+from check_polyline_decoder import random_track
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+# pylint: disable=wrong-import-position
+from polyline_decoder import PolylineDecoder
+
+def main():
+  """
+  Times both decoders on tracks of several sizes
+  """
+  random.seed(42)
+  for points, count in ((100, 2000), (5000, 100)):
+    plines = [polyline.encode(random_track(points)) for _ in range(count)]
+    reference = min(timeit.repeat(lambda plines=plines: [polyline.decode(x) for x in plines], number=1, repeat=3))
+    batch = min(timeit.repeat(lambda plines=plines: PolylineDecoder().decode_batch(plines), number=1, repeat=3))
+    print(f"⏱️  {count} polylines of {points} points: polyline.decode {reference:.3f}s, decode_batch {batch:.3f}s ({reference / batch:.1f}x)")
+
+if __name__ == "__main__":
+  main()
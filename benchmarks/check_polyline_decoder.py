@@ -0,0 +1,71 @@
+"""
+Offline checks for the batch polyline decoder, comparing everything it decodes against `polyline.decode`. Nothing is timed, see `bench_polyline_decoder.py` for that.
+Run from the repo's root folder: `python3 benchmarks/check_polyline_decoder.py`
+"""
+import os
+import random
+import sys
+import polyline
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+# pylint: disable=wrong-import-position
+from polyline_decoder import PolylineDecoder
+
+# Deltas up to this many 1e-5 degrees take up to 3 chars, and are decoded from a table seeded upfront. Larger ones are decoded on first sight
+SEEDED_DELTA = 2 ** 14 - 1
+
+def random_track(points: int) -> list:
+  """
+  Returns a random walk of `points` coordinates, shaped like a recorded track
+  """
+  lat, lon = random.uniform(-80, 80), random.uniform(-179, 179)
+  track = []
+  for _ in range(points):
+    lat = max(min(lat + random.gauss(0, 0.0003), 89.9), -89.9)
+    lon = max(min(lon + random.gauss(0, 0.0003), 179.9), -179.9)
+    track.append((lat, lon))
+  return track
+
+def matches(decoder: PolylineDecoder, plines: list) -> bool:
+  """
+  Tells whether every polyline decodes the same as with `polyline.decode`, both on its own and as part of a batch. Prints those that don't
+  """
+  ok = True
+  views = decoder.decode_batch(plines)
+  if len(views) != len(plines):
+    print(f"   {len(plines)} polylines decoded into {len(views)} views")
+    return False
+  for pline, view in zip(plines, views):
+    expected = polyline.decode(pline) if pline else []
+    if list(decoder.pairs(view)) != expected or list(decoder.pairs(decoder.decode(pline or ""))) != expected:
+      print(f"   mismatch decoding {pline[:40]!r}")
+      ok = False
+  return ok
+
+def main():
+  """
+  Runs every check, then prints how each went
+  """
+  random.seed(42)
+  decoder = PolylineDecoder()
+  step = SEEDED_DELTA / 1e5
+  checks = [
+    ("empty polylines", matches(decoder, ["", None, ""])),
+    ("single points", matches(decoder, [polyline.encode([x]) for x in [(0, 0), (1e-5, -1e-5), (38.5, -120.2), (-33.86785, 151.20732)]])),
+    ("negative coordinates", matches(decoder, [polyline.encode([(-x / 7, -y / 3) for x, y in zip(range(50), range(50, 0, -1))]),
+                                               polyline.encode([(-89.99999, -179.99999), (-0.00001, -0.00001)])])),
+    ("poles and antimeridian", matches(decoder, [polyline.encode([(90, 180), (-90, -180)]), polyline.encode([(10, 179.99999), (10, -179.99999), (10, 179.99999)]),
+                                                 polyline.encode([(-16.5, 179.9), (-16.6, 180), (-16.7, -179.9)])])),
+    ("deltas around the seeded ones", matches(decoder, [polyline.encode([(0, 0), (d, -d), (0, 0)]) for d in (step - 1e-5, step, step + 1e-5, step + 2e-5)])),
+    ("known polylines", matches(decoder, ["??", "_p~iF~ps|U_ulLnnqC_mqNvxq`@"])),
+  ]
+  # Extraction hands polylines over in chunks of 16. Views must line up across them, whatever the batch holds
+  mixed = ["", polyline.encode([(1, 1)])] + [polyline.encode(random_track(random.randint(1, 500))) for _ in range(29)] + [None, polyline.encode(random_track(5000))]
+  checks.append(("mixed batches across chunk boundaries", all(matches(decoder, mixed[:x]) for x in (1, 15, 16, 17, 32, 33))))
+  checks.append(("random tracks", matches(decoder, [polyline.encode(random_track(random.randint(1, 2000))) for _ in range(300)])))
+
+  print("\n".join(f"{'✅' if ok else '❌'} {name}" for name, ok in checks))
+  sys.exit(0 if all(ok for _, ok in checks) else 1)
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,87 @@
+"""
+Offline checks for the ratelimit budget, running `RateLimiter` on a fake clock, so days can go by in an instant. Nothing is sent to strava.
+Run from the repo's root folder: `python3 benchmarks/check_rate_limiter.py`
+"""
+import os
+import sys
+import requests
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+# pylint: disable=wrong-import-position
+import rate_limiter
+from rate_limiter import RateLimiter
+
+class FakeClock:
+  """
+  Stands in for the `time` module on `rate_limiter`, so its windows roll over when told to
+  """
+  def __init__(self, now: float):
+    self.now = now
+
+  def time(self) -> float:
+    """
+    Returns the fake current time
+    """
+    return self.now
+
+  def sleep(self, seconds: float):
+    """
+    Moves the fake clock forward instead of sleeping
+    """
+    self.now += seconds
+
+def response(u_15: int, u_daily: int, lim_15: int = 100, lim_daily: int = 1000) -> requests.Response:
+  """
+  Builds a response carrying strava's ratelimit headers, as seen after a request
+  """
+  res = requests.Response()
+  res.status_code = 200
+  res.headers["x-ratelimit-limit"] = f"{lim_15},{lim_daily}"
+  res.headers["x-ratelimit-usage"] = f"{u_15},{u_daily}"
+  return res
+
+def exhaust(limiter: RateLimiter):
+  """
+  Sends a request that spends what's left of the daily budget
+  """
+  limiter.acquire()
+  limiter.release(response(u_15=1, u_daily=1000))
+
+def main():
+  """
+  Runs every check, then prints how each went
+  """
+  day = 86400
+  clock = FakeClock(now=1_700_000_000 // day * day + 3600)
+  rate_limiter.time = clock
+  checks = []
+
+  limiter = RateLimiter()
+  exhaust(limiter)
+  checks.append(("exhausted once the daily usage reaches its limit", limiter.daily_limit_reached() and not limiter.acquire()))
+  clock.now += 6 * 3600
+  checks.append(("still exhausted later that day", limiter.daily_limit_reached() and not limiter.acquire()))
+  clock.now += day
+  checks.append(("daily_limit_reached clears on the next day", not limiter.daily_limit_reached()))
+  checks.append(("acquire works again on the next day", limiter.acquire()))
+  limiter.release(response(u_15=1, u_daily=1))
+
+  # Same limiter, as push sync keeps one for as long as it runs
+  exhaust(limiter)
+  clock.now += 2 * day
+  checks.append(("acquire works again two days after being exhausted again", limiter.acquire()))
+  limiter.release(response(u_15=1, u_daily=1))
+
+  limiter = RateLimiter()
+  exhaust(limiter)
+  checks.append(("charge refused while exhausted", not limiter.charge()))
+  clock.now += day
+  checks.append(("charge works again on the next day", limiter.charge()))
+
+  for name, ok in checks:
+    print(f"{'✅' if ok else '❌'} {name}")
+  if not all(ok for _, ok in checks):
+    sys.exit(1)
+
+if __name__ == "__main__":
+  main()
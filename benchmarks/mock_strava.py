@@ -0,0 +1,359 @@
+"""
+Local mock of strava's API, serving synthetic workouts so the exporter can be benchmarked offline.
+Used by `bench_end_to_end.py`, or on its own: `python3 benchmarks/mock_strava.py --activities 1000 --port 8080`,
+then set `"strava_url": "http://localhost:8080"` on the config file.
+"""
+import argparse
+import json
+import random
+import re
+import threading
+import time
+from datetime import datetime, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+import polyline
+
+SPORT_TYPES = ["Run", "Ride", "Walk", "Hike", "Swim", "VirtualRide"]
+
+# The mock's knobs and counters are all independent settings, not state to be grouped.
+# pylint: disable=too-many-instance-attributes
+class MockStrava:
+  """
+  #### Description
+  This class serves a synthetic athlete's workouts on a local port, mimicking the parts of strava's API the exporter uses.
+  Workouts are generated from a seed, on demand, so the same one always looks the same and large athletes take no memory.
+  #### Available functions
+  - `activity(workout_id: int) -> dict`: returns a workout, as `/activities/{id}` would
+  - `authorized(header: str) -> bool`: tells whether an `Authorization` header carries a valid access token
+  - `counts() -> dict`: returns how many requests were served on each endpoint, plus bytes sent
+  - `issue_tokens(refresh_token: str = None) -> dict`: hands out a new token set, as `/oauth/token` would
+  - `revoke_access_tokens()`: revokes every access token handed out, as if the athlete changed their password
+  - `start() -> str`: starts serving on a background thread, and returns the base URL to point the exporter at
+  - `stop()`: stops serving
+  - `streams(workout_id: int) -> dict`: returns a workout's streams, as `/activities/{id}/streams` would
+  - `summary(index: int) -> dict`: returns a workout summary, as listed by `/athlete/activities`
+  #### Notes
+  Serves `/athlete`, `/athlete/activities`, `/activities/{id}`, `/activities/{id}/streams` and `/oauth/token`.
+  Every response carries strava's `x-ratelimit-limit` and `x-ratelimit-usage` headers, counted on 15-minute windows starting at every quarter hour,
+  and daily ones starting at midnight UTC. Requests past either limit get a `429`, as do a random share of them if `throttle_rate` is set.
+  Tokens never expire, unless `token_lifetime` is set. Then, every refresh hands out a new access token, good for that many seconds,
+  and a new refresh token, the old one being rejected from then on, as strava does.
+  """
+  ACCESS_TOKEN = "mock-access-token"
+  REFRESH_TOKEN = "mock-refresh-token"
+
+  def __init__(self, activities: int = 1000, seed: int = 1, points: int = 500, port: int = 0, *,
+               limit_15: int = 10**7, limit_daily: int = 10**8, latency: float = 0.0, error_rate: float = 0.0, throttle_rate: float = 0.0,
+               token_lifetime: int = None):
+    """
+    #### Parameters
+    - `activities`: how many workouts the athlete has
+    - `seed`: seed workouts are generated from
+    - `points`: how many points detailed tracks have. Summary tracks have a tenth of them
+    - `port`: port to serve on. `0` picks a free one
+    - `limit_15`: 15-minute ratelimit. High enough not to be reached by default
+    - `limit_daily`: daily ratelimit. High enough not to be reached by default
+    - `latency`: seconds every response is delayed by
+    - `error_rate`: share of requests answered with a `500`, from `0` to `1`
+    - `throttle_rate`: share of requests answered with a `429`, from `0` to `1`. The exporter pauses until the next quarter hour on each one, as with strava
+    - `token_lifetime`: seconds access tokens are good for, including the one in `ACCESS_TOKEN`. Tokens never expire if not set
+    """
+    self.activities = int(activities)
+    self.seed = seed
+    self.points = max(int(points), 2)
+    self.port = port
+    self.limit_15, self.limit_daily = limit_15, limit_daily
+    self.latency, self.error_rate, self.throttle_rate = latency, error_rate, throttle_rate
+    self._lock = threading.Lock()
+    self._random = random.Random(seed)
+    self._usage = {"15m": (0, 0), "daily": (0, 0)}
+    self._counts = {"bytes_sent": 0}
+    self.token_lifetime = token_lifetime
+    self._tokens = {MockStrava.ACCESS_TOKEN: time.time() + token_lifetime if token_lifetime else float("inf")}
+    self._refresh_token = MockStrava.REFRESH_TOKEN
+    self._server = None
+    self._thread = None
+    # Newest workouts come first, one every 8 hours, up to now
+    self._newest = int(time.time()) // 3600 * 3600
+
+  def summary(self, index: int) -> dict:
+    """
+    #### Description
+    Returns a workout summary, as listed by `/athlete/activities`
+    #### Parameters
+    - `index`: the workout's position on the list, newest first
+    #### Returns
+    A dict shaped like strava's summary activity
+    """
+    workout_id = 10**9 + self.activities - index
+    rnd = random.Random(f"{self.seed}:{workout_id}")
+    start = self._newest - index * 28800
+    sport = rnd.choice(SPORT_TYPES)
+    moving_time = rnd.randint(600, 10800)
+    return {
+      "id": workout_id,
+      "name": f"{sport} #{workout_id - 10**9}",
+      "type": sport,
+      "sport_type": sport,
+      "start_date": datetime.fromtimestamp(start, tz=timezone.utc).strftime("%Y-%m-%dT%H:%M:%SZ"),
+      "distance": round(moving_time * rnd.uniform(1.5, 8), 1),
+      "moving_time": moving_time,
+      "elapsed_time": moving_time + rnd.randint(0, 900),
+      "total_elevation_gain": round(rnd.uniform(0, 800), 1),
+      "map": {"id": f"a{workout_id}", "summary_polyline": polyline.encode(self._track(workout_id)[::10])},
+    }
+
+  def activity(self, workout_id: int) -> dict:
+    """
+    #### Description
+    Returns a workout, as `/activities/{id}` would
+    #### Parameters
+    - `workout_id`: the workout's ID
+    #### Returns
+    A dict shaped like strava's detailed activity, or `None` if there's no such workout
+    """
+    index = 10**9 + self.activities - int(workout_id)
+    if not 0 <= index < self.activities:
+      return None
+    workout = self.summary(index)
+    workout["map"]["polyline"] = polyline.encode(self._track(int(workout_id)))
+    workout["description"] = "Generated by the mock strava server"
+    workout["calories"] = round(workout["moving_time"] / 6, 1)
+    return workout
+
+  def streams(self, workout_id: int) -> dict:
+    """
+    #### Description
+    Returns a workout's streams, as `/activities/{id}/streams` would with `key_by_type`
+    #### Parameters
+    - `workout_id`: the workout's ID
+    #### Returns
+    A dict of streams by type, or `None` if there's no such workout
+    """
+    workout = self.activity(workout_id)
+    if workout is None:
+      return None
+    track = self._track(int(workout_id))
+    rnd = random.Random(f"{self.seed}:{workout_id}:streams")
+    step = workout["elapsed_time"] / len(track)
+    altitude = rnd.uniform(0, 1500)
+    streams = {"latlng": [list(x) for x in track], "time": [int(x * step) for x in range(len(track))], "altitude": [], "heartrate": []}
+    for _ in track:
+      altitude += rnd.gauss(0, 0.5)
+      streams["altitude"].append(round(altitude, 1))
+      streams["heartrate"].append(rnd.randint(110, 175))
+    return {k: {"type": k, "data": v, "series_type": "distance", "original_size": len(v), "resolution": "high"} for k, v in streams.items()}
+
+  def counts(self) -> dict:
+    """
+    #### Description
+    Returns how many requests were served on each endpoint, plus bytes sent
+    #### Returns
+    A dict where its key is the endpoint, or a status code such as `429`, and its value the amount of requests. `bytes_sent` holds the bytes sent
+    """
+    with self._lock:
+      return dict(self._counts)
+
+  def authorized(self, header: str) -> bool:
+    """
+    #### Description
+    Tells whether an `Authorization` header carries a valid access token
+    #### Parameters
+    - `header`: the request's `Authorization` header
+    #### Returns
+    `True` if the token was handed out, and hasn't expired nor been revoked. `False` otherwise
+    """
+    with self._lock:
+      return self._tokens.get((header or "").removeprefix("Bearer "), 0) > time.time()
+
+  def issue_tokens(self, refresh_token: str = None) -> dict:
+    """
+    #### Description
+    Hands out a new token set, as `/oauth/token` would
+    #### Parameters
+    - `refresh_token`: the refresh token sent, if refreshing. Authorization codes are always accepted
+    #### Returns
+    A dict shaped like strava's token response, or `None` if the refresh token was rejected
+    """
+    with self._lock:
+      self._counts["oauth/token"] = self._counts.get("oauth/token", 0) + 1
+      if not self.token_lifetime:
+        return {"token_type": "Bearer", "access_token": MockStrava.ACCESS_TOKEN, "refresh_token": MockStrava.REFRESH_TOKEN,
+                "expires_at": int(time.time()) + 21600, "expires_in": 21600}
+      if refresh_token is not None and refresh_token != self._refresh_token:
+        return None
+      issued = len(self._tokens)
+      access_token = f"{MockStrava.ACCESS_TOKEN}-{issued}"
+      self._tokens[access_token] = time.time() + self.token_lifetime
+      self._refresh_token = f"{MockStrava.REFRESH_TOKEN}-{issued}"
+      return {"token_type": "Bearer", "access_token": access_token, "refresh_token": self._refresh_token,
+              "expires_at": int(time.time() + self.token_lifetime), "expires_in": self.token_lifetime}
+
+  def revoke_access_tokens(self):
+    """
+    #### Description
+    Revokes every access token handed out, as if the athlete changed their password. Refresh tokens keep working
+    """
+    with self._lock:
+      self._tokens = {k: 0 for k in self._tokens}
+
+  def start(self) -> str:
+    """
+    #### Description
+    Starts serving on a background thread
+    #### Returns
+    The base URL to point the exporter at
+    """
+    self._server = ThreadingHTTPServer(("127.0.0.1", self.port), _make_handler(self))
+    self._server.daemon_threads = True
+    self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+    self._thread.start()
+    return f"http://127.0.0.1:{self._server.server_address[1]}"
+
+  def stop(self):
+    """
+    #### Description
+    Stops serving
+    """
+    if self._server is not None:
+      self._server.shutdown()
+      self._server.server_close()
+      self._server = None
+
+  def _track(self, workout_id: int) -> list:
+    # A random walk, shaped like a recorded track
+    rnd = random.Random(f"{self.seed}:{workout_id}:track")
+    lat, lon = rnd.uniform(-60, 60), rnd.uniform(-170, 170)
+    track = []
+    for _ in range(self.points):
+      lat += rnd.gauss(0, 0.0003)
+      lon += rnd.gauss(0, 0.0003)
+      track.append((round(lat, 5), round(lon, 5)))
+    return track
+
+  def _account(self, endpoint: str) -> tuple:
+    # Counts a request, and tells whether it's to be refused. Refused requests still count, as they do on strava
+    now = time.time()
+    with self._lock:
+      self._counts[endpoint] = self._counts.get(endpoint, 0) + 1
+      windows = {}
+      for window, length in (("15m", 900), ("daily", 86400)):
+        window_id, used = self._usage[window]
+        windows[window] = (int(now // length), (used if window_id == int(now // length) else 0) + 1)
+      self._usage = windows
+      u_15, u_daily = windows["15m"][1], windows["daily"][1]
+      roll = self._random.random()
+    headers = {"x-ratelimit-limit": f"{self.limit_15},{self.limit_daily}", "x-ratelimit-usage": f"{u_15},{u_daily}"}
+    if u_15 > self.limit_15 or u_daily > self.limit_daily or roll < self.throttle_rate:
+      return 429, headers
+    if roll < self.throttle_rate + self.error_rate:
+      return 500, headers
+    return 200, headers
+
+  def _sent(self, status: int, size: int):
+    with self._lock:
+      if status != 200:
+        self._counts[status] = self._counts.get(status, 0) + 1
+      self._counts["bytes_sent"] += size
+
+def _make_handler(mock: MockStrava):
+  class RequestHandler(BaseHTTPRequestHandler):
+    """
+    Request handler serving the mock's endpoints
+    """
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+      # Suppress logging by overriding the log_message method
+      pass
+
+    def do_GET(self):
+      """
+      Serves the athlete, its workouts, and their streams
+      """
+      url = urlparse(self.path)
+      if not mock.authorized(self.headers.get("Authorization")):
+        self._reply(401, {}, {"message": "Authorization Error"})
+        return
+      if url.path == "/api/v3/athlete":
+        self._serve("athlete", lambda: {"id": 1, "firstname": "Mock", "lastname": "Athlete"})
+      elif url.path == "/api/v3/athlete/activities":
+        self._serve("athlete/activities", lambda: self._list(parse_qs(url.query)))
+      elif match := re.fullmatch(r"/api/v3/activities/(\d+)", url.path):
+        self._serve("activities/{id}", lambda: mock.activity(match[1]))
+      elif match := re.fullmatch(r"/api/v3/activities/(\d+)/streams", url.path):
+        self._serve("activities/{id}/streams", lambda: mock.streams(match[1]))
+      else:
+        self._reply(404, {}, {"message": "Record Not Found"})
+
+    def do_POST(self):
+      """
+      Serves oauth token exchanges and refreshes
+      """
+      form = parse_qs(self.rfile.read(int(self.headers.get("Content-Length", 0))).decode())
+      if urlparse(self.path).path != "/oauth/token":
+        self._reply(404, {}, {"message": "Record Not Found"})
+        return
+      tokens = mock.issue_tokens(form.get("refresh_token", [None])[0] if form.get("grant_type") == ["refresh_token"] else None)
+      if tokens is None:
+        self._reply(400, {}, {"message": "Bad Request", "errors": [{"resource": "RefreshToken", "field": "refresh_token", "code": "invalid"}]})
+      else:
+        self._reply(200, {}, tokens)
+
+    def _list(self, query: dict) -> list:
+      # Newest first, filtered by the time window asked for, then paged
+      page, per_page = int(query.get("page", ["1"])[0]), min(int(query.get("per_page", ["30"])[0]), 200)
+      after, before = int(query.get("after", ["0"])[0]), int(query.get("before", [str(2**40)])[0])
+      first = max((mock._newest - before) // 28800 + 1, 0) if before < 2**40 else 0
+      last = min((mock._newest - after + 28799) // 28800, mock.activities)
+      start = first + (page - 1) * per_page
+      return [mock.summary(x) for x in range(start, min(start + per_page, last))]
+
+    def _serve(self, endpoint: str, body):
+      status, headers = mock._account(endpoint)
+      if mock.latency > 0:
+        time.sleep(mock.latency)
+      if status != 200:
+        self._reply(status, headers, {"message": "Rate Limit Exceeded" if status == 429 else "Internal Server Error"})
+        return
+      payload = body()
+      if payload is None:
+        self._reply(404, headers, {"message": "Record Not Found"})
+      else:
+        self._reply(200, headers, payload)
+
+    def _reply(self, status: int, headers: dict, payload):
+      data = json.dumps(payload).encode()
+      self.send_response(status)
+      self.send_header("Content-Type", "application/json; charset=utf-8")
+      self.send_header("Content-Length", str(len(data)))
+      for key, value in headers.items():
+        self.send_header(key, value)
+      self.end_headers()
+      self.wfile.write(data)
+      mock._sent(status, len(data))
+
+  return RequestHandler
+
+def main():
+  """
+  Serves a mock strava until interrupted
+  """
+  parser = argparse.ArgumentParser(description="Serves a synthetic athlete's workouts, mimicking strava's API")
+  parser.add_argument("--activities", type=int, default=1000, help="how many workouts the athlete has")
+  parser.add_argument("--port", type=int, default=8080, help="port to serve on")
+  parser.add_argument("--latency", type=float, default=0.0, help="seconds every response is delayed by")
+  parser.add_argument("--error-rate", type=float, default=0.0, help="share of requests answered with a 500")
+  parser.add_argument("--throttle-rate", type=float, default=0.0, help="share of requests answered with a 429")
+  args = parser.parse_args()
+  mock = MockStrava(activities=args.activities, port=args.port, latency=args.latency, error_rate=args.error_rate, throttle_rate=args.throttle_rate)
+  print(f"🏃 Serving {args.activities} workouts on {mock.start()}. Access token: {MockStrava.ACCESS_TOKEN}")
+  try:
+    while True:
+      time.sleep(3600)
+  except KeyboardInterrupt:
+    mock.stop()
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,84 @@
+"""
+Posts strava-shaped push subscription events to the exporter's webhook receiver, so push sync can be tried offline, against the mock.
+Run from the repo's root folder, with the exporter running with `--webhook` against `benchmarks/mock_strava.py`:
+`python3 benchmarks/webhook_events.py --url http://127.0.0.1:8080/webhook create:1000001000 update:1000000999 delete:1000000998`
+"""
+import argparse
+import json
+import sys
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+
+def make_event(spec: str, owner_id: int) -> dict:
+  """
+  Builds an event from a `create:ID`, `update:ID[:new title]`, `delete:ID` or `deauthorize` spec, shaped as strava posts them
+  """
+  kind, _, rest = spec.partition(":")
+  event = {"aspect_type": kind, "event_time": int(time.time()), "object_type": "activity", "owner_id": owner_id, "subscription_id": 1, "updates": {}}
+  match kind:
+    case "deauthorize":
+      event.update({"aspect_type": "update", "object_type": "athlete", "object_id": owner_id, "updates": {"authorized": "false"}})
+    case "create" | "delete":
+      event["object_id"] = int(rest)
+    case "update":
+      object_id, _, title = rest.partition(":")
+      event.update({"object_id": int(object_id), "updates": {"title": title} if title else {"type": "Ride"}})
+    case _:
+      raise ValueError(f"unknown event \"{spec}\"")
+  return event
+
+def post(url: str, event: dict) -> int:
+  """
+  Posts an event, and returns the status code it got
+  """
+  request = urllib.request.Request(url, data=json.dumps(event).encode(), headers={"Content-Type": "application/json"}, method="POST")
+  try:
+    with urllib.request.urlopen(request, timeout=10) as response:
+      return response.status
+  except urllib.error.HTTPError as e:
+    return e.code
+
+def validate(url: str, verify_token: str) -> bool:
+  """
+  Sends a subscription validation request, as strava does when creating a subscription, and checks the challenge is echoed back
+  """
+  query = urllib.parse.urlencode({"hub.mode": "subscribe", "hub.challenge": "mock-challenge", "hub.verify_token": verify_token})
+  try:
+    with urllib.request.urlopen(f"{url}?{query}", timeout=10) as response:
+      return json.loads(response.read()).get("hub.challenge") == "mock-challenge"
+  except urllib.error.HTTPError:
+    return False
+
+def main():
+  """
+  Posts every event asked for, then prints how each went
+  """
+  parser = argparse.ArgumentParser(description="Posts push subscription events to the exporter's webhook receiver")
+  parser.add_argument("events", nargs="*", help="events to post: create:ID, update:ID[:new title], delete:ID or deauthorize")
+  parser.add_argument("--url", default="http://127.0.0.1:8080/webhook", help="the receiver's callback URL")
+  parser.add_argument("--owner-id", type=int, default=1, help="athlete the events belong to. The mock's is 1")
+  parser.add_argument("--file", help="JSON file holding a list of events to post as they are, before any given as arguments")
+  parser.add_argument("--validate", metavar="TOKEN", help="send a subscription validation request with TOKEN as its verify token first")
+  args = parser.parse_args()
+
+  ok = True
+  if args.validate is not None:
+    validated = validate(args.url, args.validate)
+    ok = ok and validated
+    print(f"{'✅' if validated else '❌'} validation")
+  events = []
+  if args.file:
+    with open(args.file, mode="r", encoding="utf8") as f:
+      events += json.load(f)
+  events += [make_event(x, args.owner_id) for x in args.events]
+  for event in events:
+    status = post(args.url, event)
+    ok = ok and status == 200
+    print(f"{'✅' if status == 200 else '❌'} {event['object_type']}:{event['aspect_type']} {event['object_id']} -> {status}")
+  if not ok:
+    sys.exit(1)
+
+if __name__ == "__main__":
+  main()
@@ -2,6 +2,7 @@
 Configuration module, containing the config class.
 """
 import json
+import os
 class Config:
   """
   #### Description
@@ -9,6 +10,7 @@ class Config:
   #### Available functions
   - `ask_for_path(message: str, prompt: str) -> str`: asks the user for a directory path
   - `read_config_file(config_file: str) -> str`: reads the app's config file from disk
+  - `read_config_option(config_file: str, option: str, default=None)`: reads a single optional setting from the app's config file
   - `read_downloaded_workouts(db_file: str) -> dict`: loads the downloaded workouts database from its JSON file and returns it as a dict
   - `read_secrets_file(secrets_file: str) -> list`: reads the app's secrets file from disk
   - `write_config_file(config_file: str, tracks_output_path: str)`: writes the app's config file to disk
@@ -24,19 +26,22 @@ class Config:
     #### Returns
     - A list containing all of the app's secrets
     #### Notes
+    The access token's expiry is `0` on secrets files written by older versions, which didn't keep it
     """
     with open(secrets_file, mode="r", encoding="utf8") as f:
       conf = json.loads(f.read())
       return conf['strava_access_token'], \
             conf['strava_refresh_token'], \
             conf['strava_client_id'], \
-            conf['strava_client_secret']
+            conf['strava_client_secret'], \
+            conf.get('strava_token_expires_at', 0)
 
   def write_secrets_file(self, secrets_file: str,
                         strava_client_id: str = "",
                         strava_client_secret: str = "",
                         strava_access_token: str = "",
-                        strava_refresh_token: str = ""):
+                        strava_refresh_token: str = "",
+                        strava_token_expires_at: int = 0):
     """
     #### Description
     Writes the app's secrets file to disk
@@ -46,14 +51,19 @@ class Config:
     - `strava_client_secret`: strava's client secret (from strava's API settings)
     - `strava_access_token`: strava's access token
     - `strava_refresh_token`: strava's refresh token
+    - `strava_token_expires_at`: when strava's access token expires, as a unix timestamp
+    #### Notes
+    Written to a temporary file first, then moved into place, so a run cut short never leaves it half-written. Refresh tokens can't be recovered if lost.
     """
-    with open(secrets_file, mode="w", encoding="utf8") as f:
+    with open(f"{secrets_file}.tmp", mode="w", encoding="utf8") as f:
       conf = {}
       conf['strava_access_token'] = strava_access_token
       conf['strava_refresh_token'] = strava_refresh_token
       conf['strava_client_id'] = strava_client_id
       conf['strava_client_secret'] = strava_client_secret
+      conf['strava_token_expires_at'] = strava_token_expires_at
       f.write(json.dumps(conf))
+    os.replace(f"{secrets_file}.tmp", secrets_file)
 
   def read_config_file(self, config_file: str) -> str:
     """
@@ -69,6 +79,23 @@ class Config:
       conf = json.loads(f.read())
       return conf['tracks_output_path'], conf['workouts_output_path']
 
+  def read_config_option(self, config_file: str, option: str, default=None):
+    """
+    #### Description
+    Reads a single optional setting from the app's config file
+    #### Parameters
+    - `config_file`: full path to the file where config is stored
+    - `option`: name of the setting to be read
+    - `default`: value to be returned if the setting isn't present on the config file
+    #### Returns
+    The setting's value if set. Otherwise `default`
+    #### Notes
+    Optional settings aren't asked for during setup. To change them, add them to the config file by hand.
+    """
+    with open(config_file, mode="r", encoding="utf8") as f:
+      conf = json.loads(f.read())
+      return conf.get(option, default)
+
   def write_config_file(self, config_file: str, tracks_output_path: str, workouts_output_path: str):
     """
     #### Description
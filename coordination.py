@@ -0,0 +1,226 @@
+"""
+Coordination module, containing the work queue and quota ledger shared by exporters running on several machines.
+"""
+import os
+import socket
+import time
+from state_store import Database
+
+def _as_usage(windows: dict) -> list:
+  # Lays out the ledger's windows the same way strava's ratelimit headers are
+  return [windows["15m"][0], windows["daily"][0], windows["15m"][1], windows["daily"][1]]
+
+class WorkQueue(Database):
+  """
+  #### Description
+  This class keeps a queue of workouts to be downloaded, shared by every exporter pointed at the same database.
+  Workouts are claimed on a time-limited lease, so no two exporters download the same one, and the leases of crashed exporters expire and are claimed again.
+  #### Available functions
+  - `claim(count: int = 1) -> dict`: claims pending workouts, plus any whose lease expired
+  - `close()`: releases this exporter's leases and closes the database
+  - `commit()`: does nothing. Every change is written right away, so other exporters see it
+  - `complete(workout_id: int)`: flags a workout as downloaded
+  - `counts() -> dict`: returns how many workouts are on each state
+  - `enqueue(workout_list: dict) -> int`: adds workouts to the queue, unless already there
+  - `fail(workout_id: int)`: returns a workout to the queue, or gives up on it once it failed too many times
+  - `release(workout_id: int = None)`: returns claimed workouts to the queue without counting it as a failure
+  #### Notes
+  Meant to live on a shared filesystem, so it doesn't use SQLite's `WAL` journal, which needs shared memory.
+  Workouts are `pending`, `leased`, `done` or `failed`.
+  """
+
+  def __init__(self, db_file: str, lease_seconds: int = 1200, max_attempts: int = 3):
+    """
+    #### Parameters
+    - `db_file`: full path to the database file. Created if missing
+    - `lease_seconds`: how long a claimed workout is held before others may claim it. Longer than a 15-minute ratelimit pause, so paused exporters keep theirs
+    - `max_attempts`: how many times a workout may fail before giving up on it
+    """
+    super().__init__(db_file=db_file, journal_mode="DELETE")
+    self.owner = f"{socket.gethostname()}:{os.getpid()}"
+    self._lease_seconds = lease_seconds
+    self._max_attempts = max_attempts
+    self._db.execute("CREATE TABLE IF NOT EXISTS work_items (workout_id INTEGER PRIMARY KEY, name TEXT NOT NULL, state TEXT NOT NULL, " \
+                     "owner TEXT, lease_expires REAL, attempts INTEGER NOT NULL DEFAULT 0, updated_at INTEGER NOT NULL)")
+    self._db.execute("CREATE INDEX IF NOT EXISTS work_items_state ON work_items (state, lease_expires)")
+
+  def enqueue(self, workout_list: dict) -> int:
+    """
+    #### Description
+    Adds workouts to the queue, unless already there
+    #### Parameters
+    - `workout_list`: a dict where its key is the workout ID and its value the workout's name
+    #### Returns
+    The amount of workouts added
+    """
+    with self._lock, self._transaction():
+      before = self._db.total_changes
+      self._db.executemany("INSERT OR IGNORE INTO work_items (workout_id, name, state, updated_at) VALUES (?, ?, 'pending', ?)",
+                           [(int(k), v, int(time.time())) for k, v in workout_list.items()])
+      return self._db.total_changes - before
+
+  def claim(self, count: int = 1) -> dict:
+    """
+    #### Description
+    Claims pending workouts, plus any whose lease expired, newest first
+    #### Parameters
+    - `count`: how many workouts to claim at most
+    #### Returns
+    A dict where its key is the workout ID and its value the workout's name. Empty once there's nothing left to claim
+    """
+    now = time.time()
+    with self._lock, self._transaction():
+      claimed = dict(self._db.execute("SELECT workout_id, name FROM work_items WHERE state = 'pending' OR (state = 'leased' AND lease_expires < ?) " \
+                                      "ORDER BY workout_id DESC LIMIT ?", (now, int(count))).fetchall())
+      self._db.executemany("UPDATE work_items SET state = 'leased', owner = ?, lease_expires = ?, updated_at = ? WHERE workout_id = ?",
+                           [(self.owner, now + self._lease_seconds, int(now), x) for x in claimed])
+    return claimed
+
+  def complete(self, workout_id: int):
+    """
+    #### Description
+    Flags a workout as downloaded. Done even if its lease expired meanwhile, since it's downloaded anyway
+    #### Parameters
+    - `workout_id`: the workout's ID
+    """
+    with self._lock:
+      self._db.execute("UPDATE work_items SET state = 'done', owner = NULL, lease_expires = NULL, updated_at = ? WHERE workout_id = ?",
+                       (int(time.time()), int(workout_id)))
+
+  def fail(self, workout_id: int):
+    """
+    #### Description
+    Returns a workout to the queue, so it's retried later on, or gives up on it once it failed too many times
+    #### Parameters
+    - `workout_id`: the workout's ID
+    """
+    with self._lock:
+      self._db.execute("UPDATE work_items SET state = CASE WHEN attempts + 1 >= ? THEN 'failed' ELSE 'pending' END, attempts = attempts + 1, " \
+                       "owner = NULL, lease_expires = NULL, updated_at = ? WHERE workout_id = ? AND owner = ? AND state = 'leased'",
+                       (self._max_attempts, int(time.time()), int(workout_id), self.owner))
+
+  def release(self, workout_id: int = None):
+    """
+    #### Description
+    Returns claimed workouts to the queue without counting it as a failure, such as when the daily ratelimit is reached
+    #### Parameters
+    - `workout_id`: the workout's ID. All of this exporter's claimed workouts if `None`
+    """
+    with self._lock:
+      if workout_id is None:
+        self._db.execute("UPDATE work_items SET state = 'pending', owner = NULL, lease_expires = NULL, updated_at = ? WHERE owner = ? AND state = 'leased'",
+                         (int(time.time()), self.owner))
+      else:
+        self._db.execute("UPDATE work_items SET state = 'pending', owner = NULL, lease_expires = NULL, updated_at = ? " \
+                         "WHERE workout_id = ? AND owner = ? AND state = 'leased'", (int(time.time()), int(workout_id), self.owner))
+
+  def counts(self) -> dict:
+    """
+    #### Description
+    Returns how many workouts are on each state
+    #### Returns
+    A dict where its key is the state and its value the amount of workouts on it. Expired leases count as `pending`
+    """
+    result = {"pending": 0, "leased": 0, "done": 0, "failed": 0}
+    with self._lock:
+      result.update(self._db.execute("SELECT CASE WHEN state = 'leased' AND lease_expires < ? THEN 'pending' ELSE state END AS s, COUNT(*) " \
+                                     "FROM work_items GROUP BY s", (time.time(),)).fetchall())
+    return result
+
+  def commit(self):
+    """
+    #### Description
+    Does nothing. Every change is written right away, so other exporters see it
+    """
+
+  def close(self):
+    """
+    #### Description
+    Releases this exporter's leases, so others don't have to wait for them to expire, then closes the database
+    """
+    with self._lock:
+      self.release()
+      super().close()
+
+class QuotaLedger(Database):
+  """
+  #### Description
+  This class keeps track of the requests sent to strava by every exporter pointed at the same database, on each ratelimit window.
+  Strava's ratelimits apply to the API app, not to each exporter, so every request is reserved on the ledger before being sent,
+  and the usage strava reports is written back to it.
+  #### Available functions
+  - `commit()`: does nothing. Every change is written right away, so other exporters see it
+  - `report(usage: list)`: writes back the ratelimits and usage strava reported
+  - `reserve() -> tuple`: reserves a request on both ratelimit windows, if there's budget left on them
+  - `usage() -> list`: returns the ratelimits and usage on the ledger
+  #### Notes
+  Meant to live on a shared filesystem, so it doesn't use SQLite's `WAL` journal, which needs shared memory.
+  Until strava reports its ratelimits, requests are counted but never refused.
+  """
+  WINDOWS = {"15m": 900, "daily": 86400}
+
+  def __init__(self, db_file: str):
+    """
+    #### Parameters
+    - `db_file`: full path to the database file. Created if missing
+    """
+    super().__init__(db_file=db_file, journal_mode="DELETE")
+    self._db.execute("CREATE TABLE IF NOT EXISTS quota_ledger (window TEXT PRIMARY KEY, window_id INTEGER NOT NULL, lim INTEGER, used INTEGER NOT NULL)")
+
+  def reserve(self) -> tuple:
+    """
+    #### Description
+    Reserves a request on both ratelimit windows, if there's budget left on them
+    #### Returns
+    A tuple containing `True` if reserved, `False` otherwise, and the ledger's usage, as returned by `usage`
+    """
+    with self._lock, self._transaction():
+      windows = self._read_locked()
+      granted = all(lim is None or used < lim for lim, used in windows.values())
+      if granted:
+        windows = {k: (lim, used + 1) for k, (lim, used) in windows.items()}
+        self._write_locked(windows)
+    return granted, _as_usage(windows)
+
+  def report(self, usage: list):
+    """
+    #### Description
+    Writes back the ratelimits and usage strava reported. Usage only ever grows within a window, so reports arriving late are ignored
+    #### Parameters
+    - `usage`: a list containing [`15-minute ratelimit`, `daily ratelimit`, `15-minute usage`, `daily usage`]
+    """
+    lim_15, lim_daily, u_15, u_daily = usage
+    with self._lock, self._transaction():
+      windows = self._read_locked()
+      self._write_locked({"15m": (lim_15, max(windows["15m"][1], u_15)), "daily": (lim_daily, max(windows["daily"][1], u_daily))})
+
+  def usage(self) -> list:
+    """
+    #### Description
+    Returns the ratelimits and usage on the ledger
+    #### Returns
+    A list containing [`15-minute ratelimit`, `daily ratelimit`, `15-minute usage`, `daily usage`]. Ratelimits are `None` if unknown yet
+    """
+    with self._lock:
+      return _as_usage(self._read_locked())
+
+  def commit(self):
+    """
+    #### Description
+    Does nothing. Every change is written right away, so other exporters see it
+    """
+
+  def _read_locked(self) -> dict:
+    # Usage recorded for a window that's already over no longer counts
+    now = time.time()
+    rows = {x[0]: x[1:] for x in self._db.execute("SELECT window, window_id, lim, used FROM quota_ledger")}
+    windows = {}
+    for window, length in QuotaLedger.WINDOWS.items():
+      window_id, lim, used = rows.get(window, (None, None, 0))
+      windows[window] = (lim, used if window_id == int(now // length) else 0)
+    return windows
+
+  def _write_locked(self, windows: dict):
+    now = time.time()
+    self._db.executemany("INSERT OR REPLACE INTO quota_ledger VALUES (?, ?, ?, ?)",
+                         [(k, int(now // QuotaLedger.WINDOWS[k]), lim, used) for k, (lim, used) in windows.items()])
@@ -0,0 +1,98 @@
+"""
+GPX writer module, containing a streaming GPX 1.1 writer.
+"""
+import math
+import time
+from itertools import repeat
+
+class GpxWriter:
+  """
+  #### Description
+  This class writes GPX 1.1 tracks straight to a buffered file, one point at a time, without building the whole document in memory first.
+  Its output is the same `gpxpy` would produce for the same coordinates.
+  #### Available functions
+  - `format_coordinate(value: float) -> str`: formats a coordinate the same way `gpxpy` does
+  - `write_detailed_track(coordinates, output_file: str, elevations, times, heartrates, cadences, watts)`: writes a single-segment track with elevation, time and sensor data to a gpx file
+  - `write_track(coordinates, output_file: str)`: writes a single-segment track to a gpx file
+  """
+  HEADER = '<?xml version="1.0" encoding="UTF-8"?>\n' \
+           '<gpx xmlns="http://www.topografix.com/GPX/1/1" xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance" ' \
+           'xsi:schemaLocation="http://www.topografix.com/GPX/1/1 http://www.topografix.com/GPX/1/1/gpx.xsd" ' \
+           'version="1.1" creator="gpx.py -- https://github.com/tkrajina/gpxpy">'
+  # Heart rate and cadence go on Garmin's TrackPointExtension, which most tools read. Power has no standard, so it goes on a plain `power` element
+  DETAILED_HEADER = HEADER.replace('xmlns:xsi=', 'xmlns:gpxtpx="http://www.garmin.com/xmlschemas/TrackPointExtension/v1" xmlns:xsi=')
+  BUFFER_SIZE = 256 * 1024
+
+  def format_coordinate(self, value: float) -> str:
+    """
+    #### Description
+    Formats a coordinate the same way `gpxpy` does
+    #### Parameters
+    - `value`: latitude or longitude
+    #### Returns
+    The coordinate as a string, never in scientific notation, which isn't valid on GPX 1.1
+    """
+    result = str(value or 0)
+    if "e" not in result:
+      return result
+    return format(value, '.10f').rstrip('0').rstrip('.')
+
+  def write_track(self, coordinates, output_file: str):
+    """
+    #### Description
+    Writes a single-segment track to a gpx file
+    #### Parameters
+    - `coordinates`: an iterable of `(latitude, longitude)` pairs, such as the one provided by the `decode_polyline` function
+    - `output_file`: full path of the gpx file to be written
+    """
+    fmt = self.format_coordinate
+    with open(output_file, 'w', encoding="utf8", buffering=GpxWriter.BUFFER_SIZE) as f:
+      f.write(GpxWriter.HEADER)
+      f.write("\n  <trk>\n    <trkseg>")
+      f.writelines(f'\n      <trkpt lat="{fmt(lat)}" lon="{fmt(lon)}">\n      </trkpt>' for lat, lon in coordinates)
+      f.write("\n    </trkseg>\n  </trk>\n</gpx>")
+
+  def write_detailed_track(self, coordinates, output_file: str, *, elevations = None, times = None, heartrates = None, cadences = None, watts = None):
+    """
+    #### Description
+    Writes a single-segment track with elevation, time and sensor data to a gpx file
+    #### Parameters
+    - `coordinates`: an iterable of `(latitude, longitude)` pairs
+    - `output_file`: full path of the gpx file to be written
+    - `elevations`: an iterable with each point's elevation, in meters. Optional
+    - `times`: an iterable with each point's time, as a unix timestamp. Optional
+    - `heartrates`: an iterable with each point's heart rate, in beats per minute. Optional
+    - `cadences`: an iterable with each point's cadence. Optional
+    - `watts`: an iterable with each point's power, in watts. Optional
+    #### Notes
+    Missing values, either `None`, `NaN` or negative, are left out of their point. Points missing their coordinates are left out altogether.
+    """
+    fmt = self.format_coordinate
+    columns = [repeat(None) if x is None else x for x in (elevations, times, heartrates, cadences, watts)]
+
+    def trkpt(lat: float, lon: float, values: list) -> str:
+      if math.isnan(lat) or math.isnan(lon):
+        return ""
+      ele, when, hr, cad, power = values
+      point = [f'\n      <trkpt lat="{fmt(lat)}" lon="{fmt(lon)}">']
+      if ele is not None and not math.isnan(ele):
+        point.append(f"\n        <ele>{ele}</ele>")
+      if when is not None:
+        point.append(f"\n        <time>{time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime(when))}</time>")
+      tpx = [f"\n            <gpxtpx:{k}>{v}</gpxtpx:{k}>" for k, v in (("hr", hr), ("cad", cad)) if v is not None and v >= 0]
+      has_power = power is not None and power >= 0
+      if tpx or has_power:
+        point.append("\n        <extensions>")
+        if tpx:
+          point.append("\n          <gpxtpx:TrackPointExtension>" + "".join(tpx) + "\n          </gpxtpx:TrackPointExtension>")
+        if has_power:
+          point.append(f"\n          <power>{power}</power>")
+        point.append("\n        </extensions>")
+      point.append("\n      </trkpt>")
+      return "".join(point)
+
+    with open(output_file, 'w', encoding="utf8", buffering=GpxWriter.BUFFER_SIZE) as f:
+      f.write(GpxWriter.DETAILED_HEADER)
+      f.write("\n  <trk>\n    <trkseg>")
+      f.writelines(trkpt(lat, lon, values) for (lat, lon), *values in zip(coordinates, *columns))
+      f.write("\n    </trkseg>\n  </trk>\n</gpx>")
@@ -1,11 +1,11 @@
 """
 Helper module, containing misc functions
 """
-from datetime import datetime
+import hashlib
+import math
 import os
 import re
 import time
-import emoji
 import requests
 
 class Helpers:
@@ -13,9 +13,12 @@ class Helpers:
   #### Description
   This class provides miscelaneous helper functions and methods.
   #### Available functions
+  - `file_digest(path: str) -> tuple`: returns a file's size and the hex digest of its contents
+  - `format_duration(seconds: float) -> str`: formats an amount of seconds as a short, human-readable duration
   - `get_rate_limits(res: requests.Response) -> list`: returns strava's rate limits and usage quota from a given requests' response
   - `is_duplicate(paths: list, filename: str) -> bool`: checks if a file already exists on any of the given paths
   - `sanitize_filename(filename: str) -> str`: sanitizes a string so it can become a valid filename
+  - `seconds_to_next_window(window: int = 900, now: float = None) -> float`: returns how many seconds are left until the next clock-aligned ratelimit window starts
   - `wait_for_it(extra_message: str = "")`: waits for a set amount of time, while printing a message letting the user know how much time is left in seconds
   - `welcome()`: prints the welcome message
   """
@@ -47,7 +50,8 @@ class Helpers:
     #### Notes
     Supports Linux, Macos, and Windows
     """
-    # Remove emojis
+    # Remove emojis. Only imported once needed, since loading its tables takes longer than a run with nothing new to sync
+    import emoji # pylint: disable=import-outside-toplevel
     result = emoji.replace_emoji(filename,"").strip()
 
     # Replace invalid characters with underscores
@@ -63,27 +67,57 @@ class Helpers:
     - `extra_message`: A custom message to be added before the countdown message
     #### Notes
     The countdown will be a one-liner which'll update every second. Useful to avoid log noise.
-    Strava's 15-minute ratelimiter resets every quarter hour, so we must wait until then before resuming.
-    Cooldown time could be anywhere between 0 and 900 seconds.
+    Strava's 15-minute ratelimiter resets every quarter hour, so we must wait until the next one before resuming.
+    Cooldown time could be anywhere between 0 and 900 seconds. See `seconds_to_next_window`.
     """
     if extra_message != "":
       print(f"\033[33m⏰ {extra_message}\033[0m")
 
-    # Get seconds to wait for ratelimiter to reset
-    reset_seconds = [900, 1800, 2700, 3600]
-    current_seconds = datetime.now().second + (datetime.now().minute * 60)
-    for reset_point in reset_seconds:
-      result = current_seconds / reset_point
-      if result <= 1:
-        time_wait = reset_point - current_seconds + 1
-        break
-
-    # Wait for ratelimiter to reset
-    for x in range(time_wait, 0, -1):
+    # Wait for ratelimiter to reset. Sleep against a deadline, so the countdown doesn't drift
+    deadline = time.time() + Helpers.seconds_to_next_window(self, window=900) + 1
+    while (time_left := deadline - time.time()) > 0:
+      x = math.ceil(time_left)
       print(f"\033[33m⏰ Rate limit exceeded. Sleeping for {x} second{'' if x == 1 else 's'}  \033[0m", end='\r', flush=True)
-      time.sleep(1)
+      time.sleep(time_left % 1 or 1)
     print("\n")
 
+  def seconds_to_next_window(self, window: int = 900, now: float = None) -> float:
+    """
+    #### Description
+    Returns how many seconds are left until the next clock-aligned ratelimit window starts
+    #### Parameters
+    - `window`: window length in seconds. `900` for strava's 15-minute ratelimiter, `86400` for its daily one
+    - `now`: unix timestamp to count from. Defaults to the current time
+    #### Returns
+    Seconds left until the next window, between `0` (excluded) and `window` (included)
+    #### Notes
+    Windows are aligned to the unix epoch, so 15-minute ones start at every quarter hour and daily ones at midnight UTC, as strava's do.
+    """
+    if now is None:
+      now = time.time()
+    return window - (now % window)
+
+  def format_duration(self, seconds: float) -> str:
+    """
+    #### Description
+    Formats an amount of seconds as a short, human-readable duration
+    #### Parameters
+    - `seconds`: the duration to be formatted
+    #### Returns
+    A string such as `1d 3h 20m`, `3h 20m`, `20m 5s` or `5s`
+    """
+    seconds = int(round(seconds))
+    days, seconds = divmod(seconds, 86400)
+    hours, seconds = divmod(seconds, 3600)
+    minutes, seconds = divmod(seconds, 60)
+    if days > 0:
+      return f"{days}d {hours}h {minutes}m"
+    if hours > 0:
+      return f"{hours}h {minutes}m"
+    if minutes > 0:
+      return f"{minutes}m {seconds}s"
+    return f"{seconds}s"
+
   def is_duplicate(self, paths: list, filename: str) -> bool:
     """
     #### Description
@@ -101,6 +135,23 @@ class Helpers:
         return True
     return False
 
+  def file_digest(self, path: str) -> tuple:
+    """
+    #### Description
+    Returns a file's size and the hex digest of its contents
+    #### Parameters
+    - `path`: full path of the file
+    #### Returns
+    A tuple containing the file's size in bytes and its sha256 hex digest
+    """
+    digest = hashlib.sha256()
+    size = 0
+    with open(path, mode="rb") as f:
+      for chunk in iter(lambda: f.read(1024 * 1024), b""):
+        digest.update(chunk)
+        size += len(chunk)
+    return size, digest.hexdigest()
+
   def get_rate_limits(self, res: requests.Response) -> list:
     """
     #### Description
@@ -0,0 +1,138 @@
+"""
+HTTP client module, containing the pooled session every request to strava goes through.
+"""
+import re
+import threading
+from urllib.parse import urlparse
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+# Connection settings, plus the session and auth they're applied to.
+# pylint: disable=too-many-instance-attributes
+class HttpClient:
+  """
+  #### Description
+  This class provides a single, pooled HTTP session to be shared by everything talking to strava.
+  Connections are kept alive and reused, so only the first request to a host pays for the TLS handshake.
+  Server errors and connection errors are retried with a jittered, exponential backoff, and responses are gzip-compressed.
+  #### Available functions
+  - `authenticate(auth: requests.auth.AuthBase)`: signs every request sent from now on with the given auth, such as a `TokenManager`
+  - `close()`: closes all pooled connections
+  - `get(url: str, **kwargs) -> requests.Response`: sends a GET request
+  - `post(url: str, **kwargs) -> requests.Response`: sends a POST request
+  #### Notes
+  When given a `Metrics`, every response is counted by endpoint and status code, along with its size and latency.
+  Safe to be used from several threads at once. Ratelimit handling is left to `RateLimiter`, so 429 responses are never retried here.
+  Only GET requests are retried once sent, since POSTs to strava's oauth endpoints aren't idempotent. Connection errors are retried for all of them.
+  """
+  RETRY_STATUSES = (500, 502, 503, 504)
+
+  def __init__(self, pool_size: int = 10, retries: int = 3, backoff: float = 0.5, timeout: float = 60, connect_timeout: float = 10, metrics = None):
+    """
+    #### Parameters
+    - `pool_size`: how many connections to keep alive per host. Should be at least as many as threads making requests
+    - `retries`: how many times to retry a request on server or connection errors
+    - `backoff`: base delay between retries, in seconds. Doubles on every retry, plus up to as much random jitter
+    - `timeout`: how long to wait for strava to send data, in seconds
+    - `connect_timeout`: how long to wait for a connection to be established, in seconds
+    - `metrics`: a `Metrics` to record responses on. Optional
+    """
+    self.pool_size = max(int(pool_size), 1)
+    self.retries = max(int(retries), 0)
+    self.backoff = backoff
+    self.timeout = (connect_timeout, timeout)
+    self.metrics = metrics
+    self.auth = None
+    self._lock = threading.Lock()
+    self._session = None
+
+  def authenticate(self, auth: requests.auth.AuthBase):
+    """
+    #### Description
+    Signs every request sent from now on with the given auth, such as a `TokenManager`. Explicit `Authorization` headers are overridden by it
+    #### Parameters
+    - `auth`: what to sign requests with. `None` stops signing them
+    """
+    with self._lock:
+      self.auth = auth
+      if self._session is not None:
+        self._session.auth = auth
+
+  def get(self, url: str, **kwargs) -> requests.Response:
+    """
+    #### Description
+    Sends a GET request
+    #### Parameters
+    - `url`: URL to send the request to
+    - `kwargs`: any other argument `requests` takes, such as `headers` or `params`
+    #### Returns
+    The response. Once retries run out, the last one received
+    """
+    kwargs.setdefault("timeout", self.timeout)
+    return self._get_session().get(url, **kwargs)
+
+  def post(self, url: str, **kwargs) -> requests.Response:
+    """
+    #### Description
+    Sends a POST request
+    #### Parameters
+    - `url`: URL to send the request to
+    - `kwargs`: any other argument `requests` takes, such as `data` or `headers`
+    #### Returns
+    The response. Once retries run out, the last one received
+    """
+    kwargs.setdefault("timeout", self.timeout)
+    return self._get_session().post(url, **kwargs)
+
+  def close(self):
+    """
+    #### Description
+    Closes all pooled connections. The client can still be used afterwards, opening new ones
+    """
+    with self._lock:
+      if self._session is not None:
+        self._session.close()
+        self._session = None
+
+  def __getstate__(self) -> dict:
+    # Sessions can't cross process boundaries. Workers get their own on first use
+    state = self.__dict__.copy()
+    state["_lock"], state["_session"] = None, None
+    return state
+
+  def __setstate__(self, state: dict):
+    self.__dict__.update(state)
+    self._lock = threading.Lock()
+
+  def _get_session(self) -> requests.Session:
+    # Sessions are created on first use, so clients that never send a request don't open any connection
+    with self._lock:
+      if self._session is None:
+        retry = Retry(total=self.retries,
+                      status_forcelist=HttpClient.RETRY_STATUSES,
+                      allowed_methods=frozenset({"GET"}),
+                      backoff_factor=self.backoff,
+                      backoff_jitter=self.backoff,
+                      raise_on_status=False)
+        adapter = HTTPAdapter(pool_maxsize=self.pool_size, max_retries=retry)
+        session = requests.Session()
+        session.headers.update({"Accept-Encoding": "gzip, deflate", "Connection": "keep-alive"})
+        session.auth = self.auth
+        session.mount("https://", adapter)
+        session.mount("http://", adapter)
+        if self.metrics is not None:
+          session.hooks["response"].append(self._record)
+        self._session = session
+      return self._session
+
+  def _record(self, res: requests.Response, *args, **kwargs): # pylint: disable=unused-argument
+    # Workout and athlete IDs are left out of endpoints, so they don't make a metric each
+    endpoint = re.sub(r"/\d+(?=/|$)", "/{id}", urlparse(res.url).path)
+    self.metrics.count("http_requests_total", endpoint=endpoint, status=res.status_code)
+    self.metrics.count("http_downloaded_bytes_total", len(res.content), endpoint=endpoint)
+    self.metrics.observe("http_request_seconds", res.elapsed.total_seconds(), endpoint=endpoint)
+    # Retries happen within urllib3, so only the response they ended on gets here
+    retries = getattr(res.raw, "retries", None)
+    if retries is not None and retries.history:
+      self.metrics.count("http_retries_total", len(retries.history), endpoint=endpoint)
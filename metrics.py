@@ -0,0 +1,222 @@
+"""
+Metrics module, containing the counters, latency histograms and per-phase timings collected during a run.
+"""
+import cProfile
+import io
+import json
+import os
+import pstats
+import re
+import threading
+import time
+import tracemalloc
+from contextlib import contextmanager
+
+class Metrics:
+  """
+  #### Description
+  This class collects counters, gauges and latency histograms over a run, timing each of its phases.
+  Once done, they're written as a JSON summary, and as a Prometheus textfile for node_exporter's textfile collector.
+  #### Available functions
+  - `count(name: str, value: float = 1, **labels)`: adds to a counter
+  - `gauge(name: str, value: float, **labels)`: sets a gauge
+  - `observe(name: str, seconds: float, **labels)`: records a latency on a histogram
+  - `phase(name: str)`: context manager timing a phase of the run, and profiling it if enabled
+  - `summary() -> dict`: returns everything collected so far
+  - `write_json(output_file: str)`: writes the summary to a JSON file
+  - `write_prometheus(output_file: str)`: writes everything collected to a Prometheus textfile
+  #### Notes
+  Safe to be used from several threads at once. Copies sent to worker processes start empty, and what they collect isn't sent back,
+  so anything measured there must be returned to the main process and recorded from it.
+  Metric names get the `strava_exporter_` prefix on the Prometheus textfile.
+  """
+  BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+  PREFIX = "strava_exporter_"
+
+  def __init__(self, profile_dir: str = None):
+    """
+    #### Parameters
+    - `profile_dir`: folder where to dump a cProfile and a tracemalloc report for each phase. Profiling is disabled if not provided
+    """
+    self.profile_dir = profile_dir
+    self._lock = threading.Lock()
+    self._counters = {}
+    self._gauges = {}
+    self._histograms = {}
+    self._phases = {}
+    self._started = time.time()
+
+  def count(self, name: str, value: float = 1, **labels):
+    """
+    #### Description
+    Adds to a counter
+    #### Parameters
+    - `name`: the counter's name, such as `http_requests_total`
+    - `value`: how much to add
+    - `labels`: labels telling this counter apart from others of the same name, such as `status=200`
+    """
+    key = (name, tuple(sorted((k, str(v)) for k, v in labels.items())))
+    with self._lock:
+      self._counters[key] = self._counters.get(key, 0) + value
+
+  def gauge(self, name: str, value: float, **labels):
+    """
+    #### Description
+    Sets a gauge
+    #### Parameters
+    - `name`: the gauge's name, such as `ratelimit_remaining`
+    - `value`: its current value
+    - `labels`: labels telling this gauge apart from others of the same name
+    """
+    key = (name, tuple(sorted((k, str(v)) for k, v in labels.items())))
+    with self._lock:
+      self._gauges[key] = value
+
+  def observe(self, name: str, seconds: float, **labels):
+    """
+    #### Description
+    Records a latency on a histogram
+    #### Parameters
+    - `name`: the histogram's name, such as `http_request_seconds`
+    - `seconds`: the latency to record
+    - `labels`: labels telling this histogram apart from others of the same name
+    """
+    key = (name, tuple(sorted((k, str(v)) for k, v in labels.items())))
+    with self._lock:
+      histogram = self._histograms.get(key)
+      if histogram is None:
+        histogram = self._histograms[key] = {"buckets": [0] * len(Metrics.BUCKETS), "count": 0, "sum": 0.0, "max": 0.0}
+      for i, bound in enumerate(Metrics.BUCKETS):
+        if seconds <= bound:
+          histogram["buckets"][i] += 1
+      histogram["count"] += 1
+      histogram["sum"] += seconds
+      histogram["max"] = max(histogram["max"], seconds)
+
+  @contextmanager
+  def phase(self, name: str):
+    """
+    #### Description
+    Times a phase of the run, such as `listing` or `extraction`. If profiling is enabled, it's profiled with cProfile and tracemalloc too,
+    and their reports are dumped to `<profile_dir>/<name>.prof`, `<name>.txt` and `<name>.memory.txt`
+    #### Parameters
+    - `name`: the phase's name
+    #### Notes
+    cProfile only sees this thread, so work done by download threads shows as time spent waiting for them. Use it for single-threaded phases,
+    or set a single worker while profiling. Phases shouldn't be nested while profiling.
+    """
+    profiler = None
+    if self.profile_dir is not None:
+      os.makedirs(self.profile_dir, exist_ok=True)
+      tracemalloc.start()
+      profiler = cProfile.Profile()
+      profiler.enable()
+    started = time.perf_counter()
+    try:
+      yield
+    finally:
+      elapsed = time.perf_counter() - started
+      with self._lock:
+        self._phases[name] = self._phases.get(name, 0.0) + elapsed
+      if profiler is not None:
+        profiler.disable()
+        Metrics._dump_profile(self, name, profiler)
+
+  def summary(self) -> dict:
+    """
+    #### Description
+    Returns everything collected so far
+    #### Returns
+    A dict containing the run's `started_at` and `duration_seconds`, its `phases` timings, and its `counters`, `gauges` and `histograms`,
+    each being a list of dicts with their `name`, `labels` and values
+    """
+    with self._lock:
+      return {
+        "started_at": int(self._started),
+        "duration_seconds": round(time.time() - self._started, 3),
+        "phases": {k: round(v, 3) for k, v in self._phases.items()},
+        "counters": [{"name": k, "labels": dict(l), "value": v} for (k, l), v in sorted(self._counters.items())],
+        "gauges": [{"name": k, "labels": dict(l), "value": v} for (k, l), v in sorted(self._gauges.items())],
+        "histograms": [{"name": k, "labels": dict(l), "count": v["count"], "sum": round(v["sum"], 6), "max": round(v["max"], 6),
+                        "buckets": dict(zip(map(str, Metrics.BUCKETS), v["buckets"]))} for (k, l), v in sorted(self._histograms.items())],
+      }
+
+  def write_json(self, output_file: str):
+    """
+    #### Description
+    Writes the summary to a JSON file
+    #### Parameters
+    - `output_file`: full path of the JSON file to be written
+    """
+    Metrics._write_atomically(self, output_file, json.dumps(Metrics.summary(self), indent=2))
+
+  def write_prometheus(self, output_file: str):
+    """
+    #### Description
+    Writes everything collected to a Prometheus textfile
+    #### Parameters
+    - `output_file`: full path of the textfile to be written. Should end in `.prom` and be on node_exporter's textfile collector folder
+    #### Notes
+    The file is written to a temporary one first, then moved into place, so the collector never reads it half-written.
+    """
+    summary = Metrics.summary(self)
+    lines = [f"# TYPE {Metrics.PREFIX}run_started_timestamp_seconds gauge", f"{Metrics.PREFIX}run_started_timestamp_seconds {summary['started_at']}",
+             f"# TYPE {Metrics.PREFIX}run_duration_seconds gauge", f"{Metrics.PREFIX}run_duration_seconds {summary['duration_seconds']}",
+             f"# TYPE {Metrics.PREFIX}phase_duration_seconds gauge"]
+    lines += [f"{Metrics.PREFIX}phase_duration_seconds{{phase=\"{k}\"}} {v}" for k, v in summary["phases"].items()]
+    for kind in ("counters", "gauges"):
+      typed = set()
+      for x in summary[kind]:
+        name = f"{Metrics.PREFIX}{x['name']}"
+        if name not in typed:
+          typed.add(name)
+          lines.append(f"# TYPE {name} {'counter' if kind == 'counters' else 'gauge'}")
+        lines.append(f"{name}{Metrics._labels(self, x['labels'])} {x['value']}")
+    typed = set()
+    for x in summary["histograms"]:
+      name = f"{Metrics.PREFIX}{x['name']}"
+      if name not in typed:
+        typed.add(name)
+        lines.append(f"# TYPE {name} histogram")
+      for bound, count in x["buckets"].items():
+        lines.append(f"{name}_bucket{Metrics._labels(self, x['labels'], le=bound)} {count}")
+      lines.append(f"{name}_bucket{Metrics._labels(self, x['labels'], le='+Inf')} {x['count']}")
+      lines.append(f"{name}_sum{Metrics._labels(self, x['labels'])} {x['sum']}")
+      lines.append(f"{name}_count{Metrics._labels(self, x['labels'])} {x['count']}")
+    Metrics._write_atomically(self, output_file, "\n".join(lines) + "\n")
+
+  def __getstate__(self) -> dict:
+    # Locks and profilers can't cross process boundaries. Workers get an empty copy
+    return {"profile_dir": None}
+
+  def __setstate__(self, state: dict):
+    Metrics.__init__(self, **state)
+
+  def _labels(self, labels: dict, **extra) -> str:
+    labels = {**labels, **extra}
+    if not labels:
+      return ""
+    escaped = {k: re.sub(r'(["\\])', r"\\\1", str(v)).replace("\n", "\\n") for k, v in labels.items()}
+    return "{" + ",".join(f'{k}="{v}"' for k, v in escaped.items()) + "}"
+
+  def _dump_profile(self, name: str, profiler: cProfile.Profile):
+    profiler.dump_stats(f"{self.profile_dir}/{name}.prof")
+    text = io.StringIO()
+    pstats.Stats(profiler, stream=text).sort_stats("cumulative").print_stats(40)
+    with open(f"{self.profile_dir}/{name}.txt", mode="w", encoding="utf8") as f:
+      f.write(text.getvalue())
+    snapshot = tracemalloc.take_snapshot()
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    with open(f"{self.profile_dir}/{name}.memory.txt", mode="w", encoding="utf8") as f:
+      f.write(f"Current: {current / 2**20:.1f} MiB, peak: {peak / 2**20:.1f} MiB\n\nTop allocations by line:\n")
+      for stat in snapshot.statistics("lineno")[:30]:
+        f.write(f"{stat}\n")
+    with self._lock:
+      self._gauges[("phase_peak_memory_bytes", (("phase", name),))] = peak
+
+  def _write_atomically(self, output_file: str, content: str):
+    os.makedirs(os.path.dirname(os.path.abspath(output_file)), exist_ok=True)
+    with open(f"{output_file}.tmp", mode="w", encoding="utf8") as f:
+      f.write(content)
+    os.replace(f"{output_file}.tmp", output_file)
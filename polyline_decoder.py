@@ -0,0 +1,103 @@
+"""
+Polyline decoder module, containing a batch decoder for encoded polylines.
+"""
+import re
+from array import array
+from itertools import accumulate, repeat
+from operator import truediv
+
+# Every encoded value is a run of continuation chars (0x20 bit set) closed by a final one
+_VALUE = re.compile(r"[_-~]*[?-^]")
+
+class _Deltas(dict):
+  """
+  Decodes encoded values on first sight and remembers them. Consecutive points are close to each other,
+  so the same small deltas show up over and over again and most values are decoded by a dict lookup.
+  """
+  def __init__(self):
+    # Seed every value up to 3 chars long (deltas of up to ~0.16 degrees), which covers nearly all points on a track
+    super().__init__()
+    finals = [chr(x + 63) for x in range(0x20)]
+    continuations = [chr(x + 63) for x in range(0x20, 0x40)]
+    chunks = finals
+    for _ in range(2):
+      chunks = [f"{a}{b}" for a in continuations for b in chunks] + finals
+    for chunk in chunks:
+      self.__missing__(chunk)
+
+  def __missing__(self, chunk: str) -> int:
+    result, shift = 0, 0
+    for char in chunk:
+      result |= ((ord(char) - 63) & 0x1f) << shift
+      shift += 5
+    value = ~(result >> 1) if result & 1 else result >> 1
+    self[chunk] = value
+    return value
+
+class PolylineDecoder:
+  """
+  #### Description
+  This class decodes many encoded polylines at once into flat, array-backed coordinate buffers.
+  Coordinates are laid out as `[lat0, lon0, lat1, lon1, ...]` on an `array('d')`, and handed out as `memoryview` slices, so consumers can read them without copying.
+  Decoded values are the very same floats `polyline.decode` returns.
+  #### Available functions
+  - `decode(pline: str) -> array`: decodes a single polyline into a flat coordinate buffer
+  - `decode_batch(plines: list) -> list`: decodes several polylines into a single buffer, returning a view of it for each of them
+  - `pairs(buffer) -> zip`: iterates a flat coordinate buffer as `(latitude, longitude)` pairs, without copying it
+  """
+  _deltas = None
+
+  def __init__(self, precision: int = 5):
+    """
+    #### Parameters
+    - `precision`: precision of the encoded coordinates. Strava, as Google Maps does, uses 5
+    """
+    self._factor = float(10 ** precision)
+    if PolylineDecoder._deltas is None:
+      PolylineDecoder._deltas = _Deltas()
+
+  def decode(self, pline: str) -> array:
+    """
+    #### Description
+    Decodes a single polyline into a flat coordinate buffer
+    #### Parameters
+    - `pline`: polyline to be decoded
+    #### Returns
+    An `array('d')` containing `[lat0, lon0, lat1, lon1, ...]`
+    """
+    deltas = list(map(self._deltas.__getitem__, _VALUE.findall(pline)))
+    points = len(deltas) // 2
+    result = array('d', bytes(16 * points))
+    result[0::2] = array('d', map(truediv, accumulate(deltas[0:2 * points:2]), repeat(self._factor)))
+    result[1::2] = array('d', map(truediv, accumulate(deltas[1:2 * points:2]), repeat(self._factor)))
+    return result
+
+  def decode_batch(self, plines: list) -> list:
+    """
+    #### Description
+    Decodes several polylines into a single buffer
+    #### Parameters
+    - `plines`: polylines to be decoded
+    #### Returns
+    A list with a `memoryview` for each polyline, in the same order, each one pointing to its coordinates on the shared buffer as `[lat0, lon0, lat1, lon1, ...]`
+    """
+    buffer = array('d')
+    bounds = []
+    for pline in plines:
+      start = len(buffer)
+      buffer.extend(self.decode(pline or ""))
+      bounds.append((start, len(buffer)))
+    view = memoryview(buffer)
+    return [view[start:end] for start, end in bounds]
+
+  def pairs(self, buffer) -> zip:
+    """
+    #### Description
+    Iterates a flat coordinate buffer as `(latitude, longitude)` pairs, without copying it
+    #### Parameters
+    - `buffer`: a coordinate buffer, either an `array('d')` or a `memoryview` of one
+    #### Returns
+    An iterator of `(latitude, longitude)` tuples
+    """
+    view = memoryview(buffer)
+    return zip(view[0::2], view[1::2])
@@ -0,0 +1,302 @@
+"""
+Rate limiter module, containing a thread-safe budget shared by all download workers.
+"""
+import threading
+import time
+import requests
+from helpers import Helpers as helpers
+
+# Ratelimit state is made of several related values which must be updated together.
+# pylint: disable=too-many-instance-attributes
+class RateLimiter:
+  """
+  #### Description
+  This class keeps a single strava ratelimit budget that any number of workers can draw from.
+  It's fed by the `x-ratelimit-limit` and `x-ratelimit-usage` headers of every response, and paces
+  requests so the work pending is spread over what's left of the current 15-minute window instead of
+  bursting into a `429`.
+  #### Available functions
+  - `acquire() -> bool`: blocks until a request may be sent without exceeding either budget
+  - `cap(count: int)`: caps how many more requests may be sent, regardless of the budget left
+  - `cap_reached() -> bool`: tells whether the cap set through `cap` has been reached
+  - `charge() -> bool`: takes one more request from the budget, for a request sent on behalf of one already acquired, such as a retry
+  - `daily_limit_reached() -> bool`: tells whether the daily ratelimit has been exhausted
+  - `eta(pending: int = None) -> float`: estimates how many seconds it'll take to send the pending requests
+  - `plan(pending: int)`: lets the pacer know how many requests are still to be sent
+  - `rate_limited(res: requests.Response)`: pauses all workers until strava's 15-minute ratelimiter resets
+  - `release(res: requests.Response = None)`: returns a request slot and updates the budget from a response's headers
+  - `usage() -> list`: returns the last known [`15-minute limit`, `daily limit`, `15-minute usage`, `daily usage`]
+  #### Notes
+  Strava's 15-minute windows start at every quarter hour, and its daily window at midnight UTC.
+  When given a `QuotaLedger`, every request is also reserved on it, so exporters running on other machines draw from the same budget.
+  When given a `Metrics`, the quota left and time spent waiting for windows to reset are recorded on it.
+  """
+
+  def __init__(self, ledger = None, metrics = None):
+    """
+    #### Parameters
+    - `ledger`: a `QuotaLedger` shared with other exporters. Optional
+    - `metrics`: a `Metrics` to record quota and waits on. Optional
+    """
+    self._ledger = ledger
+    self._metrics = metrics
+    self._cond = threading.Condition()
+    self._lim_15, self._lim_daily, self._u_15, self._u_daily = None, None, 0, 0
+    self._window_15, self._window_daily = 0, 0
+    self._in_flight = 0
+    self._pending = 0
+    self._next_slot = 0.0
+    self._paused = False
+    self._daily_exhausted = False
+    self._cap = None
+
+  def plan(self, pending: int):
+    """
+    #### Description
+    Lets the pacer know how many requests are still to be sent
+    #### Parameters
+    - `pending`: amount of requests left to be sent
+    #### Notes
+    Requests are only spaced out when there's more work pending than budget left on the current window.
+    """
+    with self._cond:
+      self._pending = max(int(pending), 0)
+
+  def acquire(self) -> bool:
+    """
+    #### Description
+    Blocks until a request may be sent without exceeding either budget
+    #### Returns
+    `True` if the caller may send its request. `False` if the daily ratelimit, or the cap set through `cap`, has been reached
+    #### Notes
+    Every successful `acquire` must be followed by a `release` once the response is in.
+    """
+    with self._cond:
+      while True:
+        RateLimiter._rollover_locked(self)
+        if self._daily_exhausted or self._cap == 0:
+          return False
+        if self._paused:
+          self._cond.wait()
+          continue
+        if self._lim_15 is not None:
+          left_15, left_daily = self._budget_locked()
+          if min(left_15, left_daily) - self._in_flight <= 0:
+            if self._in_flight > 0:
+              # Wait for in-flight requests to report back the actual usage
+              self._cond.wait()
+            elif left_daily <= 0:
+              self._daily_exhausted = True
+            else:
+              # Budget spent. Hold everyone until the window resets
+              self._pause_locked()
+            continue
+          now = time.time()
+          if now < self._next_slot:
+            self._cond.wait(timeout=self._next_slot - now)
+            continue
+          self._next_slot = now + self._interval_locked(min(left_15, left_daily) - self._in_flight)
+        if self._ledger is not None:
+          granted, usage = self._ledger.reserve()
+          if not granted:
+            # Other exporters spent the budget. Catch up with them and wait as if we had
+            self._merge_locked(usage)
+            continue
+        self._in_flight += 1
+        self._pending = max(self._pending - 1, 0)
+        if self._cap is not None:
+          self._cap -= 1
+        return True
+
+  def cap(self, count: int):
+    """
+    #### Description
+    Caps how many more requests may be sent, regardless of the budget left. Once reached, `acquire` returns `False` as if the daily ratelimit had been
+    #### Parameters
+    - `count`: how many more requests may be sent. `None` removes the cap
+    """
+    with self._cond:
+      self._cap = None if count is None else max(int(count), 0)
+      self._cond.notify_all()
+
+  def charge(self) -> bool:
+    """
+    #### Description
+    Takes one more request from the budget, for a request sent on behalf of one already acquired, such as a retry. Never blocks
+    #### Returns
+    `True` if it may be sent without exceeding either budget, or the cap set through `cap`. `False` otherwise
+    #### Notes
+    It shares the slot of the request it's sent on behalf of, so it isn't followed by a `release` of its own.
+    """
+    with self._cond:
+      RateLimiter._rollover_locked(self)
+      if self._daily_exhausted or self._cap == 0:
+        return False
+      if self._lim_15 is not None and min(self._budget_locked()) - self._in_flight <= 0:
+        return False
+      if self._ledger is not None:
+        granted, usage = self._ledger.reserve()
+        if not granted:
+          self._merge_locked(usage)
+          return False
+      if self._cap is not None:
+        self._cap -= 1
+      return True
+
+  def cap_reached(self) -> bool:
+    """
+    #### Description
+    Tells whether the cap set through `cap` has been reached
+    #### Returns
+    `True` if reached, `False` otherwise, or if there's no cap
+    """
+    with self._cond:
+      return self._cap == 0
+
+  def release(self, res: requests.Response = None):
+    """
+    #### Description
+    Returns a request slot and updates the budget from a response's headers
+    #### Parameters
+    - `res`: the response of the request sent after `acquire`. Optional, for requests that got no response
+    """
+    with self._cond:
+      self._in_flight = max(self._in_flight - 1, 0)
+      if res is not None and 'x-ratelimit-usage' in res.headers:
+        self._update_locked(res)
+      self._cond.notify_all()
+
+  def rate_limited(self, res: requests.Response):
+    """
+    #### Description
+    Pauses all workers until strava's 15-minute ratelimiter resets. Meant to be called upon a `429` response
+    #### Parameters
+    - `res`: the response containing the ratelimit headers
+    #### Notes
+    Only the first worker to hit the ratelimiter shows the countdown. The rest just wait for it silently.
+    Shouldn't happen while pacing, unless some other client is using the same API app.
+    """
+    with self._cond:
+      if 'x-ratelimit-usage' in res.headers:
+        self._update_locked(res)
+      if self._daily_exhausted:
+        self._cond.notify_all()
+        return
+      if self._paused:
+        return
+      self._pause_locked()
+
+  def daily_limit_reached(self) -> bool:
+    """
+    #### Description
+    Tells whether the daily ratelimit has been exhausted
+    #### Returns
+    `True` if exhausted, `False` otherwise
+    """
+    with self._cond:
+      RateLimiter._rollover_locked(self)
+      return self._daily_exhausted
+
+  def usage(self) -> list:
+    """
+    #### Description
+    Returns the last known ratelimits and usage quota
+    #### Returns
+    A `list(int)` containing the values for [`15-minute ratelimit`, `daily ratelimit`, `15-minute usage`, `daily usage`]
+    """
+    with self._cond:
+      return self._lim_15, self._lim_daily, self._u_15, self._u_daily
+
+  def eta(self, pending: int = None) -> float:
+    """
+    #### Description
+    Estimates how many seconds it'll take to send the pending requests, waiting for as many 15-minute and daily windows as needed
+    #### Parameters
+    - `pending`: amount of requests to be sent. Defaults to the amount set through `plan`
+    #### Returns
+    The estimated seconds to finish, or `0` if no ratelimit headers have been seen yet
+    """
+    with self._cond:
+      if pending is None:
+        pending = self._pending
+      if self._lim_15 is None or pending <= 0:
+        return 0.0
+      left_15, left_daily = self._budget_locked()
+      now = time.time()
+      clock = now
+      while True:
+        allowance = max(min(left_15, left_daily), 0)
+        if pending < allowance:
+          return clock - now
+        if pending == allowance:
+          # The pacer spreads the last batch over what's left of its window
+          return clock - now + helpers.seconds_to_next_window(self, window=900, now=clock)
+        pending -= allowance
+        left_daily -= allowance
+        if left_daily <= 0:
+          clock += helpers.seconds_to_next_window(self, window=86400, now=clock)
+          left_daily = self._lim_daily
+        else:
+          clock += helpers.seconds_to_next_window(self, window=900, now=clock)
+        left_15 = self._lim_15
+
+  def _rollover_locked(self):
+    # The daily budget is back once its window is over. Long-lived limiters, such as push sync's, would stay exhausted for good otherwise
+    if self._daily_exhausted and self._window_daily != int(time.time() // 86400):
+      self._daily_exhausted = False
+
+  def _budget_locked(self) -> list:
+    # Usage reported for a window that's already over no longer counts
+    now = time.time()
+    u_15 = self._u_15 if self._window_15 == int(now // 900) else 0
+    u_daily = self._u_daily if self._window_daily == int(now // 86400) else 0
+    return self._lim_15 - u_15, self._lim_daily - u_daily
+
+  def _interval_locked(self, left: int) -> float:
+    # Spread pending work evenly over the current window, if it won't fit in it
+    if self._pending <= left or left <= 0:
+      return 0.0
+    return helpers.seconds_to_next_window(self, window=900) / left
+
+  def _update_locked(self, res: requests.Response):
+    self._lim_15, self._lim_daily, self._u_15, self._u_daily = helpers.get_rate_limits(self, res=res)
+    now = time.time()
+    self._window_15, self._window_daily = int(now // 900), int(now // 86400)
+    if self._u_daily >= self._lim_daily:
+      self._daily_exhausted = True
+    if self._ledger is not None:
+      self._ledger.report([self._lim_15, self._lim_daily, self._u_15, self._u_daily])
+    if self._metrics is not None:
+      self._metrics.gauge("ratelimit_remaining", max(self._lim_15 - self._u_15, 0), window="15m")
+      self._metrics.gauge("ratelimit_remaining", max(self._lim_daily - self._u_daily, 0), window="daily")
+
+  def _merge_locked(self, usage: list):
+    # Take whichever usage is higher, ours or the one on the shared ledger
+    lim_15, lim_daily, u_15, u_daily = usage
+    if lim_15 is None or lim_daily is None:
+      return
+    now = time.time()
+    u_15 = max(u_15, self._u_15 if self._window_15 == int(now // 900) else 0)
+    u_daily = max(u_daily, self._u_daily if self._window_daily == int(now // 86400) else 0)
+    self._lim_15, self._lim_daily, self._u_15, self._u_daily = lim_15, lim_daily, u_15, u_daily
+    self._window_15, self._window_daily = int(now // 900), int(now // 86400)
+    if self._u_daily >= self._lim_daily:
+      self._daily_exhausted = True
+
+  def _pause_locked(self):
+    # Sleep outside the lock so the other workers can keep reporting their responses
+    message = f"15m Limit: [{self._u_15}/{self._lim_15}], Daily Limit: [{self._u_daily}/{self._lim_daily}]"
+    self._paused = True
+    self._cond.release()
+    started = time.time()
+    try:
+      helpers.wait_for_it(self, message)
+    finally:
+      self._cond.acquire()
+    if self._metrics is not None:
+      self._metrics.count("ratelimit_pauses_total")
+      self._metrics.count("ratelimit_wait_seconds_total", time.time() - started)
+    self._paused = False
+    self._u_15 = 0
+    self._next_slot = 0.0
+    self._cond.notify_all()
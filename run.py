@@ -2,24 +2,71 @@
 Main file
 """
 import sys
-import json
 import os
+import time
+import atexit
+import argparse
 from strava_oauth import StravaOauth
 from strava_workouts import StravaWorkouts
+from rate_limiter import RateLimiter
 from helpers import Helpers
 from config import Config
+from state_store import StateStore
+from http_client import HttpClient
+from token_manager import TokenManager
+from coordination import QuotaLedger, WorkQueue
+from artifact_manifest import ArtifactManifest
+from metrics import Metrics
+from track_pipeline import TrackPipeline
+from track_exports import TrackExports
+from track_simplifier import TrackSimplifier
+from spatial_index import SpatialIndex
+from athlete_daemon import AthleteDaemon
+from webhook import EventQueue, WebhookReceiver, WebhookWorker
+from workout_storage import FieldProjection, StreamStore, WorkoutArchive, WorkoutFiles
+
+parser = argparse.ArgumentParser(description="Exports all workouts from strava, then extracts their tracks to gpx files")
+parser.add_argument("--full-sync", action="store_true", help="list the whole workout history, instead of only what's new since the last run")
+parser.add_argument("--pack-workouts", action="store_true", help="pack all workout files on the workouts folder into the workouts archive, then exit")
+parser.add_argument("--export-workouts", metavar="FOLDER", help="export the workouts archive to FOLDER, one JSON file per workout, then exit")
+parser.add_argument("--coordinated", metavar="FOLDER", help="share the download queue and ratelimit budget with other exporters through FOLDER, such as a network drive")
+parser.add_argument("--quota-ledger", metavar="FILE", help="share the ratelimit budget with other exporters through the ledger on FILE, but not the download queue")
+parser.add_argument("--max-requests", metavar="N", type=int, help="download for at most N requests after listing, then exit with code 3 if there's more left")
+parser.add_argument("--daemon", metavar="FOLDER", help="keep every athlete set up under FOLDER/athletes in sync, splitting the ratelimit budget between them")
+parser.add_argument("--settings-dir", metavar="FOLDER", help="keep settings, secrets and sync state on FOLDER instead of the settings folder next to this script")
+parser.add_argument("--profile", action="store_true", help="profile each phase with cProfile and tracemalloc, writing reports to a profiles folder next to the settings folder")
+parser.add_argument("--webhook", action="store_true", help="keep in sync from strava's push subscription events, serving its callback URL until interrupted, instead of listing workouts")
+parser.add_argument("--reconcile", action="store_true", help="rebuild the manifest of extracted tracks from the files on the tracks folder, then exit")
+parser.add_argument("--find-tracks", metavar="AREA", help="print the workouts whose track passes through AREA, given as \"south,west,north,east\" " \
+                    "or as \"latitude,longitude,radius in metres\", then exit")
+parser.add_argument("--within", action="store_true", help="with --find-tracks, only print workouts whose track lies entirely within the area")
+args = parser.parse_args()
 
 helpers = Helpers()
 config = Config()
-strava_workouts = StravaWorkouts()
-strava_oauth = StravaOauth()
 
-helpers.welcome()
+# Cron jobs mail whatever gets printed. Spare them the banner
+if sys.stdout.isatty():
+  helpers.welcome()
+
+# Daemon mode =================================================================
+if args.daemon:
+  daemon_config_file = f"{args.daemon}/daemon.json"
+  has_daemon_config = os.path.exists(daemon_config_file)
+  sync_interval_minutes = config.read_config_option(config_file=daemon_config_file, option="sync_interval_minutes", default=60) if has_daemon_config else 60
+  min_share = config.read_config_option(config_file=daemon_config_file, option="min_share", default=20) if has_daemon_config else 20
+  AthleteDaemon(daemon_dir=args.daemon, sync_interval=sync_interval_minutes * 60, min_share=min_share).run()
+  sys.exit(0)
+# =============================================================================
 
 #region #? Read config, secret handling, & do oauth
 workdir = f"{os.path.dirname(os.path.realpath(__file__))}"
-secrets_file, config_file = f"{workdir}/settings/secrets.json", f"{workdir}/settings/config.json"
-workout_db_file = f"{workdir}/settings/downloaded_workouts.json"
+settings_dir = args.settings_dir or f"{workdir}/settings"
+secrets_file, config_file = f"{settings_dir}/secrets.json", f"{settings_dir}/config.json"
+workout_db_file = f"{settings_dir}/downloaded_workouts.json"
+sync_state_file = f"{settings_dir}/sync_state.json"
+state_db_file = f"{settings_dir}/state.db"
+metrics = Metrics(profile_dir=f"{os.path.dirname(os.path.abspath(settings_dir))}/profiles" if args.profile else None)
 
 # Config file management ======================================================
 if not os.path.exists(config_file):
@@ -43,19 +90,110 @@ if not os.path.exists(config_file):
 
 else:
   tracks_dir, workouts_dir = config.read_config_file(config_file)
+
+download_workers = config.read_config_option(config_file=config_file, option="download_workers", default=4)
+full_sync_interval_days = config.read_config_option(config_file=config_file, option="full_sync_interval_days", default=7)
+workouts_storage = config.read_config_option(config_file=config_file, option="workouts_storage", default="files")
+extract_workers = config.read_config_option(config_file=config_file, option="extract_workers", default=os.cpu_count() or 1)
+gpx_writer = config.read_config_option(config_file=config_file, option="gpx_writer", default="stream")
+workout_format = config.read_config_option(config_file=config_file, option="workout_format", default="pretty")
+workout_fields_keep = config.read_config_option(config_file=config_file, option="workout_fields_keep", default=None)
+workout_fields_drop = config.read_config_option(config_file=config_file, option="workout_fields_drop", default=None)
+http_pool_size = config.read_config_option(config_file=config_file, option="http_pool_size", default=download_workers)
+http_retries = config.read_config_option(config_file=config_file, option="http_retries", default=3)
+http_timeout = config.read_config_option(config_file=config_file, option="http_timeout", default=60)
+fetch_streams = config.read_config_option(config_file=config_file, option="fetch_streams", default=False)
+extract_while_downloading = config.read_config_option(config_file=config_file, option="extract_while_downloading", default=True)
+strava_url = config.read_config_option(config_file=config_file, option="strava_url", default="https://www.strava.com")
+sync_mode = config.read_config_option(config_file=config_file, option="sync_mode", default="detail")
+detail_types = config.read_config_option(config_file=config_file, option="detail_types", default=None)
+metrics_file = config.read_config_option(config_file=config_file, option="metrics_file", default=f"{settings_dir}/metrics.json")
+prometheus_textfile = config.read_config_option(config_file=config_file, option="prometheus_textfile", default=None)
+webhook_host = config.read_config_option(config_file=config_file, option="webhook_host", default="0.0.0.0")
+webhook_port = config.read_config_option(config_file=config_file, option="webhook_port", default=8080)
+webhook_path = config.read_config_option(config_file=config_file, option="webhook_path", default="/webhook")
+webhook_verify_token = config.read_config_option(config_file=config_file, option="webhook_verify_token", default=None)
+track_formats = config.read_config_option(config_file=config_file, option="track_formats", default=[])
+track_collections = config.read_config_option(config_file=config_file, option="track_collections", default=[])
+simplify_method = config.read_config_option(config_file=config_file, option="simplify_method", default=None)
+simplify_tolerance = config.read_config_option(config_file=config_file, option="simplify_tolerance", default=5)
+coordinate_precision = config.read_config_option(config_file=config_file, option="coordinate_precision", default=None)
+drop_duplicate_points = config.read_config_option(config_file=config_file, option="drop_duplicate_points", default=False)
+build_spatial_index = config.read_config_option(config_file=config_file, option="spatial_index", default=True)
 # =============================================================================
 
+# Metrics are written on exit, so runs cut short by the ratelimit get theirs too
+if metrics_file:
+  atexit.register(metrics.write_json, metrics_file)
+if prometheus_textfile:
+  atexit.register(metrics.write_prometheus, prometheus_textfile)
+
+# All requests to strava go through the same pool of connections
+http_client = HttpClient(pool_size=http_pool_size, retries=http_retries, timeout=http_timeout, metrics=metrics)
+strava_workouts = StravaWorkouts(http_client=http_client, base_url=strava_url)
+strava_oauth = StravaOauth(http_client=http_client, base_url=strava_url)
+
+# Workouts storage management =================================================
+if args.pack_workouts or args.export_workouts:
+  workout_archive = WorkoutArchive(workdir=workouts_dir)
+  if args.pack_workouts:
+    print(f"\033[92m📦 Packed {workout_archive.import_files(src_dir=workouts_dir)} workouts into \033[37m\"{workout_archive.archive_dir}\"\033[0m")
+  if args.export_workouts:
+    print(f"\033[92m📤 Exported {workout_archive.export_files(dest_dir=args.export_workouts)} workouts to \033[37m\"{args.export_workouts}\"\033[0m")
+  workout_archive.close()
+  sys.exit(0)
+
 # Activities DB file management ===============================================
-if not os.path.exists(workout_db_file):
-  downloaded_workouts_db = {}
-  with open(workout_db_file, mode="w", encoding="utf8") as f:
-    f.write(json.dumps(downloaded_workouts_db))
-else:
-  downloaded_workouts_db = config.read_downloaded_workouts(db_file=workout_db_file)
+# Older versions kept these on JSON files. Import them, if found
+state_store = StateStore(db_file=state_db_file, metrics=metrics)
+state_store.migrate(workout_db_file=workout_db_file, sync_state_file=sync_state_file)
+# =============================================================================
+
+# Artifact manifest management ================================================
+if args.reconcile:
+  artifact_manifest = ArtifactManifest(db_file=state_db_file, metrics=metrics)
+  #! - Make "Archive" hardcode a config parameter
+  found = artifact_manifest.reconcile(paths=[tracks_dir, f"{tracks_dir}/Archive"])
+  #! --------------------------------------------
+  print(f"\033[94mℹ️  Found {found} extracted track{'s' if found != 1 else ''} on \033[37m\"{tracks_dir}\"\033[0m")
+  artifact_manifest.close()
+  state_store.close()
+  sys.exit(0)
+# =============================================================================
+
+# Spatial queries =============================================================
+if args.find_tracks:
+  try:
+    area = [float(x) for x in args.find_tracks.split(",")]
+  except ValueError:
+    area = []
+  if len(area) not in (3, 4) or (len(area) == 3 and args.within):
+    print("\033[91m❌ Areas are either \"south,west,north,east\", or \"latitude,longitude,radius in metres\". Only the former works with \"--within\"\033[0m")
+    sys.exit(1)
+  track_index = SpatialIndex(db_file=state_db_file)
+  artifact_manifest = ArtifactManifest(db_file=state_db_file)
+  query_started = time.perf_counter()
+  if len(area) == 4:
+    found = track_index.search(*area, within=args.within)
+  else:
+    found = [x[0] for x in track_index.near(*area)]
+  # Tracks forgotten since being indexed are no longer there
+  found = [(x, artifact_manifest.get(x)) for x in found]
+  found = [(x, artifact["path"]) for x, artifact in found if artifact is not None]
+  query_ms = (time.perf_counter() - query_started) * 1000
+  if track_index.count() == 0:
+    print("\033[93m⚠️  No tracks indexed yet. Tracks get indexed as they're extracted, unless \"spatial_index\" is off\033[0m", file=sys.stderr)
+  print(f"\033[94mℹ️  Found {len(found)} track{'s' if len(found) != 1 else ''} out of {track_index.count()} indexed, in {query_ms:.1f} ms\033[0m", file=sys.stderr)
+  for workout_id, path in found:
+    print(f"{workout_id}\t{path}")
+  track_index.close()
+  artifact_manifest.close()
+  state_store.close()
+  sys.exit(0)
 # =============================================================================
 
 # Secrets file management =====================================================
-strava_access_token, strava_refresh_token = "", ""
+strava_access_token, strava_refresh_token, strava_token_expires_at = "", "", 0
 if not os.path.exists(secrets_file):
   # There's no secrets file. Ask user for client ID & Secret
   strava_client_id, strava_client_secret = strava_oauth.ask_for_secrets()
@@ -72,31 +210,35 @@ else:
   strava_access_token, \
   strava_refresh_token, \
   strava_client_id, \
-  strava_client_secret = config.read_secrets_file(secrets_file)
+  strava_client_secret, \
+  strava_token_expires_at = config.read_secrets_file(secrets_file)
 
 if strava_access_token == "":
   # No access token present. Let's retrieve them
   strava_access_token, \
-  strava_refresh_token = strava_oauth.do_oauth_flow(client_id=strava_client_id, \
-                                                    client_secret=strava_client_secret)
-else:
-  if not strava_oauth.check_access_token(access_token=strava_access_token):
-    # Refresh invalid access_token, so we don't bother user
-    strava_access_token = strava_oauth.refresh_access_token(client_id=strava_client_id, \
-                                              client_secret=strava_client_secret, \
-                                              refresh_token=strava_refresh_token)
+  strava_refresh_token, \
+  strava_token_expires_at = strava_oauth.do_oauth_flow(client_id=strava_client_id, \
+                                                       client_secret=strava_client_secret)
+  if strava_access_token != "":
+    config.write_secrets_file(secrets_file=secrets_file, \
+                            strava_client_id=strava_client_id, \
+                            strava_client_secret=strava_client_secret, \
+                            strava_access_token=strava_access_token, \
+                            strava_refresh_token=strava_refresh_token, \
+                            strava_token_expires_at=strava_token_expires_at)
+
+if strava_access_token != "":
+  # From here on, every request to strava's API is signed with a fresh access token, refreshed whenever it's about to expire or gets rejected.
+  # Tokens still far from expiring are used as they are, without checking them with strava first
+  token_manager = TokenManager(strava_oauth=strava_oauth, secrets_file=secrets_file)
+  http_client.authenticate(token_manager)
+  strava_access_token = token_manager.access_token()
 
 if strava_access_token == "":
   # If at this point we still have no access token, we've failed and can't do anything about it,
   # so we exit with error
   print("\033[91m❌ Unable to retrieve tokens. Check provided strava's \"Client ID\" & \"Secret\", then try again\033[0m")
   sys.exit(1)
-else:
-  config.write_secrets_file(secrets_file=secrets_file, \
-                          strava_client_id=strava_client_id, \
-                          strava_client_secret=strava_client_secret, \
-                          strava_access_token=strava_access_token, \
-                          strava_refresh_token=strava_refresh_token)
 
 print("\033[92m🔐 Authentication successful!\n\033[0m")
 # =============================================================================
@@ -107,15 +249,205 @@ print("\033[92m🔐 Authentication successful!\n\033[0m")
 # Main program flow ===========================================================
 # =============================================================================
 
-# Get full workouts' list to download
-workout_list = strava_workouts.get_workout_list(access_token=strava_access_token)
+# All requests draw from the same ratelimit budget. In coordinated mode, so do other exporters' ones
+quota_ledger, work_queue = None, None
+if args.coordinated:
+  os.makedirs(args.coordinated, exist_ok=True)
+  quota_ledger = QuotaLedger(db_file=f"{args.coordinated}/coordination.db")
+  work_queue = WorkQueue(db_file=f"{args.coordinated}/coordination.db")
+  print(f"\033[94mℹ️  Coordinating with other exporters through \033[37m\"{args.coordinated}\"\033[0m")
+elif args.quota_ledger:
+  quota_ledger = QuotaLedger(db_file=args.quota_ledger)
+rate_limiter = RateLimiter(ledger=quota_ledger, metrics=metrics)
+# Requests sent again with a refreshed token count as requests of their own
+token_manager.meter(rate_limiter)
+
+# Formats to export tracks in, besides gpx
+track_exports = TrackExports(tracks_dir, formats=track_formats, collections=track_collections) if track_formats or track_collections else None
+export_kinds = track_exports.kinds() if track_exports is not None else []
+# Tracks already extracted get indexed on the next extraction pass, same as they get new exports, so a run that turns it on can't stop early
+if build_spatial_index:
+  export_kinds.append("spatial_index")
+# Geometry stage tracks go through before being written. Skipped altogether unless asked for
+track_simplifier = None
+if simplify_method or coordinate_precision is not None or drop_duplicate_points:
+  track_simplifier = TrackSimplifier(method=simplify_method, tolerance=simplify_tolerance, precision=coordinate_precision, drop_duplicates=drop_duplicate_points)
+
+sync_state = state_store.read_sync_state()
+full_sync = args.full_sync \
+            or sync_state["newest_start_date"] is None \
+            or sync_state["last_full_sync"] is None \
+            or time.time() - sync_state["last_full_sync"] >= full_sync_interval_days * 86400
+
+# Nothing new since a run which left nothing behind means there's nothing to do. A single request tells.
+# Other exporters may have queued work for this one in coordinated mode, so it always checks the queue.
+# Newly asked for exports of already extracted tracks are pending work too
+if not full_sync and sync_state["settled"] and sync_state["exports"] == export_kinds and not args.coordinated and not args.webhook:
+  with metrics.phase("probe"):
+    has_new_workouts = strava_workouts.has_new_workouts(access_token=strava_access_token, rate_limiter=rate_limiter, after=sync_state["newest_start_date"])
+  if has_new_workouts is False:
+    print("\033[92m✅ Nothing new on strava since the last run\033[0m")
+    if quota_ledger is not None:
+      quota_ledger.close()
+    state_store.close()
+    http_client.close()
+    sys.exit(0)
+  if has_new_workouts is None:
+    print("\033[91m❌ Strava rejected the access token, and it couldn't be refreshed. Check provided strava's \"Client ID\" & \"Secret\", then try again\033[0m")
+    sys.exit(1)
+
+# Workouts storage management =================================================
+workout_projection = None
+if workout_fields_keep or workout_fields_drop:
+  workout_projection = FieldProjection(keep=workout_fields_keep, drop=workout_fields_drop)
+
+if workouts_storage == "archive":
+  workout_storage = WorkoutArchive(workdir=workouts_dir, projection=workout_projection)
+else:
+  workout_storage = WorkoutFiles(workdir=workouts_dir, projection=workout_projection, serialization=workout_format)
+# =============================================================================
+
+# Older versions told extracted tracks apart by their file names. Build the manifest from them, if it's empty
+artifact_manifest = ArtifactManifest(db_file=state_db_file, metrics=metrics)
+if artifact_manifest.count() == 0:
+  #! - Make "Archive" hardcode a config parameter
+  found = artifact_manifest.reconcile(paths=[tracks_dir, f"{tracks_dir}/Archive"])
+  #! --------------------------------------------
+  if found > 0:
+    print(f"\033[94mℹ️  Found {found} extracted track{'s' if found != 1 else ''} on \033[37m\"{tracks_dir}\"\033[0m")
+track_index = SpatialIndex(db_file=state_db_file, metrics=metrics) if build_spatial_index else None
+
+# Webhook mode ================================================================
+if args.webhook:
+  # Push subscriptions are per app, so only this athlete's events are synced
+  athlete_id = strava_oauth.get_athlete(access_token=strava_access_token).get("id")
+  if athlete_id is None:
+    print("\033[91m❌ Unable to retrieve the athlete's ID from strava. Try again later\033[0m")
+    sys.exit(1)
+  event_queue = EventQueue(db_file=state_db_file)
+  webhook_worker = WebhookWorker(strava_workouts, event_queue, storage=workout_storage, state_store=state_store, manifest=artifact_manifest, tracks_dir=tracks_dir,
+                                 access_token=strava_access_token, rate_limiter=rate_limiter, gpx_writer=gpx_writer, metrics=metrics,
+                                 exports=track_exports, simplifier=track_simplifier, spatial_index=track_index)
+  webhook_receiver = WebhookReceiver(event_queue, host=webhook_host, port=webhook_port, path=webhook_path, verify_token=webhook_verify_token,
+                                     athlete_id=athlete_id, on_event=webhook_worker.notify)
+  print(f"\033[94mℹ️  Listening for strava's push events on \033[37m{webhook_receiver.start()}\033[94m. Press ^C to stop\033[0m", flush=True)
+  deauthorized = False
+  try:
+    deauthorized = webhook_worker.run()
+  except KeyboardInterrupt:
+    print("\n\033[94mℹ️  Stopped\033[0m")
+  finally:
+    webhook_receiver.stop()
+    event_queue.close()
+    if quota_ledger is not None:
+      quota_ledger.close()
+    state_store.close()
+    artifact_manifest.close()
+    if track_index is not None:
+      track_index.close()
+    workout_storage.close()
+    http_client.close()
+  if deauthorized:
+    # Tokens were revoked along with the app's access. Keep the app's credentials, so the next run starts the oauth flow right away
+    config.write_secrets_file(secrets_file=secrets_file, strava_client_id=strava_client_id, strava_client_secret=strava_client_secret)
+  sys.exit(0)
+# =============================================================================
+
+# Get workouts' list to download. Only what's new since the last run, unless a full sync is due.
+# Full syncs are what tell us about workouts deleted from strava
+if not full_sync:
+  print("\033[94mℹ️  Looking for new activities only. Run with \"--full-sync\" to check the whole history\033[0m")
+with metrics.phase("listing"):
+  listing_started = time.time()
+  workout_summaries = strava_workouts.get_workout_summaries(access_token=strava_access_token,
+                                                            rate_limiter=rate_limiter,
+                                                            after=None if full_sync else sync_state["newest_start_date"])
+  # Workouts edited on strava since last seen are synced again, along with their tracks
+  strava_workouts.detect_changes(summaries=workout_summaries, state_store=state_store, manifest=artifact_manifest, tracks_dir=tracks_dir)
+
+  if sync_mode == "summary":
+    # Store summaries as they are. Details are only downloaded for the types asked for, if any
+    strava_workouts.store_summaries(summaries=workout_summaries, storage=workout_storage, state_store=state_store)
+    workout_list = state_store.summarized(workout_types=detail_types) if detail_types else {}
+  else:
+    workout_list = {x["id"]: x["name"] for x in workout_summaries}
+
+# Listing isn't capped, so it's never left half done. Only what's downloaded after it is
+if args.max_requests is not None:
+  rate_limiter.cap(args.max_requests)
+
+# Tracks of summarized workouts get extracted again once their details are in
+upgraded = [x for x in workout_list if state_store.is_summarized(x)]
+
+# Extract tracks as workouts come in, instead of reading them back once all are downloaded.
+# Not worth it when fetching streams, since tracks get built from those afterwards
+track_pipeline = None
+if extract_while_downloading and not fetch_streams:
+  track_pipeline = TrackPipeline(strava_workouts, tracks_dir, manifest=artifact_manifest, gpx_writer=gpx_writer, workers=extract_workers, metrics=metrics,
+                                 exports=track_exports, simplifier=track_simplifier, spatial_index=track_index)
+  track_pipeline.start()
 
 # Download all workouts
-strava_workouts.download_all_workouts(workdir=workouts_dir, \
-                              workout_list=workout_list, \
-                              access_token=strava_access_token, \
-                              downloaded_workouts_db=downloaded_workouts_db, \
-                              workout_db_file=workout_db_file)
+with metrics.phase("download"):
+  downloaded = strava_workouts.download_all_workouts(workdir=workouts_dir, \
+                                workout_list=workout_list, \
+                                access_token=strava_access_token, \
+                                state_store=state_store, \
+                                workers=download_workers, \
+                                rate_limiter=rate_limiter, \
+                                full_listing=full_sync and sync_mode != "summary", \
+                                storage=workout_storage, \
+                                work_queue=work_queue, \
+                                pipeline=track_pipeline)
+  if track_pipeline is not None:
+    track_pipeline.close()
+  for key in upgraded:
+    if state_store.is_downloaded(key) and not (track_pipeline is not None and track_pipeline.extracted(key)):
+      artifact_manifest.forget(key, kind="gpx")
+
+# Download streams, for full-fidelity tracks. These draw from the same ratelimit budget
+stream_store, streamed = None, True
+if fetch_streams:
+  stream_store = StreamStore(workdir=workouts_dir)
+  with metrics.phase("streams"):
+    streamed = strava_workouts.download_all_streams(stream_store=stream_store,
+                                         workout_list=workout_storage.index(),
+                                         access_token=strava_access_token,
+                                         workers=download_workers,
+                                         rate_limiter=rate_limiter)
+
+if args.coordinated:
+  work_queue.close()
+if quota_ledger is not None:
+  quota_ledger.close()
+
+with metrics.phase("state"):
+  # Move the high-water mark up to the newest workout we've got everything before
+  sync_state["newest_start_date"] = strava_workouts.get_high_water_mark(summaries=workout_summaries,
+                                                                        state_store=state_store,
+                                                                        high_water_mark=None if full_sync else sync_state["newest_start_date"])
+  if full_sync:
+    sync_state["last_full_sync"] = int(listing_started)
+  # Until extraction is done, the next run can't skip it
+  sync_state["settled"] = False
+  state_store.write_sync_state(sync_state)
 
 # Extract tracks and convert them to gpx
-strava_workouts.extract_all_tracks(workouts_dir=workouts_dir, tracks_dir=tracks_dir)
+with metrics.phase("extraction"):
+  strava_workouts.extract_all_tracks(workouts_dir=workouts_dir, tracks_dir=tracks_dir, storage=workout_storage, workers=extract_workers, gpx_writer=gpx_writer,
+                                     manifest=artifact_manifest, stream_store=stream_store, metrics=metrics, exports=track_exports,
+                                     simplifier=track_simplifier, spatial_index=track_index)
+
+# Runs that got everything let the next one stop early if there's nothing new. Failed downloads are listed again anyway, being past the high-water mark
+pending_details = sync_mode == "summary" and detail_types and state_store.summarized(workout_types=detail_types)
+state_store.write_sync_state({"settled": bool(downloaded and streamed and not rate_limiter.cap_reached() and not pending_details), "exports": export_kinds})
+state_store.close()
+artifact_manifest.close()
+if track_index is not None:
+  track_index.close()
+workout_storage.close()
+http_client.close()
+
+# Let whoever capped this run know there's more left to download
+if rate_limiter.cap_reached():
+  sys.exit(AthleteDaemon.INCOMPLETE_EXIT_CODE)
@@ -0,0 +1,214 @@
+"""
+Spatial index module, containing the R-tree index of where every extracted track goes.
+"""
+import math
+from state_store import Database
+
+# Bounds only need to be worked out.
+# pylint: disable=too-few-public-methods
+class TrackBounds:
+  """
+  #### Description
+  This class works out the bounding boxes of a track's stretches, for them to be indexed.
+  #### Available functions
+  - `stretches(buffer) -> list`: returns the bounding box of each stretch of a track
+  #### Notes
+  Meant to be run on worker processes, along with the writers, so it only reads the coordinates already decoded.
+  """
+  STRETCH_SIZE = 64
+
+  def __init__(self, stretch_size: int = STRETCH_SIZE):
+    """
+    #### Parameters
+    - `stretch_size`: how many points each stretch spans. Smaller ones make proximity searches finer, at the expense of a larger index
+    """
+    self.stretch_size = max(int(stretch_size), 1)
+
+  def stretches(self, buffer) -> list:
+    """
+    #### Description
+    Splits a track in stretches, and returns the bounding box of each
+    #### Parameters
+    - `buffer`: the track's flat coordinate buffer, either an `array('d')` or a `memoryview` of one
+    #### Returns
+    A list with a `(min_lat, max_lat, min_lon, max_lon)` tuple for each stretch. Consecutive stretches share their end point,
+    so the line between them is covered too. Points missing their coordinates are left out
+    """
+    view = memoryview(buffer)
+    lats, lons = view[0::2], view[1::2]
+    result = []
+    for start in range(0, max(len(lats) - 1, 1), self.stretch_size):
+      stretch_lats = [x for x in lats[start:start + self.stretch_size + 1] if not math.isnan(x)]
+      stretch_lons = [x for x in lons[start:start + self.stretch_size + 1] if not math.isnan(x)]
+      if stretch_lats and stretch_lons:
+        result.append((min(stretch_lats), max(stretch_lats), min(stretch_lons), max(stretch_lons)))
+    return result
+
+class SpatialIndex(Database):
+  """
+  #### Description
+  This class keeps where every extracted track goes on SQLite R-trees, so finding the workouts that pass through an area, or near a place,
+  takes a lookup instead of decoding every polyline.
+  Each track is indexed by its bounding box, plus those of its stretches, so tracks merely going around an area aren't mistaken for passing through it.
+  #### Available functions
+  - `close()`: commits any pending writes and closes the database
+  - `commit()`: commits any pending writes to disk
+  - `count() -> int`: returns how many tracks are indexed
+  - `forget(workout_id: int)`: removes a track from the index
+  - `has(workout_id: int) -> bool`: checks whether a track is indexed
+  - `near(latitude: float, longitude: float, radius: float) -> list`: finds the tracks passing within a distance of a place
+  - `record(workout_id: int, stretches: list)`: indexes a track, replacing whatever was indexed for it. Committed on the next batch
+  - `search(south: float, west: float, north: float, east: float, within: bool = False) -> list`: finds the tracks passing through an area
+  #### Notes
+  Shares the state database with `StateStore`, on tables of its own. Safe to be used from several threads at once.
+  Tracks without points are recorded as indexed, so they aren't extracted again, but never found. Areas crossing the antimeridian aren't supported.
+  """
+  METRES_PER_DEGREE = math.pi / 180 * 6371008.8
+
+  def __init__(self, db_file: str, batch_size: int = 50, metrics = None):
+    """
+    #### Parameters
+    - `db_file`: full path to the database file. Created if missing
+    - `batch_size`: how many tracks to buffer before committing them to disk
+    - `metrics`: a `Metrics` to record how long writes take on. Optional
+    """
+    super().__init__(db_file=db_file, batch_size=batch_size, metrics=metrics)
+    self._db.execute("CREATE TABLE IF NOT EXISTS indexed_tracks (workout_id INTEGER PRIMARY KEY, first_stretch INTEGER, stretches INTEGER NOT NULL)")
+    self._db.execute("CREATE VIRTUAL TABLE IF NOT EXISTS track_bounds USING rtree(workout_id, min_lat, max_lat, min_lon, max_lon)")
+    self._db.execute("CREATE VIRTUAL TABLE IF NOT EXISTS track_stretches USING rtree(id, min_lat, max_lat, min_lon, max_lon, +workout_id INTEGER)")
+    self._indexed = {x[0] for x in self._db.execute("SELECT workout_id FROM indexed_tracks")}
+
+  def has(self, workout_id: int) -> bool:
+    """
+    #### Description
+    Checks whether a track is indexed, without touching the database
+    #### Parameters
+    - `workout_id`: the workout's ID
+    #### Returns
+    `True` if indexed, `False` otherwise
+    """
+    with self._lock:
+      return int(workout_id) in self._indexed
+
+  def count(self) -> int:
+    """
+    #### Description
+    Returns how many tracks are indexed
+    #### Returns
+    The amount of indexed tracks, including those without points
+    """
+    with self._lock:
+      return len(self._indexed)
+
+  def record(self, workout_id: int, stretches: list):
+    """
+    #### Description
+    Indexes a track, replacing whatever was indexed for it. It'll be written to disk along with the rest of its batch
+    #### Parameters
+    - `workout_id`: the workout's ID
+    - `stretches`: the bounding boxes of the track's stretches, as returned by `TrackBounds.stretches`
+    """
+    with self._lock:
+      self._indexed.add(int(workout_id))
+      self._pending.append((int(workout_id), stretches))
+      if len(self._pending) >= self._batch_size:
+        self.commit()
+
+  def forget(self, workout_id: int):
+    """
+    #### Description
+    Removes a track from the index, so it'll be indexed again once extracted
+    #### Parameters
+    - `workout_id`: the workout's ID
+    """
+    with self._lock:
+      self.commit()
+      with self._transaction():
+        SpatialIndex._delete(self, int(workout_id))
+      self._indexed.discard(int(workout_id))
+
+  def search(self, south: float, west: float, north: float, east: float, within: bool = False) -> list:
+    """
+    #### Description
+    Finds the tracks passing through an area
+    #### Parameters
+    - `south`, `west`, `north`, `east`: the area's bounds, in degrees
+    - `within`: whether to only find tracks lying entirely within the area
+    #### Returns
+    A sorted list with the IDs of the workouts found
+    """
+    area = (south, north, west, east)
+    with self._lock:
+      self.commit()
+      rows = self._db.execute("SELECT workout_id, min_lat >= ? AND max_lat <= ? AND min_lon >= ? AND max_lon <= ? FROM track_bounds " \
+                              "WHERE max_lat >= ? AND min_lat <= ? AND max_lon >= ? AND min_lon <= ?", area + area).fetchall()
+      found = {x[0] for x in rows if x[1]}
+      # Tracks lying within the area pass through it for sure. Only those straddling its edges need their stretches checked, which are looked up by ID
+      for workout_id in [x[0] for x in rows if not x[1] and not within]:
+        if self._db.execute("SELECT 1 FROM indexed_tracks JOIN track_stretches ON id >= first_stretch AND id < first_stretch + stretches " \
+                            "WHERE indexed_tracks.workout_id = ? AND max_lat >= ? AND min_lat <= ? AND max_lon >= ? AND min_lon <= ? LIMIT 1",
+                            (workout_id, *area)).fetchone():
+          found.add(workout_id)
+      return sorted(found)
+
+  def near(self, latitude: float, longitude: float, radius: float) -> list:
+    """
+    #### Description
+    Finds the tracks passing within a distance of a place
+    #### Parameters
+    - `latitude`, `longitude`: where the place is, in degrees
+    - `radius`: how far from the place tracks may pass, in metres
+    #### Returns
+    A list with a `(workout ID, distance)` tuple for each track found, nearest first. Distances are in metres
+    #### Notes
+    Distances are measured to each stretch's bounding box, so tracks may be found up to a stretch's width further than `radius`.
+    """
+    scale = SpatialIndex.METRES_PER_DEGREE
+    # Degrees of longitude shrink towards the poles
+    shrink = max(math.cos(math.radians(latitude)), 1e-6)
+    lat_span, lon_span = radius / scale, radius / (scale * shrink)
+    with self._lock:
+      self.commit()
+      rows = self._db.execute("SELECT workout_id, min_lat, max_lat, min_lon, max_lon FROM track_stretches " \
+                              "WHERE max_lat >= ? AND min_lat <= ? AND max_lon >= ? AND min_lon <= ?",
+                              (latitude - lat_span, latitude + lat_span, longitude - lon_span, longitude + lon_span)).fetchall()
+    nearest = {}
+    for workout_id, *bounds in rows:
+      # Distance to the nearest point of the stretch's box
+      distance = math.hypot(max(bounds[0] - latitude, 0.0, latitude - bounds[1]) * scale, max(bounds[2] - longitude, 0.0, longitude - bounds[3]) * scale * shrink)
+      if distance <= radius and distance < nearest.get(workout_id, math.inf):
+        nearest[workout_id] = distance
+    return sorted(nearest.items(), key=lambda x: (x[1], x[0]))
+
+  def commit(self):
+    """
+    #### Description
+    Commits any pending writes to disk, in a single transaction
+    """
+    with self._lock:
+      if not self._pending:
+        return
+      with self._transaction():
+        next_stretch = (self._db.execute("SELECT max(id) FROM track_stretches").fetchone()[0] or 0) + 1
+        for workout_id, stretches in self._pending:
+          SpatialIndex._delete(self, workout_id)
+          self._db.execute("INSERT INTO indexed_tracks VALUES (?, ?, ?)", (workout_id, next_stretch if stretches else None, len(stretches)))
+          if not stretches:
+            continue
+          self._db.execute("INSERT INTO track_bounds VALUES (?, ?, ?, ?, ?)",
+                           (workout_id, min(x[0] for x in stretches), max(x[1] for x in stretches),
+                            min(x[2] for x in stretches), max(x[3] for x in stretches)))
+          self._db.executemany("INSERT INTO track_stretches VALUES (?, ?, ?, ?, ?, ?)",
+                               [(next_stretch + index, *bounds, workout_id) for index, bounds in enumerate(stretches)])
+          next_stretch += len(stretches)
+      self._pending = []
+
+  def _delete(self, workout_id: int):
+    # Stretches are numbered consecutively for each track, so they're found by ID instead of scanning for their workout
+    row = self._db.execute("SELECT first_stretch, stretches FROM indexed_tracks WHERE workout_id = ?", (workout_id,)).fetchone()
+    if row is None:
+      return
+    if row[0] is not None:
+      self._db.executemany("DELETE FROM track_stretches WHERE id = ?", [(row[0] + x,) for x in range(row[1])])
+    self._db.execute("DELETE FROM track_bounds WHERE workout_id = ?", (workout_id,))
+    self._db.execute("DELETE FROM indexed_tracks WHERE workout_id = ?", (workout_id,))
@@ -0,0 +1,287 @@
+"""
+State store module, containing the sync state database, and the SQLite plumbing shared by every database kept on it.
+"""
+import json
+import os
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+
+class Database:
+  """
+  #### Description
+  Base class for the databases kept on SQLite. Opens the database, and provides atomic transactions and batched writes to the classes built on it.
+  #### Available functions
+  - `close()`: commits any pending writes and closes the database
+  - `commit()`: commits any pending writes to disk. Implemented by each database
+  """
+
+  def __init__(self, db_file: str, batch_size: int = 50, journal_mode: str = "WAL", metrics = None):
+    """
+    #### Parameters
+    - `db_file`: full path to the database file. Created if missing
+    - `batch_size`: how many writes to buffer before committing them to disk
+    - `journal_mode`: SQLite's journal mode. `WAL` needs shared memory, so databases on network filesystems must use `DELETE` instead
+    - `metrics`: a `Metrics` to record how long transactions take on. Optional
+    """
+    self._metrics = metrics
+    self._lock = threading.RLock()
+    self._batch_size = batch_size
+    self._pending = []
+    # Other processes may be holding the database for a while, so wait for them instead of failing
+    self._db = sqlite3.connect(db_file, timeout=60, check_same_thread=False, isolation_level=None)
+    self._db.execute(f"PRAGMA journal_mode={journal_mode}")
+    self._db.execute("PRAGMA synchronous=NORMAL")
+
+  def commit(self):
+    """
+    #### Description
+    Commits any pending writes to disk, in a single transaction
+    """
+    raise NotImplementedError
+
+  def close(self):
+    """
+    #### Description
+    Commits any pending writes and closes the database
+    """
+    with self._lock:
+      self.commit()
+      self._db.close()
+
+  @contextmanager
+  def _transaction(self):
+    # Wraps a block of statements in a single, atomic transaction
+    started = time.perf_counter()
+    self._db.execute("BEGIN IMMEDIATE")
+    try:
+      yield
+    except:
+      self._db.execute("ROLLBACK")
+      raise
+    self._db.execute("COMMIT")
+    if self._metrics is not None:
+      self._metrics.observe("db_transaction_seconds", time.perf_counter() - started, database=self.__class__.__name__)
+
+class StateStore(Database):
+  """
+  #### Description
+  This class keeps track of which workouts have already been downloaded, or stored from their summary only, plus any other sync state, on a SQLite database.
+  Writes are batched and atomic, so a crash can't leave a half-written state behind, and lookups don't touch the disk.
+  #### Available functions
+  - `close()`: commits any pending writes and closes the database
+  - `commit()`: commits any pending writes to disk
+  - `downloaded_ids() -> set`: returns the IDs of all already-downloaded workouts
+  - `fingerprint(workout_id: int) -> str`: returns a workout's last seen fingerprint
+  - `forget(workout_id: int)`: removes a workout from the downloaded and summarized workouts
+  - `is_downloaded(workout_id: int) -> bool`: checks whether a workout has already been downloaded
+  - `is_summarized(workout_id: int) -> bool`: checks whether a workout has been stored from its summary only
+  - `mark_downloaded(workout_id: int)`: flags a workout as downloaded. Committed on the next batch
+  - `mark_summarized(workout_id: int, workout_name: str, workout_type: str)`: flags a workout as stored from its summary only. Committed on the next batch
+  - `migrate(workout_db_file: str, sync_state_file: str)`: imports the JSON files used by previous versions, if found
+  - `read_sync_state() -> dict`: returns the sync state
+  - `summarized(workout_types: list = None) -> dict`: returns the workouts stored from their summary only, optionally of some types
+  - `write_fingerprints(fingerprints: dict)`: writes workouts' fingerprints
+  - `write_sync_state(sync_state: dict)`: writes the sync state
+  #### Notes
+  Safe to be used from several threads at once.
+  """
+
+  def __init__(self, db_file: str, batch_size: int = 50, metrics = None):
+    """
+    #### Parameters
+    - `db_file`: full path to the database file. Created if missing
+    - `batch_size`: how many downloaded workouts to buffer before committing them to disk
+    - `metrics`: a `Metrics` to record how long writes take on. Optional
+    """
+    super().__init__(db_file=db_file, batch_size=batch_size, metrics=metrics)
+    self._db.execute("CREATE TABLE IF NOT EXISTS downloaded_workouts (workout_id INTEGER PRIMARY KEY, downloaded_at INTEGER NOT NULL)")
+    self._db.execute("CREATE TABLE IF NOT EXISTS sync_state (key TEXT PRIMARY KEY, value TEXT)")
+    self._db.execute("CREATE TABLE IF NOT EXISTS summarized_workouts (workout_id INTEGER PRIMARY KEY, name TEXT, workout_type TEXT, summarized_at INTEGER NOT NULL)")
+    self._downloaded = {x[0] for x in self._db.execute("SELECT workout_id FROM downloaded_workouts")}
+    self._db.execute("CREATE TABLE IF NOT EXISTS fingerprints (workout_id INTEGER PRIMARY KEY, fingerprint TEXT NOT NULL)")
+    self._summarized = {x[0]: x[1:] for x in self._db.execute("SELECT workout_id, name, workout_type FROM summarized_workouts")}
+    self._fingerprints = dict(self._db.execute("SELECT workout_id, fingerprint FROM fingerprints"))
+    self._pending_summaries = []
+
+  def migrate(self, workout_db_file: str, sync_state_file: str):
+    """
+    #### Description
+    Imports the JSON files used by previous versions, if found, then renames them to `<file>.migrated`
+    #### Parameters
+    - `workout_db_file`: full path to the old downloaded workouts JSON file
+    - `sync_state_file`: full path to the old sync state JSON file
+    """
+    if os.path.exists(workout_db_file):
+      with open(workout_db_file, mode="r", encoding="utf8") as f:
+        workout_db = json.loads(f.read())
+      now = int(time.time())
+      with self._lock:
+        self.commit()
+        with self._transaction():
+          self._db.executemany("INSERT OR IGNORE INTO downloaded_workouts VALUES (?, ?)", [(int(x), now) for x in workout_db.keys()])
+        self._downloaded.update(int(x) for x in workout_db.keys())
+      os.replace(workout_db_file, f"{workout_db_file}.migrated")
+      print(f"\033[94mℹ️  Migrated {len(workout_db)} downloaded activities to the state database\033[0m")
+
+    if os.path.exists(sync_state_file):
+      with open(sync_state_file, mode="r", encoding="utf8") as f:
+        self.write_sync_state(json.loads(f.read()))
+      os.replace(sync_state_file, f"{sync_state_file}.migrated")
+
+  def is_downloaded(self, workout_id: int) -> bool:
+    """
+    #### Description
+    Checks whether a workout has already been downloaded
+    #### Parameters
+    - `workout_id`: the workout's ID
+    #### Returns
+    `True` if downloaded, `False` otherwise
+    """
+    with self._lock:
+      return int(workout_id) in self._downloaded
+
+  def is_summarized(self, workout_id: int) -> bool:
+    """
+    #### Description
+    Checks whether a workout has been stored from its summary only, and its details are yet to be downloaded
+    #### Parameters
+    - `workout_id`: the workout's ID
+    #### Returns
+    `True` if summarized, `False` otherwise
+    """
+    with self._lock:
+      return int(workout_id) in self._summarized
+
+  def summarized(self, workout_types: list = None) -> dict:
+    """
+    #### Description
+    Returns the workouts stored from their summary only
+    #### Parameters
+    - `workout_types`: if set, only workouts of these types are returned
+    #### Returns
+    A dict where its key is the workout ID and its value the workout's name
+    """
+    with self._lock:
+      return {k: v[0] for k, v in self._summarized.items() if workout_types is None or v[1] in workout_types}
+
+  def mark_summarized(self, workout_id: int, workout_name: str, workout_type: str):
+    """
+    #### Description
+    Flags a workout as stored from its summary only. It'll be written to disk along with the rest of its batch
+    #### Parameters
+    - `workout_id`: the workout's ID
+    - `workout_name`: the workout's name, so its details can be downloaded later on
+    - `workout_type`: the workout's sport type, such as `Run`
+    """
+    with self._lock:
+      self._summarized[int(workout_id)] = (workout_name, workout_type)
+      self._pending_summaries.append((int(workout_id), workout_name, workout_type, int(time.time())))
+      if len(self._pending_summaries) >= self._batch_size:
+        self.commit()
+
+  def downloaded_ids(self) -> set:
+    """
+    #### Description
+    Returns the IDs of all already-downloaded workouts
+    #### Returns
+    A `set(int)` of workout IDs
+    """
+    with self._lock:
+      return set(self._downloaded)
+
+  def mark_downloaded(self, workout_id: int):
+    """
+    #### Description
+    Flags a workout as downloaded, so it's no longer summarized. It'll be written to disk along with the rest of its batch
+    #### Parameters
+    - `workout_id`: the workout's ID
+    """
+    with self._lock:
+      self._downloaded.add(int(workout_id))
+      self._summarized.pop(int(workout_id), None)
+      self._pending.append((int(workout_id), int(time.time())))
+      if len(self._pending) >= self._batch_size:
+        self.commit()
+
+  def forget(self, workout_id: int):
+    """
+    #### Description
+    Removes a workout from the downloaded and summarized workouts, so it'll be downloaded again
+    #### Parameters
+    - `workout_id`: the workout's ID
+    """
+    with self._lock:
+      self.commit()
+      self._downloaded.discard(int(workout_id))
+      self._summarized.pop(int(workout_id), None)
+      with self._transaction():
+        self._db.execute("DELETE FROM downloaded_workouts WHERE workout_id = ?", (int(workout_id),))
+        self._db.execute("DELETE FROM summarized_workouts WHERE workout_id = ?", (int(workout_id),))
+
+  def commit(self):
+    """
+    #### Description
+    Commits any pending writes to disk, in a single transaction
+    """
+    with self._lock:
+      if not self._pending and not self._pending_summaries:
+        return
+      with self._transaction():
+        self._db.executemany("INSERT OR REPLACE INTO summarized_workouts VALUES (?, ?, ?, ?)", self._pending_summaries)
+        self._db.executemany("INSERT OR REPLACE INTO downloaded_workouts VALUES (?, ?)", self._pending)
+        self._db.executemany("DELETE FROM summarized_workouts WHERE workout_id = ?", [x[:1] for x in self._pending])
+      self._pending = []
+      self._pending_summaries = []
+
+  def fingerprint(self, workout_id: int) -> str:
+    """
+    #### Description
+    Returns a workout's last seen fingerprint
+    #### Parameters
+    - `workout_id`: the workout's ID
+    #### Returns
+    The fingerprint, or `None` if never seen
+    """
+    with self._lock:
+      return self._fingerprints.get(int(workout_id))
+
+  def write_fingerprints(self, fingerprints: dict):
+    """
+    #### Description
+    Writes workouts' fingerprints, replacing any previous ones. Unchanged ones aren't written again
+    #### Parameters
+    - `fingerprints`: a dict where its key is the workout ID and its value the workout's fingerprint
+    """
+    with self._lock:
+      changed = [(int(k), v) for k, v in fingerprints.items() if self._fingerprints.get(int(k)) != v]
+      if not changed:
+        return
+      with self._transaction():
+        self._db.executemany("INSERT OR REPLACE INTO fingerprints VALUES (?, ?)", changed)
+      self._fingerprints.update(changed)
+
+  def read_sync_state(self) -> dict:
+    """
+    #### Description
+    Returns the sync state
+    #### Returns
+    A dict containing `newest_start_date`, the high-water mark for incremental listings, and `last_full_sync`, both as unix timestamps,
+    plus any other key previously written. Both are `None` if not set yet. `settled` tells whether the last run left nothing behind to download or extract,
+    and `exports` lists the kinds of track exports it was settled with
+    """
+    sync_state = {"newest_start_date": None, "last_full_sync": None, "settled": False, "exports": []}
+    with self._lock:
+      sync_state.update({k: json.loads(v) for k, v in self._db.execute("SELECT key, value FROM sync_state")})
+    return sync_state
+
+  def write_sync_state(self, sync_state: dict):
+    """
+    #### Description
+    Writes the sync state
+    #### Parameters
+    - `sync_state`: a dict containing the keys to be written. Keys not present are left untouched
+    """
+    with self._lock, self._transaction():
+      self._db.executemany("INSERT OR REPLACE INTO sync_state VALUES (?, ?)", [(k, json.dumps(v)) for k, v in sync_state.items()])
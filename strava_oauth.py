@@ -4,9 +4,7 @@ This module contains all functions related to strava's oauth flow
 import os
 import getpass as g
 from urllib.parse import urlencode
-from http.server import BaseHTTPRequestHandler, HTTPServer
-from webbrowser import open_new_tab
-import requests
+from http_client import HttpClient
 class StravaOauth:
   """
   #### Description
@@ -14,29 +12,50 @@ class StravaOauth:
   #### Available functions.
   - `ask_for_secrets() -> list`: asks the user for both strava's client ID and secret
   - `check_access_token(access_token: str) -> bool`: checks if the provided strava access token is still valid
-  - `do_oauth_flow(client_id: str, client_secret: str)`: performs strava's oauth flow in order to get the required access tokens
-  - `refresh_access_token(client_id: str, client_secret: str, refresh_token: str) -> str`: gets a new access token using strava's oauth refresh token
+  - `do_oauth_flow(client_id: str, client_secret: str) -> tuple`: performs strava's oauth flow in order to get the required access tokens
+  - `get_athlete(access_token: str) -> dict`: retrieves the athlete the access token belongs to
+  - `refresh_access_token(client_id: str, client_secret: str, refresh_token: str) -> tuple`: gets a new access token using strava's oauth refresh token
+  #### Notes
+  Access tokens last six hours. Strava hands the same one back when refreshed with more than an hour left, so there's no point refreshing them any sooner.
   """
+  REFRESH_MARGIN = 3600
 
-  def do_oauth_flow(self, client_id: str, client_secret: str):
+  def __init__(self, http_client: HttpClient = None, base_url: str = "https://www.strava.com"):
+    """
+    #### Parameters
+    - `http_client`: HTTP session to send requests through. A new one is created if not provided
+    - `base_url`: where strava's oauth and API endpoints are served from. Only meant to be changed for testing against a mock server
+    """
+    self.http_client = http_client if http_client is not None else HttpClient()
+    self.base_url = base_url.rstrip('/')
+
+  def do_oauth_flow(self, client_id: str, client_secret: str) -> tuple:
     """
     #### Description
     Performs strava's oauth flow in order to get the required access tokens
     #### Parameters
     - `client_id`: client ID from strava's API config
     - `client_secret`: client secret from strava's API config
+    #### Returns
+    A `(access_token, refresh_token, expires_at)` tuple, `expires_at` being a unix timestamp. Tokens are empty strings if unsuccessful
     #### Notes
     Interactive function. It'll open a browser tab asking the used to authorize this app for read access
     """
+    # Only needed the first time around, so runs with tokens already in place don't pay for importing them
+    from http.server import BaseHTTPRequestHandler, HTTPServer # pylint: disable=import-outside-toplevel
+    from webbrowser import open_new_tab # pylint: disable=import-outside-toplevel
+
     with open(f"{os.path.dirname(os.path.realpath(__file__))}/oauth_success.htm", encoding="utf8") as file:
       html_code = bytes("".join(file.readlines()), "utf-8")
 
     # Step 1: Get Authorization Code
     redirect_uri = 'http://localhost:8000/'
-    auth_url = f'https://www.strava.com/oauth/authorize?{urlencode({"client_id": client_id, "redirect_uri": redirect_uri, "response_type": "code", "scope": "activity:read_all"})}'
+    auth_url = f'{self.base_url}/oauth/authorize?{urlencode({"client_id": client_id, "redirect_uri": redirect_uri, "response_type": "code", "scope": "activity:read_all"})}'
     print("\033[93m🟡 Please authorize this script to read from your Strava profile\033[0m")
     print("\033[93m   Ensure the app being authorized is actually yours on Strava's website\033[0m")
     open_new_tab(auth_url)
+    http_client = self.http_client
+    token_url = f'{self.base_url}/oauth/token'
 
     class RequestHandler(BaseHTTPRequestHandler):
       """
@@ -52,22 +71,23 @@ class StravaOauth:
         """
         code = self.path.split('code=')[1].split("&")[0]
         # Exchange Authorization Code for Access Token
-        token_url = 'https://www.strava.com/oauth/token'
         payload = {
           'client_id': client_id,
           'client_secret': client_secret,
           'code': code,
           'grant_type': 'authorization_code'
         }
-        response = requests.post(token_url, data=payload, timeout=60)
+        response = http_client.post(token_url, data=payload)
         if response.status_code != 200:
           self.server.access_token = ""
           self.server.refresh_token = ""
+          self.server.expires_at = 0
         else:
           # Store access_token as an instance variable,
           # so we can return it later from the do_auth_flow function
           self.server.access_token = response.json().get('access_token')
           self.server.refresh_token = response.json().get('refresh_token')
+          self.server.expires_at = int(response.json().get('expires_at') or 0)
 
         self.send_response(200)
         self.send_header('Content-type', 'text/html')
@@ -77,9 +97,9 @@ class StravaOauth:
     # Start the local server to handle the OAuth redirect
     server = HTTPServer(('localhost', 8000), RequestHandler)
     server.handle_request()
-    return server.access_token, server.refresh_token
+    return server.access_token, server.refresh_token, server.expires_at
 
-  def refresh_access_token(self, client_id: str, client_secret: str, refresh_token: str) -> str:
+  def refresh_access_token(self, client_id: str, client_secret: str, refresh_token: str) -> tuple:
     """
     #### Description
     This function gets a new access token using strava's oauth refresh token
@@ -88,9 +108,11 @@ class StravaOauth:
     - `client_secret`: client secret from strava's API config page
     - `refresh_token`: strava's refresh token
     #### Returns
-    A `valid strava's access token` if successful. Otherwise an `empty string`
+    A `(access_token, refresh_token, expires_at)` tuple if successful, `expires_at` being a unix timestamp. Otherwise `("", "", 0)`
+    #### Notes
+    Strava may hand a new refresh token back, in which case the old one stops working. Store the one returned.
     """
-    token_url = 'https://www.strava.com/oauth/token'
+    token_url = f'{self.base_url}/oauth/token'
     payload = {
       'client_id': client_id,
       'client_secret': client_secret,
@@ -98,13 +120,13 @@ class StravaOauth:
       'grant_type': 'refresh_token'
     }
 
-    response = requests.post(token_url, data=payload, timeout=60)
+    response = self.http_client.post(token_url, data=payload)
 
     if response.status_code == 200:
-      access_token = response.json().get('access_token')
-      return access_token
+      tokens = response.json()
+      return tokens.get('access_token'), tokens.get('refresh_token') or refresh_token, int(tokens.get('expires_at') or 0)
     print(f"Error refreshing access token: {response.status_code}, {response.text}")
-    return ""
+    return "", "", 0
 
   def check_access_token(self, access_token: str) -> bool:
     """
@@ -115,15 +137,29 @@ class StravaOauth:
     #### Returns
     `True` if valid, `False` otherwise
     """
-    check_url = 'https://www.strava.com/api/v3/athlete'
+    check_url = f'{self.base_url}/api/v3/athlete'
     headers = {'Authorization': f'Bearer {access_token}'}
 
-    response = requests.get(check_url, headers=headers, timeout=60)
+    response = self.http_client.get(check_url, headers=headers)
 
     if response.status_code == 200:
       return True
     return False
 
+  def get_athlete(self, access_token: str) -> dict:
+    """
+    #### Description
+    Retrieves the athlete the access token belongs to
+    #### Parameters
+    - `access_token`: strava's access token
+    #### Returns
+    A dict containing the athlete's data, such as its `id`. Empty if it couldn't be retrieved
+    """
+    response = self.http_client.get(f'{self.base_url}/api/v3/athlete', headers={'Authorization': f'Bearer {access_token}'})
+    if response.status_code == 200:
+      return response.json()
+    return {}
+
   def ask_for_secrets(self) -> list:
     """
     #### Description
@@ -2,14 +2,26 @@
 This module provides the strava_workouts class, meant to work with strava workouts.
 """
 import sys
-import json
+import time
 import os
-import gpxpy
-import gpxpy.gpx
-import polyline
+import hashlib
+import json
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from itertools import chain, islice, repeat
+from datetime import datetime, timezone
 import requests
 from helpers import Helpers as helpers
-from config import Config
+from state_store import StateStore
+from workout_storage import StreamStore, WorkoutFiles
+from rate_limiter import RateLimiter
+from gpx_writer import GpxWriter
+from polyline_decoder import PolylineDecoder
+from http_client import HttpClient
+from artifact_manifest import ArtifactManifest
+from coordination import WorkQueue
+from track_exports import TrackExports
+from track_simplifier import TrackSimplifier
+from spatial_index import SpatialIndex, TrackBounds
 
 class StravaWorkouts:
   """
@@ -17,44 +29,96 @@ class StravaWorkouts:
   This class provides methods and functions for downloading, converting and storing strava workouts and tracks
   #### Available functions.
   - `decode_polyline(pline: str)`: decodes a polyline and returns a list of coordinates
-  - `download_all_workouts(workdir: str, workout_list: dict, access_token: str) -> bool`: implements the get_workout function and downloads all workouts that are still unsaved on the workouts dir
+  - `detect_changes(summaries: list, state_store: StateStore, manifest = None, tracks_dir: str = None) -> dict`: finds already-stored workouts edited on strava since last seen, and flags them to be synced again
+  - `download_all_streams(stream_store, workout_list, access_token, workers, rate_limiter) -> bool`: downloads the streams of all workouts whose streams are still unsaved
+  - `download_all_workouts(workdir, workout_list, access_token, state_store, workers, rate_limiter, full_listing, storage, work_queue, pipeline) -> bool`: downloads all workouts that are still unsaved on the workouts dir
+  - `download_queued_workouts(storage, work_queue: WorkQueue, headers: dict, rate_limiter: RateLimiter, state_store: StateStore, pipeline) -> list`: claims workouts from a shared queue and downloads them until none are left
+  - `download_streams(stream_store, workout_id: int, workout_name: str, headers: dict, rate_limiter: RateLimiter) -> str`: downloads a single workout's streams and stores them
+  - `download_workout(storage, workout_id: int, workout_name: str, headers: dict, rate_limiter: RateLimiter, pipeline) -> str`: downloads a single workout and stores it
+  - `extract_all_tracks(workouts_dir, tracks_dir, storage, workers, gpx_writer, manifest, stream_store, metrics, exports, simplifier, spatial_index)`: extracts all tracks from downloaded workouts if not done already
+  - `extract_tracks(workout_polylines, output_files, gpx_writer, stream_store, workout_streams, exports, workout_properties, simplifier, bounds) -> list`: extracts a batch of tracks to gpx, and any other format asked for
   - `get_files(workdir: str) -> dict`: from a filename where the left part of its "-" represents the strava workout id, and the right part the workout name, returns a dict where its key is the workout id and its content the full filename
   - `get_workout(workout_id: str, access_token: str) -> dict`: retrieves a full workout from strava
-  - `get_workout_list(access_token: str) -> list`: gets strava's user workout index
-  - `write_gpx_from_polyline(coordinates, output_file: str)`: writes a gpx file to disc from a decoded polyline
+  - `get_fingerprint(summary: dict) -> str`: returns a workout's fingerprint, which changes whenever the workout is edited on strava
+  - `get_high_water_mark(summaries: list, state_store: StateStore, high_water_mark: int = None) -> int`: returns the newest start date up to which all listed workouts have been downloaded
+  - `get_workout_list(access_token: str, rate_limiter: RateLimiter = None) -> list`: gets strava's user workout index
+  - `get_workout_summaries(access_token: str, rate_limiter: RateLimiter = None, after: int = None, before: int = None) -> list`: gets strava's user workout summaries, optionally limited to a time window
+  - `has_new_workouts(access_token: str, rate_limiter: RateLimiter = None, after: int = None) -> bool`: checks, with a single request, whether any workout was started after a given time
+  - `print_download_plan(pending: int, rate_limiter: RateLimiter)`: lets the pacer know how much work is pending, then prints how long it's expected to take
+  - `record_extraction(track: tuple, result: tuple, manifest, metrics, exports, spatial_index) -> bool`: reports a track's extraction, and records it on the manifest if successful
+  - `store_summaries(summaries: list, storage, state_store: StateStore) -> int`: stores workouts straight from their summaries, without downloading their details
+  - `write_gpx_from_polyline(coordinates, output_file: str, streaming: bool = True)`: writes a gpx file to disc from a decoded polyline
   """
 
-  def get_workout_list(self, access_token: str) -> dict:
+  # Summary fields that change whenever a workout is edited on strava. Descriptions aren't part of summaries, so editing them alone goes unnoticed
+  FINGERPRINT_FIELDS = ["name", "type", "sport_type", "workout_type", "start_date", "elapsed_time", "moving_time", "distance", "total_elevation_gain",
+                        "upload_id", "gear_id", "commute", "trainer", "private", "visibility", "map.summary_polyline"]
+
+  def __init__(self, http_client: HttpClient = None, base_url: str = "https://www.strava.com"):
+    """
+    #### Parameters
+    - `http_client`: HTTP session to send requests through. A new one is created if not provided
+    - `base_url`: where strava's API is served from. Only meant to be changed for testing against a mock server
+    """
+    self.http_client = http_client if http_client is not None else HttpClient()
+    self.api_url = f"{base_url.rstrip('/')}/api/v3"
+
+  def get_workout_list(self, access_token: str, rate_limiter: RateLimiter = None) -> dict:
     """
     #### Description
     Gets strava's user workout index
     #### Parameters
     - `access_token`: strava's access token
+    - `rate_limiter`: ratelimit budget to draw from. Optional
     #### Returns
     An index of workouts
     """
+    summaries = StravaWorkouts.get_workout_summaries(self, access_token=access_token, rate_limiter=rate_limiter)
+    return {x["id"]: x["name"] for x in summaries}
+
+  def get_workout_summaries(self, access_token: str,
+                            rate_limiter: RateLimiter = None,
+                            after: int = None,
+                            before: int = None) -> list:
+    """
+    #### Description
+    Gets strava's user workout summaries, optionally limited to a time window
+    #### Parameters
+    - `access_token`: strava's access token
+    - `rate_limiter`: ratelimit budget to draw from. Optional
+    - `after`: only list workouts started after this unix timestamp. Optional
+    - `before`: only list workouts started before this unix timestamp. Optional
+    #### Returns
+    A list of summary activities, as returned by strava
+    """
+    if rate_limiter is None:
+      rate_limiter = RateLimiter()
     workout_index = []
     page_limit = 200
     headers = {'Authorization': f'Bearer {access_token}'}
     page_number = 1
     do_download = True
+    time_window = "".join(f"&{k}={int(v)}" for k, v in (("after", after), ("before", before)) if v is not None)
 
     while do_download:
-      activities_url = f'https://www.strava.com/api/v3/athlete/activities?page={page_number}&per_page={page_limit}'
-      response = requests.get(activities_url, headers=headers, timeout=60)
+      activities_url = f'{self.api_url}/athlete/activities?page={page_number}&per_page={page_limit}{time_window}'
+      if not rate_limiter.acquire(): # Hit daily ratelimit
+        print("\033[91m💥 Daily ratelimit reached!\n  \033[0m Wait until tomorrow and try again.")
+        sys.exit(1)
+      response = self.http_client.get(activities_url, headers=headers)
+      rate_limiter.release(response)
       status_code = response.status_code
 
       if status_code == 429:
-        _, lim_daily, _, u_daily = helpers.get_rate_limits(self, res=response)
+        rate_limiter.rate_limited(response)
+        continue
 
-        if u_daily >= lim_daily: # Hit daily ratelimit
-          print("\033[91m💥 Daily ratelimit reached!\n  \033[0m Wait until tomorrow and try again.")
-          sys.exit(1)
-        else:
-          helpers.wait_for_it(self=self)
-          continue
+      if status_code == 401:
+        # Only gets here if the access token couldn't be refreshed either
+        print("\033[91m❌ Strava rejected the access token while retrieving the activities' list. Aborting.\033[0m")
+        sys.exit(1)
 
-      elif status_code == 500:
+      if status_code == 500:
         if workout_index == []:
           print("\033[93m💥 Encountered an internal server error while retrieving the activities' list. Aborting, since no list was retrieved.\033[0m")
           sys.exit(1)
@@ -69,16 +133,135 @@ class StravaWorkouts:
         print(f"{'⏳' if page_number % 2 == 0 else '⌛️'} Getting strava's activities list {'...' if page_number % 2 == 0 else '.  '}", end="\r", flush=True)
         page_number += 1
 
-      for activity in activities:
-        workout_index.append([activity["id"], activity["name"]])
+      workout_index.extend(activities)
 
-    print(f"\n\033[94mℹ️  Got {len(workout_index)} activities. Retrieving them...\033[0m")
-    if len(workout_index) >= 2000:
-      print("\n\033[93m🚦 Since the activity count is greater than strava's daily ratelimit of 2000,\033[0m")
-      print("\033[93m🚦 you may have to run this script again tomorrow to finish.\n\033[0m")
+    print(f"\n\033[94mℹ️  Got {len(workout_index)} {'new ' if after is not None else ''}activities. Retrieving them...\033[0m")
 
-    result = {x[0]: x[1] for x in workout_index}
-    return result
+    return workout_index
+
+  def has_new_workouts(self, access_token: str, rate_limiter: RateLimiter = None, after: int = None) -> bool:
+    """
+    #### Description
+    Checks, with a single request, whether any workout was started after a given time, so runs with nothing new to sync can stop right away
+    #### Parameters
+    - `access_token`: strava's access token
+    - `rate_limiter`: ratelimit budget to draw from. Optional
+    - `after`: unix timestamp to check from. Optional
+    #### Returns
+    `True` if there's any, or if strava couldn't tell. `False` if there's none. `None` if the access token was rejected
+    """
+    if rate_limiter is None:
+      rate_limiter = RateLimiter()
+    time_window = f"&after={int(after)}" if after is not None else ""
+    if not rate_limiter.acquire():
+      return True
+    response = self.http_client.get(f'{self.api_url}/athlete/activities?page=1&per_page=1{time_window}', headers={'Authorization': f'Bearer {access_token}'})
+    rate_limiter.release(response)
+    if response.status_code == 401:
+      return None
+    if response.status_code != 200:
+      # Let the full listing deal with it
+      return True
+    return len(response.json()) > 0
+
+  def get_high_water_mark(self, summaries: list, state_store: StateStore, high_water_mark: int = None) -> int:
+    """
+    #### Description
+    Returns the newest start date up to which all listed workouts have been downloaded, or stored from their summaries
+    #### Parameters
+    - `summaries`: summary activities, as returned by `get_workout_summaries`
+    - `state_store`: sync state, holding the already downloaded workouts
+    - `high_water_mark`: the previous high-water mark, if any
+    #### Returns
+    A unix timestamp, or `None` if there's none yet
+    #### Notes
+    Workouts that failed to download hold the mark back, so the next incremental listing picks them up again.
+    """
+    for summary in sorted(summaries, key=lambda x: x["start_date"]):
+      start_date = int(datetime.strptime(summary["start_date"], "%Y-%m-%dT%H:%M:%SZ").replace(tzinfo=timezone.utc).timestamp())
+      if not state_store.is_downloaded(summary["id"]) and not state_store.is_summarized(summary["id"]):
+        if high_water_mark is not None and start_date <= high_water_mark:
+          high_water_mark = start_date - 1
+        break
+      high_water_mark = start_date if high_water_mark is None else max(high_water_mark, start_date)
+    return high_water_mark
+
+  def get_fingerprint(self, summary: dict) -> str:
+    """
+    #### Description
+    Returns a workout's fingerprint, which changes whenever the workout is edited on strava
+    #### Parameters
+    - `summary`: the workout's summary, as returned by `get_workout_summaries`
+    #### Returns
+    A hex digest of the summary fields listed on `FINGERPRINT_FIELDS`
+    """
+    values = []
+    for field in StravaWorkouts.FINGERPRINT_FIELDS:
+      value = summary
+      for key in field.split("."):
+        value = value.get(key) if isinstance(value, dict) else None
+      values.append(value)
+    return hashlib.sha256(json.dumps(values).encode("utf8")).hexdigest()[:16]
+
+  def detect_changes(self, summaries: list, state_store: StateStore, manifest: ArtifactManifest = None, tracks_dir: str = None) -> dict:
+    """
+    #### Description
+    Finds already-stored workouts that were edited on strava since last seen, and flags them to be synced again
+    #### Parameters
+    - `summaries`: summary activities, as returned by `get_workout_summaries`
+    - `state_store`: sync state, holding the already downloaded workouts and their fingerprints
+    - `manifest`: where extracted tracks are recorded. Optional. Tracks of changed workouts are dropped from it, so they're extracted again
+    - `tracks_dir`: folder where tracks are extracted to. Optional. Tracks of changed workouts still there are deleted, along with their exports, since they may be named after an old name
+    #### Returns
+    A dict where its key is the workout ID and its value the workout's name, holding the changed workouts
+    #### Notes
+    Changed workouts are forgotten by the state store, so they're downloaded again like new ones. Only their fingerprint is compared, so no requests are spent on unchanged ones.
+    Workouts seen for the first time, or stored by versions without fingerprints, just get theirs recorded.
+    """
+    fingerprints = {x["id"]: StravaWorkouts.get_fingerprint(self, summary=x) for x in summaries}
+    changed = {}
+    for summary in summaries:
+      previous = state_store.fingerprint(summary["id"])
+      stored = state_store.is_downloaded(summary["id"]) or state_store.is_summarized(summary["id"])
+      if stored and previous is not None and previous != fingerprints[summary["id"]]:
+        changed[summary["id"]] = summary["name"]
+
+    for key in changed:
+      print(f"🔄 Activity \033[1;90m{changed[key]}\033[0m changed on strava. Syncing it again")
+      state_store.forget(key)
+      if manifest is not None:
+        for kind in ["gpx", *TrackExports.FORMATS]:
+          artifact = manifest.get(key, kind=kind)
+          if artifact is not None and tracks_dir is not None and os.path.dirname(artifact["path"]) == tracks_dir and os.path.exists(artifact["path"]):
+            os.remove(artifact["path"])
+        manifest.forget(key)
+    state_store.write_fingerprints(fingerprints)
+    return changed
+
+  def store_summaries(self, summaries: list, storage, state_store: StateStore) -> int:
+    """
+    #### Description
+    Stores workouts straight from their summaries, without downloading their details
+    #### Parameters
+    - `summaries`: summary activities, as returned by `get_workout_summaries`
+    - `storage`: where to store workouts, either a `WorkoutFiles` or a `WorkoutArchive`
+    - `state_store`: sync state, where stored workouts are flagged as summarized
+    #### Returns
+    The amount of workouts stored
+    #### Notes
+    Summaries carry a simplified `map.summary_polyline` instead of the full `map.polyline`, which tracks are extracted from instead.
+    Workouts already downloaded or summarized are left untouched.
+    """
+    stored = 0
+    for summary in summaries:
+      if state_store.is_downloaded(summary["id"]) or state_store.is_summarized(summary["id"]):
+        continue
+      storage.save(summary["id"], summary["name"], summary)
+      state_store.mark_summarized(summary["id"], summary["name"], summary.get("sport_type") or summary.get("type"))
+      stored += 1
+    state_store.commit()
+    print(f"\033[92m✅ {stored} activit{'ies' if stored != 1 else 'y'} stored from {'their summaries' if stored != 1 else 'its summary'}\033[0m")
+    return stored
 
   def get_workout(self, workout_id: str, access_token: str) -> dict:
     """
@@ -90,10 +273,10 @@ class StravaWorkouts:
     #### Returns
     A dict containing the workout's data
     """
-    api_url = f"https://www.strava.com/api/v3/activities/{workout_id}"
+    api_url = f"{self.api_url}/activities/{workout_id}"
     headers = {'Authorization': f'Bearer {access_token}'}
 
-    response = requests.get(api_url, headers=headers, timeout=60)
+    response = self.http_client.get(api_url, headers=headers)
     if response.status_code == 200:
       workout_data = response.json()
       return workout_data
@@ -101,86 +284,345 @@ class StravaWorkouts:
 
   # This function is complex by nature.
   # No point on splitting it into smaller ones.
-  # pylint: disable=too-many-locals
+  # pylint: disable=too-many-locals, too-many-branches, too-many-statements
   def download_all_workouts(self, workdir: str,
                             workout_list: dict,
                             access_token: str,
-                            downloaded_workouts_db: dict,
-                            workout_db_file: str) -> bool:
+                            state_store: StateStore,
+                            *,
+                            workers: int = 1,
+                            rate_limiter: RateLimiter = None,
+                            full_listing: bool = True,
+                            storage = None,
+                            work_queue: WorkQueue = None,
+                            pipeline = None) -> bool:
     """
     #### Description
     Implements the get_workout function and downloads all workouts that are still unsaved on the workouts dir.
     #### Parameters
     - `access_token`: strava's access token
-    - `skipped`: already skipped workouts for the skipped count
+    - `state_store`: sync state, holding the already downloaded workouts
     - `workdir`: working directory where our workouts will be stored
     - `workout_list`: a list of workout IDs
+    - `workers`: how many workouts to download concurrently. All workers share a single ratelimit budget
+    - `rate_limiter`: ratelimit budget to draw from. Optional
+    - `full_listing`: whether `workout_list` holds the whole workout history, so workouts missing from it can be reported as deleted
+    - `storage`: where to store workouts, either a `WorkoutFiles` or a `WorkoutArchive`. Defaults to one file per workout on `workdir`
+    - `work_queue`: a queue shared with exporters running elsewhere. If set, workouts are added to it, then claimed from it, so each is downloaded by a single exporter
+    - `pipeline`: a started `TrackPipeline` to hand each downloaded workout over to, so its track is extracted right away. Optional
     #### Returns
     `True` if successful, `False` otherwise
     """
     headers = {'Authorization': f'Bearer {access_token}'}
-    downloaded = 0
+    if rate_limiter is None:
+      rate_limiter = RateLimiter()
+    if storage is None:
+      storage = WorkoutFiles(workdir)
 
     # Remove already-downloaded items from the workout list
     skipped = len(workout_list)
-    for key in downloaded_workouts_db.keys():
-      try:
-        workout_list.pop(int(key))
-      except:
-        print(f"\033[93m🟡 Skipped workout ID \"{key}\". Might have been deleted from strava after sync.\033[0m")
+    if full_listing:
+      for key in state_store.downloaded_ids():
+        try:
+          workout_list.pop(int(key))
+        except:
+          print(f"\033[93m🟡 Skipped workout ID \"{key}\". Might have been deleted from strava after sync.\033[0m")
+        skipped = skipped - len(workout_list)
+    else:
+      # An incremental listing only holds recent workouts, so the rest can't be told apart from deleted ones
+      for key in [x for x in workout_list.keys() if state_store.is_downloaded(x)]:
+        workout_list.pop(key)
       skipped = skipped - len(workout_list)
 
-    for key in workout_list.keys():
-      value = workout_list[key]
-      output_file = f'{workdir}/{key}-{helpers.sanitize_filename(self, filename=value)}.json'
+    if work_queue is not None:
+      work_queue.enqueue(workout_list)
+      pending = work_queue.counts()["pending"]
+      print(f"\033[94mℹ️  {pending} activit{'ies' if pending != 1 else 'y'} pending on the shared queue\033[0m")
+      StravaWorkouts.print_download_plan(self, pending=pending, rate_limiter=rate_limiter)
+    else:
+      StravaWorkouts.print_download_plan(self, pending=len(workout_list), rate_limiter=rate_limiter)
+
+    def download(key) -> str:
+      result = StravaWorkouts.download_workout(self, storage=storage,
+                                               workout_id=key,
+                                               workout_name=workout_list[key],
+                                               headers=headers,
+                                               rate_limiter=rate_limiter,
+                                               pipeline=pipeline)
+      if result == "downloaded":
+        state_store.mark_downloaded(key)
+      return result
+
+    def drain(_) -> list:
+      # Every worker keeps claiming workouts until the queue runs dry
+      return StravaWorkouts.download_queued_workouts(self, storage, work_queue, headers, rate_limiter, state_store, pipeline=pipeline)
+
+    pool = ThreadPoolExecutor(max_workers=max(int(workers), 1))
+    try:
+      if work_queue is not None:
+        results = list(chain.from_iterable(pool.map(drain, range(max(int(workers), 1)))))
+      else:
+        results = list(pool.map(download, list(workout_list.keys())))
+    except KeyboardInterrupt:
+      # Don't wait for queued workouts. Whatever's done is kept, so we can resume from there
+      pool.shutdown(wait=False, cancel_futures=True)
+      state_store.commit()
+      if work_queue is not None:
+        work_queue.release()
+      raise
+    pool.shutdown()
+    state_store.commit()
+
+    downloaded = results.count("downloaded")
+    skipped += results.count("failed")
+
+    if rate_limiter.daily_limit_reached():
+      print("\033[91m💥 Daily ratelimit reached!\n  \033[0m Wait until tomorrow and try again. \n   \033[92mIn the meantime, processing what we have...\033[0m")
+      return False
+
+    if rate_limiter.cap_reached():
+      print(f"\033[93m🚦 Request budget for this run spent after downloading {downloaded} activit{'ies' if downloaded != 1 else 'y'}.\033[0m")
+      print("\033[93m   The rest will be downloaded on the next run. In the meantime, processing what we have...\033[0m")
+      return False
 
-      api_url = f"https://www.strava.com/api/v3/activities/{key}"
+    if skipped > 0:
+      print(f"\033[93m🟡 Skipped {skipped} already existing activit{'ies' if skipped != 1 else 'y'}\033[0m")
 
-      response = requests.get(api_url, headers=headers, timeout=60)
+    if downloaded != 0:
+      print(f"\033[92m✅ {downloaded} activit{'ies' if downloaded != 1 else 'y'} downloaded to \033[37m\"{workdir}\033[0m\"\n")
+    else:
+      print(f"\033[92m✅ No new activities found. Existing ones stored at \033[37m\"{workdir}\"\n\033[0m")
 
-      lim_15, lim_daily, u_15, u_daily = helpers.get_rate_limits(self, res=response)
+    return True
 
-      if u_daily >= lim_daily: # Hit daily ratelimit
-        print("\033[91m💥 Daily ratelimit reached!\n  \033[0m Wait until tomorrow and try again. \n   \033[92mIn the meantime, processing what we have...\033[0m")
-        Config.write_downloaded_workouts(self, db_file=workout_db_file, workout_db=downloaded_workouts_db)
-        return False
+  def download_queued_workouts(self, storage,
+                               work_queue: WorkQueue,
+                               headers: dict,
+                               rate_limiter: RateLimiter,
+                               state_store: StateStore,
+                               *,
+                               pipeline = None) -> list:
+    """
+    #### Description
+    Claims workouts from a shared queue and downloads them, one at a time, until none are left or the daily ratelimit is reached
+    #### Parameters
+    - `storage`: where to store workouts, either a `WorkoutFiles` or a `WorkoutArchive`
+    - `work_queue`: the queue to claim workouts from
+    - `headers`: request headers, including strava's authorization
+    - `rate_limiter`: ratelimit budget shared by all workers
+    - `state_store`: sync state, where downloaded workouts are flagged
+    - `pipeline`: a started `TrackPipeline` to hand each downloaded workout over to. Optional
+    #### Returns
+    A list with the result of each download, as returned by `download_workout`
+    #### Notes
+    Failed workouts go back to the queue, to be retried by whichever exporter claims them next.
+    """
+    results = []
+    while not rate_limiter.daily_limit_reached():
+      claimed = work_queue.claim()
+      if not claimed:
+        break
+      workout_id, workout_name = next(iter(claimed.items()))
+      result = StravaWorkouts.download_workout(self, storage=storage,
+                                               workout_id=workout_id,
+                                               workout_name=workout_name,
+                                               headers=headers,
+                                               rate_limiter=rate_limiter,
+                                               pipeline=pipeline)
+      match result:
+        case "downloaded":
+          work_queue.complete(workout_id)
+          state_store.mark_downloaded(workout_id)
+        case "failed":
+          work_queue.fail(workout_id)
+        case _:
+          work_queue.release(workout_id)
+      results.append(result)
+    return results
+
+  def print_download_plan(self, pending: int, rate_limiter: RateLimiter):
+    """
+    #### Description
+    Lets the pacer know how much work is pending, then prints how long it's expected to take
+    #### Parameters
+    - `pending`: amount of workouts left to be downloaded
+    - `rate_limiter`: ratelimit budget the download will draw from
+    #### Notes
+    Nothing is printed until the first ratelimit headers have been seen, since the budget is still unknown.
+    """
+    rate_limiter.plan(pending)
+    lim_15, lim_daily, _, u_daily = rate_limiter.usage()
+    if pending == 0 or lim_15 is None:
+      return
+
+    eta = rate_limiter.eta()
+    if eta > 0:
+      print(f"\033[94m⏱️  {pending} activities to download. Expected to finish in ~{helpers.format_duration(self, seconds=eta)}\033[0m")
+    if pending > lim_daily - u_daily:
+      print(f"\n\033[93m🚦 Only {max(lim_daily - u_daily, 0)} requests are left on today's ratelimit of {lim_daily},\033[0m")
+      print("\033[93m🚦 so you'll have to run this script again after midnight UTC to finish.\n\033[0m")
+
+  def download_workout(self, storage,
+                       workout_id: int,
+                       workout_name: str,
+                       headers: dict,
+                       rate_limiter: RateLimiter,
+                       *,
+                       pipeline = None) -> str:
+    """
+    #### Description
+    Downloads a single workout and stores it. Safe to be called from several threads at once.
+    #### Parameters
+    - `headers`: request headers, including strava's authorization
+    - `rate_limiter`: ratelimit budget shared by all workers
+    - `storage`: where to store the workout, either a `WorkoutFiles` or a `WorkoutArchive`
+    - `workout_id`: ID of the workout to be retrieved
+    - `workout_name`: name of the workout to be retrieved. `None` to store it under the name it's retrieved with, if not known beforehand
+    - `pipeline`: a started `TrackPipeline` to hand the workout over to once stored, so its track is extracted without reading it back. Optional
+    #### Returns
+    `"downloaded"` if successful, `"failed"` if it couldn't be retrieved, or `"daily_limit"` if the daily ratelimit was reached before retrieving it
+    """
+    api_url = f"{self.api_url}/activities/{workout_id}"
+
+    while True:
+      if not rate_limiter.acquire(): # Hit daily ratelimit
+        return "daily_limit"
+
+      try:
+        response = self.http_client.get(api_url, headers=headers)
+      except requests.RequestException as e:
+        rate_limiter.release()
+        print(f"🚫 Activity \"{workout_name or workout_id}\" failed to download due to a connection error ({e.__class__.__name__})")
+        return "failed"
+      rate_limiter.release(response)
 
       match response.status_code:
         case 200: # Success!
-          with open(output_file, 'w', encoding="utf8") as f:
-            json.dump(response.json(), f, indent=2)
-          print(f"💾 Retrieving \033[1;90m{value}\033[0m")
-          downloaded += 1
-          downloaded_workouts_db[key] = "1"
-          Config.write_downloaded_workouts(self, db_file=workout_db_file, workout_db=downloaded_workouts_db)
-
-        case 429: # Hit ratelimiter
-          helpers.wait_for_it(self, f"15m Limit: [{u_15}/{lim_15}], Daily Limit: [{u_daily}/{lim_daily}]")
-          workout = StravaWorkouts.get_workout(self, workout_id=key, access_token=access_token)
-          with open(output_file, 'w', encoding="utf8") as f:
-            f.write(json.dumps(workout, indent=2))
-          print(f"💾 Retrieving \033[1;90m{value}\033[0m")
-          downloaded += 1
-          downloaded_workouts_db[key] = "1"
-          Config.write_downloaded_workouts(self, db_file=workout_db_file, workout_db=downloaded_workouts_db)
+          workout = response.json()
+          workout_name = workout_name if workout_name is not None else workout.get("name", "")
+          storage.save(workout_id, workout_name, workout)
+          print(f"💾 Retrieving \033[1;90m{workout_name}\033[0m")
+          if pipeline is not None:
+            pipeline.submit(workout_id, workout_name, workout)
+          return "downloaded"
+
+        case 429: # Hit ratelimiter. Wait for it to reset, then retry
+          rate_limiter.rate_limited(response)
 
         case 500: # Server error
-          print(f"🚫 Activity \"{value}\" failed to download due to error 500")
-          skipped += 1
+          print(f"🚫 Activity \"{workout_name or workout_id}\" failed to download due to error 500")
+          return "failed"
 
         case _:
-          print(f"🚫 Unexpected status code ({response.status_code}) while retrieving activity {value}")
-          skipped += 1
+          print(f"🚫 Unexpected status code ({response.status_code}) while retrieving activity {workout_name or workout_id}")
+          return "failed"
+
+  def download_all_streams(self, stream_store: StreamStore,
+                           workout_list: dict,
+                           access_token: str,
+                           *,
+                           workers: int = 1,
+                           rate_limiter: RateLimiter = None) -> bool:
+    """
+    #### Description
+    Downloads the streams of all workouts whose streams are still unsaved
+    #### Parameters
+    - `stream_store`: where to store streams
+    - `workout_list`: a dict where its key is the workout ID and its value the workout's name
+    - `access_token`: strava's access token
+    - `workers`: how many workouts' streams to download concurrently. All workers share a single ratelimit budget
+    - `rate_limiter`: ratelimit budget to draw from. Optional
+    #### Returns
+    `True` if successful, `False` otherwise
+    #### Notes
+    Streams are stored as soon as they're downloaded, so an interrupted run resumes from the next workout.
+    """
+    headers = {'Authorization': f'Bearer {access_token}'}
+    if rate_limiter is None:
+      rate_limiter = RateLimiter()
+    pending = [x for x in workout_list.keys() if not stream_store.has(x)]
+    if not pending:
+      return True
+
+    print(f"\033[94mℹ️  Retrieving streams for {len(pending)} activit{'ies' if len(pending) != 1 else 'y'}...\033[0m")
+    StravaWorkouts.print_download_plan(self, pending=len(pending), rate_limiter=rate_limiter)
+
+    def download(key) -> str:
+      return StravaWorkouts.download_streams(self, stream_store=stream_store,
+                                             workout_id=key,
+                                             workout_name=workout_list[key],
+                                             headers=headers,
+                                             rate_limiter=rate_limiter)
+
+    pool = ThreadPoolExecutor(max_workers=max(int(workers), 1))
+    try:
+      results = list(pool.map(download, pending))
+    except KeyboardInterrupt:
+      pool.shutdown(wait=False, cancel_futures=True)
+      raise
+    pool.shutdown()
+
+    if rate_limiter.daily_limit_reached() or rate_limiter.cap_reached():
+      print(f"\033[91m💥 {'Daily ratelimit reached' if rate_limiter.daily_limit_reached() else 'Request budget for this run spent'}!\n  \033[0m" \
+            " Streams for the rest of activities will be retrieved on the next run.")
+      return False
+
+    failed = results.count("failed")
+    if failed > 0:
+      print(f"\033[93m🟡 Failed to retrieve streams for {failed} activit{'ies' if failed != 1 else 'y'}\033[0m")
+    print(f"\033[92m✅ Streams for {results.count('downloaded')} activit{'ies' if results.count('downloaded') != 1 else 'y'} " \
+          f"stored at \033[37m\"{stream_store.streams_dir}\"\n\033[0m")
+    return True
 
-    if skipped > 0:
-      print(f"\033[93m🟡 Skipped {skipped} already existing activit{'ies' if skipped != 1 else 'y'}\033[0m")
+  def download_streams(self, stream_store: StreamStore,
+                       workout_id: int,
+                       workout_name: str,
+                       headers: dict,
+                       rate_limiter: RateLimiter) -> str:
+    """
+    #### Description
+    Downloads a single workout's streams and stores them. Safe to be called from several threads at once.
+    #### Parameters
+    - `stream_store`: where to store streams
+    - `workout_id`: ID of the workout whose streams are to be retrieved
+    - `workout_name`: name of the workout whose streams are to be retrieved
+    - `headers`: request headers, including strava's authorization
+    - `rate_limiter`: ratelimit budget shared by all workers
+    #### Returns
+    `"downloaded"` if successful, `"failed"` if they couldn't be retrieved, or `"daily_limit"` if the daily ratelimit was reached before retrieving them
+    #### Notes
+    Workouts without streams, such as manual ones, are stored with none, so they aren't requested again.
+    """
+    api_url = f"{self.api_url}/activities/{workout_id}/streams?keys={','.join(StreamStore.KEYS)}&key_by_type=true"
 
-    if downloaded != 0:
-      print(f"\033[92m✅ {downloaded} activit{'ies' if downloaded != 1 else 'y'} downloaded to \033[37m\"{workdir}\033[0m\"\n")
-    else:
-      print(f"\033[92m✅ No new activities found. Existing ones stored at \033[37m\"{workdir}\"\n\033[0m")
+    while True:
+      if not rate_limiter.acquire(): # Hit daily ratelimit
+        return "daily_limit"
 
-    return True
+      try:
+        response = self.http_client.get(api_url, headers=headers)
+      except requests.RequestException as e:
+        rate_limiter.release()
+        print(f"🚫 Streams for \"{workout_name}\" failed to download due to a connection error ({e.__class__.__name__})")
+        return "failed"
+      rate_limiter.release(response)
+
+      match response.status_code:
+        case 200: # Success!
+          stream_store.save(workout_id, response.json())
+          print(f"📈 Retrieving streams for \033[1;90m{workout_name}\033[0m")
+          return "downloaded"
+
+        case 404: # No streams for this workout
+          stream_store.save(workout_id, {})
+          return "downloaded"
+
+        case 429: # Hit ratelimiter. Wait for it to reset, then retry
+          rate_limiter.rate_limited(response)
+
+        case _:
+          print(f"🚫 Unexpected status code ({response.status_code}) while retrieving streams for {workout_name}")
+          return "failed"
 
   def get_files(self, workdir: str) -> dict:
     """
@@ -207,16 +649,24 @@ class StravaWorkouts:
     #### Returns
     A set of coordinates
     """
+    import polyline # pylint: disable=import-outside-toplevel
     return polyline.decode(pline)
 
-  def write_gpx_from_polyline(self, coordinates, output_file: str):
+  def write_gpx_from_polyline(self, coordinates, output_file: str, streaming: bool = True):
     """
     #### Description
     Writes a gpx file to disc from a decoded polyline
     #### Parameters
     - `coordinates`: a set of coordinates provided by the `decode_polyline` function
+    - `output_file`: full path of the gpx file to be written
+    - `streaming`: whether to stream points straight to the file. If `False`, the document is built with `gpxpy` first. Both produce the same output
     """
-    # Create a GPX file with the given coordinates
+    if streaming:
+      GpxWriter().write_track(coordinates=coordinates, output_file=output_file)
+      return
+
+    # Create a GPX file with the given coordinates. gpxpy is only imported if asked for, since the streaming writer doesn't need it
+    import gpxpy.gpx # pylint: disable=import-outside-toplevel
     gpx = gpxpy.gpx.GPX()
 
     # Create a GPX track and segment
@@ -237,43 +687,255 @@ class StravaWorkouts:
     with open(output_file, 'w', encoding="utf8") as f:
       f.write(gpx.to_xml())
 
-  def extract_all_tracks(self, workouts_dir: str, tracks_dir: str):
+  def extract_tracks(self, workout_polylines: list, output_files: list, gpx_writer: str = "stream",
+                     stream_store: StreamStore = None, workout_streams: list = None, *, exports: TrackExports = None, workout_properties: list = None,
+                     simplifier: TrackSimplifier = None, bounds: TrackBounds = None, workout_kinds: list = None) -> list:
+    """
+    #### Description
+    Extracts a batch of tracks from their polylines, or their streams if available, and writes each to its gpx file, and any other format asked for
+    #### Parameters
+    - `workout_polylines`: the workouts' encoded polylines
+    - `output_files`: full path of the gpx file to be written for each polyline
+    - `gpx_writer`: either `stream` or `gpxpy`. See `write_gpx_from_polyline`. Tracks built from streams are always streamed
+    - `stream_store`: where streams are stored. Optional
+    - `workout_streams`: for each polyline, either `None`, or a `(workout ID, start timestamp)` tuple to build its track from its stored streams instead.
+    Workouts without a `latlng` stream fall back to their polyline
+    - `exports`: other formats to export tracks in. Optional
+    - `workout_properties`: for each polyline, the properties to export its track with, as returned by `TrackExports.properties`. Required along with `exports`
+    - `simplifier`: the geometry stage to run tracks through before writing them, rounding, deduplicating and simplifying them. Optional
+    - `bounds`: what to work out the bounding boxes of each track's stretches with, for them to be indexed. Optional
+    - `workout_kinds`: for each polyline, either `None` to write its gpx file and every export, or the export kinds it's missing, for tracks whose gpx file
+    was already written to `output_files`. Those only get their missing exports and bounds, and their gpx file is left as it is. Optional
+    #### Returns
+    A list with a `(error, size, sha256, decode_seconds, write_seconds, exported, points, stretches)` tuple for each polyline. `error` is an empty string if successful,
+    or a message describing the error, while `size` and `sha256` describe the written gpx file, and are `None` if it failed, or wasn't written.
+    `exported` holds the track's exports, as returned by `TrackExports.export`, and is empty if there's none.
+    `points` is a `(decoded, written)` tuple, with how many points the track had before and after the geometry stage.
+    `stretches` holds the bounding boxes of the track's stretches, as returned by `TrackBounds.stretches`, and is empty unless `bounds` is set.
+    The batch's decoding time is split evenly among its polylines
+    #### Notes
+    Polylines are decoded all at once into a single coordinate buffer, which writers read from without copying it. Every format is written from that same buffer,
+    or from what the geometry stage made of it.
+    Meant to be run on worker processes too, so it only touches the output files.
+    """
+    decoder = PolylineDecoder()
+    started = time.perf_counter()
+    try:
+      tracks = decoder.decode_batch([x or "" for x in workout_polylines])
+    except Exception as e: # pylint: disable=broad-exception-caught
+      return [(f"{e.__class__.__name__}: {e}", None, None, 0.0, 0.0, {}, (0, 0), [])] * len(workout_polylines)
+    decode_seconds = (time.perf_counter() - started) / max(len(workout_polylines), 1)
+
+    results = []
+    for workout_polyline, track, output_file, workout_stream, properties, missing in zip(workout_polylines, tracks, output_files,
+                                                                                        workout_streams or repeat(None), workout_properties or repeat(None),
+                                                                                        workout_kinds or repeat(None)):
+      started = time.perf_counter()
+      try:
+        streams = stream_store.load(workout_stream[0]) if workout_stream is not None else {}
+        if streams.get("latlng"):
+          track, decoded, start = streams["latlng"], len(streams["latlng"]) // 2, workout_stream[1]
+          if simplifier is not None:
+            # Sensor data goes along with the points kept
+            track, indices = simplifier.simplify(track)
+            streams = {k: simplifier.take(v, indices) for k, v in streams.items() if k != "latlng"}
+          if missing is None:
+            GpxWriter().write_detailed_track(coordinates=decoder.pairs(track),
+                                             output_file=output_file,
+                                             elevations=streams.get("altitude"),
+                                             times=None if start is None or "time" not in streams else (start + x for x in streams["time"]),
+                                             heartrates=streams.get("heartrate"),
+                                             cadences=streams.get("cadence"),
+                                             watts=streams.get("watts"))
+        elif workout_polyline is None:
+          results.append(("workout has no map polyline", None, None, decode_seconds, 0.0, {}, (0, 0), []))
+          continue
+        else:
+          decoded = len(track) // 2
+          if simplifier is not None:
+            track = simplifier.simplify(track)[0]
+          if missing is None:
+            StravaWorkouts.write_gpx_from_polyline(self, coordinates=decoder.pairs(track), output_file=output_file, streaming=gpx_writer != "gpxpy")
+        digest = helpers.file_digest(self, output_file) if missing is None else (None, None)
+        exported = exports.export(track, properties, output_file, kinds=missing) if exports is not None else {}
+        stretches = bounds.stretches(track) if bounds is not None else []
+        results.append(("", *digest, decode_seconds, time.perf_counter() - started, exported, (decoded, len(track) // 2), stretches))
+      except Exception as e: # pylint: disable=broad-exception-caught
+        results.append((f"{e.__class__.__name__}: {e}", None, None, decode_seconds, time.perf_counter() - started, {}, (0, 0), []))
+    return results
+
+  def record_extraction(self, track: tuple, result: tuple, *, manifest: ArtifactManifest = None, metrics = None, exports: TrackExports = None,
+                        spatial_index: SpatialIndex = None, missing: list = None) -> bool:
+    """
+    #### Description
+    Reports a track's extraction, and records it on the manifest if successful
+    #### Parameters
+    - `track`: a `(workout ID, gpx file name, polyline, output file, workout stream)` tuple, where `workout stream` is `None` unless built from streams
+    - `result`: the track's result, as returned by `extract_tracks`
+    - `manifest`: where to record extracted tracks. Optional
+    - `metrics`: a `Metrics` to record the track's extraction on. Optional
+    - `exports`: where the track was exported to other formats with, if it was, so its exports are recorded too. Optional
+    - `spatial_index`: where to index the track. Optional. Requires it to be extracted along with its bounds
+    - `missing`: the export kinds the track was missing, if its gpx file was recorded already, as passed to `extract_tracks`. Its gpx file isn't recorded again then
+    #### Returns
+    `True` if extracted, `False` if it failed
+    """
+    key, gpx_file, workout_polyline, output_file, workout_stream = track
+    error, size, sha256, decode_seconds, write_seconds, exported, points, stretches = result
+    if metrics is not None:
+      metrics.count("tracks_total", status=("extracted" if missing is None else "completed") if error == "" else "failed")
+      metrics.observe("track_decode_seconds", decode_seconds)
+      metrics.observe("track_write_seconds", write_seconds)
+      if error == "" and missing is None:
+        metrics.count("track_written_bytes_total", size)
+        metrics.count("track_points_total", points[0], stage="decoded")
+        metrics.count("track_points_total", points[1], stage="written")
+    if error != "":
+      print(f"🚫 Failed to extract \033[1;90m{gpx_file}\033[0m ({error})")
+      return False
+    if missing is not None:
+      # Exports go along with the gpx file they were made for
+      print(f"🧩 Completing \033[1;90m{gpx_file}\033[0m ({', '.join(missing) or 'spatial index'})")
+      source_version = manifest.source_version(key) if manifest is not None else None
+    else:
+      print(f"🗺️  Extracting to \033[1;90m{gpx_file}\033[0m")
+      source_version = "streams" if workout_stream is not None else hashlib.sha256(workout_polyline.encode()).hexdigest()[:16]
+    if manifest is not None and missing is None:
+      manifest.record(workout_id=key, path=output_file, size=size, sha256=sha256, source_version=source_version)
+    if exports is not None:
+      exports.record(workout_id=key, exported=exported, source_version=source_version, manifest=manifest)
+    if spatial_index is not None:
+      spatial_index.record(workout_id=key, stretches=stretches)
+    return True
+
+  # This function is complex by nature.
+  # No point on splitting it into smaller ones.
+  # pylint: disable=too-many-locals, too-many-branches, too-many-statements
+  def extract_all_tracks(self, workouts_dir: str, tracks_dir: str, storage = None, workers: int = 1, gpx_writer: str = "stream",
+                         *, manifest: ArtifactManifest = None, stream_store: StreamStore = None, metrics = None, exports: TrackExports = None,
+                         simplifier: TrackSimplifier = None, spatial_index: SpatialIndex = None):
     """
     #### Description
     Extracts all tracks from downloaded workouts if not done already.
     #### Parameters
     - `tracks_dir`: folder where to place extracted tracks
     - `workouts_dir`: folder where to look for workouts
+    - `storage`: where workouts are stored, either a `WorkoutFiles` or a `WorkoutArchive`. Defaults to one file per workout on `workouts_dir`
+    - `workers`: how many processes to extract tracks with. `1` extracts them on this process
+    - `gpx_writer`: either `stream`, which writes gpx files point by point, or `gpxpy`, which builds them in memory first
+    - `manifest`: where to record extracted tracks. If set, workouts already on it are skipped without looking for their files.
+    Otherwise, workouts are skipped if a gpx file named after them is found on `tracks_dir` or its `Archive` folder
+    - `stream_store`: where streams are stored. If set, tracks of workouts with streams are built from them, with timestamps, elevation and sensor data.
+    Tracks extracted from a polyline before their streams were downloaded are extracted again
+    - `metrics`: a `Metrics` to record tracks extracted, their size, and their decoding and writing times on. Optional
+    - `exports`: other formats to export tracks in, besides gpx. Optional. Tracks already extracted, but missing from any of them, get only those exported,
+    next to their gpx file, wherever it is. Only tracked through the manifest, so without one, tracks already extracted aren't exported
+    - `simplifier`: the geometry stage to run tracks through before writing them. Optional. How much it shrank them is reported once done.
+    Only applies to tracks extracted from then on
+    - `spatial_index`: where to index extracted tracks, so they can be searched by area. Optional. Tracks already extracted, but not indexed,
+    are indexed from their polyline, or streams, without writing their gpx file again
+    #### Notes
+    Workouts are handed to worker processes in chunks. Progress is printed in the same order workouts are read, regardless of the amount of workers.
     """
     print("\033[94mℹ️  Extracting tracks to gpx files...\033[0m")
-    filelist = StravaWorkouts.get_files(self=self, workdir=workouts_dir)
+    if storage is None:
+      storage = WorkoutFiles(workouts_dir)
+    workout_index = storage.index()
+    workers = max(int(workers), 1)
+    chunk_size = 16
     skipped = 0
     extracted = 0
+    completed = 0
+    failed = 0
+    points, written_bytes = [0, 0], 0
 
     #! - Make "Archive" hardcode a config parameter
     archive_dir = f"{tracks_dir}/Archive"
     #! --------------------------------------------
 
-    for key in filelist.keys():
-
-      if str(filelist[key]).endswith(".json"):
-        gpx_file = filelist[key].replace('.json', '.gpx')
-        gpx_filename = f"{tracks_dir}/{gpx_file}"
-
-        if not helpers.is_duplicate(self, paths=[tracks_dir, archive_dir], filename=gpx_file):
-          with open(f"{workouts_dir}/{filelist[key]}", mode="r", encoding="utf8") as f:
-            workout = json.load(f)
-          track = StravaWorkouts.decode_polyline(self, pline=workout['map']['polyline'])
-          StravaWorkouts.write_gpx_from_polyline(self, coordinates=track, output_file=gpx_filename)
-          print(f"🗺️  Extracting to \033[1;90m{gpx_file}\033[0m")
-          extracted += 1
+    export_kinds = exports.kinds() if exports is not None else []
+    if exports is not None and manifest is not None:
+      exports.reconcile(manifest)
+
+    def pending_tracks():
+      # Read workouts lazily, so only a few batches are ever held in memory
+      nonlocal skipped
+      for key in workout_index.keys():
+        gpx_file = f"{workout_index[key]}.gpx"
+        streamed = stream_store is not None and stream_store.has(key)
+        current, missing = False, []
+        if manifest is not None:
+          current = manifest.has(key) and (not streamed or manifest.source_version(key) == "streams")
+          missing = [x for x in export_kinds if not manifest.has(key, kind=x)]
+          done = current and not missing and (spatial_index is None or spatial_index.has(key))
         else:
+          done = helpers.is_duplicate(self, paths=[tracks_dir, archive_dir], filename=gpx_file)
+        if done:
           skipped += 1
+          continue
+        # Tracks already recorded stay where they are, which may be the Archive folder. Those still current only get what they're missing
+        recorded = manifest.get(key) if manifest is not None else None
+        if recorded is None or not os.path.exists(recorded["path"]):
+          recorded, current = None, False
+        workout = storage.load(key)
+        start = datetime.fromisoformat(workout["start_date"].replace("Z", "+00:00")).timestamp() if workout.get("start_date") else None
+        # Workouts stored from their summaries only have a simplified polyline
+        workout_polyline = (workout.get('map') or {}).get('polyline') or (workout.get('map') or {}).get('summary_polyline')
+        properties = exports.properties(workout) if exports is not None else None
+        output_file = recorded["path"] if recorded is not None else f"{tracks_dir}/{gpx_file}"
+        yield (key, gpx_file, workout_polyline, output_file, (key, start) if streamed else None), properties, missing if current else None
+
+    options = {"exports": exports, "simplifier": simplifier, "bounds": TrackBounds() if spatial_index is not None else None}
+    pool = ProcessPoolExecutor(max_workers=workers) if workers > 1 else None
+    try:
+      batches = iter(pending_tracks())
+      while True:
+        batch = list(islice(batches, workers * chunk_size * 4))
+        if not batch:
+          break
+        chunks = [batch[x:x + chunk_size] for x in range(0, len(batch), chunk_size)]
+        polylines, output_files = [[y[0][2] for y in x] for x in chunks], [[y[0][3] for y in x] for x in chunks]
+        workout_streams = [[y[0][4] for y in x] for x in chunks]
+        calls = [((x, y, gpx_writer, stream_store, z), options | {"workout_properties": [w[1] for w in chunk], "workout_kinds": [w[2] for w in chunk]})
+                 for x, y, z, chunk in zip(polylines, output_files, workout_streams, chunks)]
+        if pool is None:
+          results = (self.extract_tracks(*args, **kwargs) for args, kwargs in calls)
+        else:
+          results = (x.result() for x in [pool.submit(self.extract_tracks, *args, **kwargs) for args, kwargs in calls])
+        for (track, _, missing), result in zip(batch, chain.from_iterable(results)):
+          if not StravaWorkouts.record_extraction(self, track=track, result=result, manifest=manifest, metrics=metrics, exports=exports,
+                                                  spatial_index=spatial_index, missing=missing):
+            failed += 1
+          elif missing is not None:
+            completed += 1
+          else:
+            extracted += 1
+            points, written_bytes = [points[0] + result[6][0], points[1] + result[6][1]], written_bytes + result[1]
+    finally:
+      if pool is not None:
+        pool.shutdown(cancel_futures=True)
+      if manifest is not None:
+        manifest.commit()
+      if exports is not None:
+        exports.close(manifest)
+      if spatial_index is not None:
+        spatial_index.commit()
+    if metrics is not None:
+      metrics.count("tracks_total", skipped, status="skipped")
 
     if skipped > 0:
       print(f"\033[93m🟡 Skipped {skipped} already existing track{'s' if skipped != 1 else ''}\033[0m")
 
+    if failed > 0:
+      print(f"\033[91m🚫 Failed to extract {failed} track{'s' if failed != 1 else ''}\033[0m")
+
+    if completed != 0:
+      print(f"\033[92m✅ {completed} existing track{'s' if completed != 1 else ''} exported or indexed, where {'they are' if completed != 1 else 'it is'}\033[0m")
+
     if extracted != 0:
       print(f"\033[92m✅ {extracted} track{'s' if extracted != 1 else ''} extracted to \033[37m\"{tracks_dir}\"\033[0m")
-    else:
+    elif completed == 0:
       print(f"\033[92m✅ No new tracks found. Existing ones stored at either \033[37m\"{tracks_dir}\"\033[92m or \033[37m\"{archive_dir}\"\033[0m")
+
+    if simplifier is not None and extracted > 0:
+      simplifier.report(decoded=points[0], written=points[1], written_bytes=written_bytes)
@@ -0,0 +1,134 @@
+"""
+Token manager module, keeping strava's tokens fresh over long and concurrent runs.
+"""
+import threading
+import time
+import requests
+from requests.auth import AuthBase
+from config import Config
+from rate_limiter import RateLimiter
+from strava_oauth import StravaOauth
+
+# The token set, plus where it's refreshed from and written to.
+# pylint: disable=too-many-instance-attributes
+class TokenManager(AuthBase):
+  """
+  #### Description
+  This class keeps strava's tokens fresh, and signs every request to strava's API with the current access token.
+  Access tokens are refreshed shortly before expiring, and whenever strava rejects one, in which case the request is sent again with the new one.
+  #### Available functions
+  - `access_token() -> str`: returns the current access token, refreshing it first if about to expire
+  - `meter(rate_limiter: RateLimiter)`: draws requests sent again with a new token from a ratelimit budget, as requests of their own
+  - `refresh(rejected: str = None) -> bool`: refreshes the access token, unless another thread already did
+  #### Notes
+  Set it as an `HttpClient`'s auth, through `HttpClient.authenticate`, so every request to strava's API goes through it. Oauth requests are left alone.
+  Safe to be used from several threads at once. Refreshes are single-flight: when several workers find the token expired or rejected at once,
+  one refreshes it while the rest wait for it, then use what it got.
+  Strava may rotate the refresh token on every refresh, invalidating the old one, so the whole token set is written to the secrets file as soon as it's received.
+  Requests sent again are seen by the session's response hooks, same as the rejected ones, and, once metered, drawn from the ratelimit budget too.
+  """
+
+  def __init__(self, strava_oauth: StravaOauth, secrets_file: str, margin: int = StravaOauth.REFRESH_MARGIN):
+    """
+    #### Parameters
+    - `strava_oauth`: what to refresh tokens with
+    - `secrets_file`: full path to the secrets file to read tokens from, and write refreshed ones to
+    - `margin`: how many seconds before expiring to refresh the access token
+    """
+    self.strava_oauth = strava_oauth
+    self.secrets_file = secrets_file
+    self.margin = margin
+    self.api_url = f"{strava_oauth.base_url}/api/v3"
+    self._lock = threading.Lock()
+    self._rate_limiter = None
+    self._access_token, self._refresh_token, self._client_id, self._client_secret, self._expires_at = Config().read_secrets_file(secrets_file)
+
+  def access_token(self) -> str:
+    """
+    #### Description
+    Returns the current access token, refreshing it first if about to expire
+    #### Returns
+    The access token. An empty string if it expired, and couldn't be refreshed
+    #### Notes
+    If refreshing fails while the token is still valid, it's returned as it is, and refreshing is tried again on the next call.
+    """
+    with self._lock:
+      if self._expires_at - time.time() < self.margin:
+        if not TokenManager._refresh_locked(self) and self._expires_at <= time.time():
+          return ""
+      return self._access_token
+
+  def meter(self, rate_limiter: RateLimiter):
+    """
+    #### Description
+    Draws requests sent again with a new token from a ratelimit budget, as requests of their own. Those that don't fit in it aren't sent again
+    #### Parameters
+    - `rate_limiter`: the budget the requests they're sent again for were acquired from. `None` stops drawing from it
+    """
+    with self._lock:
+      self._rate_limiter = rate_limiter
+
+  def refresh(self, rejected: str = None) -> bool:
+    """
+    #### Description
+    Refreshes the access token, then writes the new token set to the secrets file
+    #### Parameters
+    - `rejected`: the access token strava rejected. If it's been replaced already, by another thread, it's not refreshed again
+    #### Returns
+    `True` if there's a new access token to use, `False` otherwise
+    """
+    with self._lock:
+      if rejected is not None and rejected != self._access_token:
+        return True
+      return TokenManager._refresh_locked(self)
+
+  def __call__(self, req: requests.PreparedRequest) -> requests.PreparedRequest:
+    # Signs requests to strava's API. Token refreshes go through the same session, and mustn't wait on themselves
+    if not req.url.startswith(self.api_url):
+      return req
+    req.headers["Authorization"] = f"Bearer {TokenManager.access_token(self)}"
+    req.register_hook("response", self._retry_rejected)
+    return req
+
+  def __getstate__(self) -> dict:
+    # Locks can't cross process boundaries. Worker processes don't send requests, so they get no tokens either
+    return {}
+
+  def _refresh_locked(self) -> bool:
+    access_token, refresh_token, expires_at = self.strava_oauth.refresh_access_token(client_id=self._client_id,
+                                                                                      client_secret=self._client_secret,
+                                                                                      refresh_token=self._refresh_token)
+    if access_token == "":
+      return False
+    Config().write_secrets_file(secrets_file=self.secrets_file,
+                                strava_client_id=self._client_id,
+                                strava_client_secret=self._client_secret,
+                                strava_access_token=access_token,
+                                strava_refresh_token=refresh_token,
+                                strava_token_expires_at=expires_at)
+    self._access_token, self._refresh_token, self._expires_at = access_token, refresh_token, expires_at
+    print("\033[94mℹ️  Access token refreshed\033[0m", flush=True)
+    return True
+
+  def _retry_rejected(self, res: requests.Response, **kwargs) -> requests.Response:
+    # Sends a rejected request once more, with a new token. Same as requests' own digest auth does
+    if res.status_code != 401 or getattr(res.request, "token_retried", False):
+      return res
+    rejected = res.request.headers.get("Authorization", "").removeprefix("Bearer ")
+    if not TokenManager.refresh(self, rejected=rejected):
+      return res
+    if self._rate_limiter is not None and not self._rate_limiter.charge():
+      return res
+    # Hooks after this one, such as the session's recording metrics, only get to see what it returns. Let them see the rejection too
+    hooks = res.request.hooks["response"]
+    requests.hooks.dispatch_hook("response", {"response": hooks[hooks.index(self._retry_rejected) + 1:]}, res, **kwargs)
+    # Read the rejection through, so its connection goes back to the pool
+    _ = res.content
+    res.close()
+    retry = res.request.copy()
+    retry.headers["Authorization"] = f"Bearer {TokenManager.access_token(self)}"
+    retry.token_retried = True
+    retried = res.connection.send(retry, **kwargs)
+    retried.history.append(res)
+    retried.request = retry
+    return retried
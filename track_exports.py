@@ -0,0 +1,346 @@
+"""
+Track exports module, writing tracks in formats other than gpx, either one file per workout or collections holding them all.
+"""
+import hashlib
+import json
+import math
+import os
+import re
+import struct
+import sys
+from array import array
+from xml.sax.saxutils import escape
+from helpers import Helpers as helpers
+from gpx_writer import GpxWriter
+from polyline_decoder import PolylineDecoder
+
+class GeometryWriter:
+  """
+  #### Description
+  This class writes tracks as GeoJSON features, KML placemarks, or records of a compact binary format, straight from their coordinates.
+  #### Available functions
+  - `binary_record(coordinates, properties: dict) -> bytes`: encodes a track as a binary record
+  - `feature(coordinates, properties: dict) -> str`: encodes a track as a GeoJSON feature, on a single line
+  - `write_geojson(coordinates, properties: dict, output_file: str)`: writes a track to a GeoJSON file, as a single feature
+  - `write_kml(coordinates, properties: dict, output_file: str)`: writes a track to a KML file, as a single placemark
+  #### Notes
+  Binary records start with a little-endian header holding the workout ID as an int64, then the length of its properties and its amount of points, as uint32s.
+  Properties follow, as UTF-8 encoded JSON, then every point as a pair of int32s, latitude first, in 1e-7 degrees.
+  Binary collections start with `BINARY_MAGIC`, followed by one record per track.
+  """
+  BINARY_MAGIC = b"STRK\x01"
+  BINARY_HEADER = struct.Struct("<qII")
+  BINARY_SCALE = 1e7
+  KML_HEADER = '<?xml version="1.0" encoding="UTF-8"?>\n<kml xmlns="http://www.opengis.net/kml/2.2">'
+
+  def feature(self, coordinates, properties: dict) -> str:
+    """
+    #### Description
+    Encodes a track as a GeoJSON feature, with a `LineString` geometry
+    #### Parameters
+    - `coordinates`: an iterable of `(latitude, longitude)` pairs
+    - `properties`: the feature's properties. Its `id` becomes the feature's
+    #### Returns
+    The feature, on a single line. Points missing their coordinates are left out
+    """
+    points = ",".join(f"[{lon},{lat}]" for lat, lon in coordinates if not (math.isnan(lat) or math.isnan(lon)))
+    return f'{{"type":"Feature","id":{json.dumps(properties.get("id"))},"geometry":{{"type":"LineString","coordinates":[{points}]}},' \
+           f'"properties":{json.dumps(properties, separators=(",", ":"), ensure_ascii=False)}}}'
+
+  def binary_record(self, coordinates, properties: dict) -> bytes:
+    """
+    #### Description
+    Encodes a track as a binary record. See the class' notes for its layout
+    #### Parameters
+    - `coordinates`: an iterable of `(latitude, longitude)` pairs
+    - `properties`: the track's properties. Must hold its `id`
+    #### Returns
+    The record. Points missing their coordinates are left out
+    """
+    scale = GeometryWriter.BINARY_SCALE
+    points = array("i", (round(x * scale) for pair in coordinates if not (math.isnan(pair[0]) or math.isnan(pair[1])) for x in pair))
+    if sys.byteorder != "little":
+      points.byteswap()
+    encoded = json.dumps(properties, separators=(",", ":"), ensure_ascii=False).encode("utf8")
+    return GeometryWriter.BINARY_HEADER.pack(int(properties["id"]), len(encoded), len(points) // 2) + encoded + points.tobytes()
+
+  def write_geojson(self, coordinates, properties: dict, output_file: str):
+    """
+    #### Description
+    Writes a track to a GeoJSON file, as a single feature
+    #### Parameters
+    - `coordinates`: an iterable of `(latitude, longitude)` pairs
+    - `properties`: the feature's properties
+    - `output_file`: full path of the file to be written
+    """
+    with open(output_file, 'w', encoding="utf8", buffering=GpxWriter.BUFFER_SIZE) as f:
+      f.write(GeometryWriter.feature(self, coordinates, properties))
+
+  def write_kml(self, coordinates, properties: dict, output_file: str):
+    """
+    #### Description
+    Writes a track to a KML file, as a single placemark, with its properties as extended data
+    #### Parameters
+    - `coordinates`: an iterable of `(latitude, longitude)` pairs
+    - `properties`: the placemark's properties. Its `name` becomes the placemark's
+    - `output_file`: full path of the file to be written
+    """
+    fmt = GpxWriter().format_coordinate
+    with open(output_file, 'w', encoding="utf8", buffering=GpxWriter.BUFFER_SIZE) as f:
+      f.write(GeometryWriter.KML_HEADER)
+      f.write(f"\n  <Placemark>\n    <name>{escape(str(properties.get('name') or ''))}</name>\n    <ExtendedData>")
+      f.writelines(f'\n      <Data name="{escape(k)}"><value>{escape(str(v))}</value></Data>' for k, v in properties.items() if v is not None)
+      f.write("\n    </ExtendedData>\n    <LineString>\n      <tessellate>1</tessellate>\n      <coordinates>")
+      f.writelines(f"{fmt(lon)},{fmt(lat)} " for lat, lon in coordinates if not (math.isnan(lat) or math.isnan(lon)))
+      f.write("</coordinates>\n    </LineString>\n  </Placemark>\n</kml>")
+
+class TrackCollection:
+  """
+  #### Description
+  This class keeps a collection of tracks on a single file, either as line-delimited GeoJSON, a GeoJSON `FeatureCollection`, or binary records.
+  Tracks are appended to it as they're extracted, so adding a few to a large collection doesn't rewrite it.
+  #### Available functions
+  - `append(record: bytes)`: appends a track's record to the collection
+  - `close(keep: set = None) -> bool`: finishes the collection, dropping records of workouts not to be kept, or replaced since
+  - `records() -> list`: returns the workout ID, offset and length of every record on the collection
+  #### Notes
+  A `FeatureCollection` can't be appended to, so its features are appended to a line-delimited GeoJSON file next to it, named after it and starting with a dot,
+  and the collection is written from them once closed, only if anything changed.
+  """
+  FILES = {"geojson": "tracks.geojson", "ndjson": "tracks.ndjson", "binary": "tracks.strk"}
+  _FEATURE_ID = re.compile(rb'\{"type":"Feature","id":(-?\d+),')
+
+  def __init__(self, collections_dir: str, collection_format: str):
+    """
+    #### Parameters
+    - `collections_dir`: folder where to keep the collection
+    - `collection_format`: either `geojson`, `ndjson` or `binary`
+    """
+    self.format = collection_format
+    self.path = f"{collections_dir}/{TrackCollection.FILES[collection_format]}"
+    self.records_path = self.path if collection_format != "geojson" else f"{collections_dir}/.{TrackCollection.FILES[collection_format]}.ndjson"
+    self._file = None
+    self._changed = False
+
+  def append(self, record: bytes):
+    """
+    #### Description
+    Appends a track's record to the collection
+    #### Parameters
+    - `record`: the record, as encoded by `TrackExports.export`
+    """
+    if self._file is None:
+      os.makedirs(os.path.dirname(self.path), exist_ok=True)
+      self._file = open(self.records_path, mode="ab", buffering=GpxWriter.BUFFER_SIZE) # pylint: disable=consider-using-with
+      if self.format == "binary" and self._file.tell() == 0:
+        self._file.write(GeometryWriter.BINARY_MAGIC)
+    self._file.write(record)
+    self._changed = True
+
+  def records(self) -> list:
+    """
+    #### Description
+    Returns where every record on the collection is
+    #### Returns
+    A list with a `(workout ID, offset, length)` tuple for each record, in the order they were appended
+    """
+    if not os.path.exists(self.records_path):
+      return []
+    result = []
+    with open(self.records_path, mode="rb", buffering=GpxWriter.BUFFER_SIZE) as f:
+      if self.format == "binary":
+        header, offset = GeometryWriter.BINARY_HEADER, len(f.read(len(GeometryWriter.BINARY_MAGIC)))
+        while len(raw := f.read(header.size)) == header.size:
+          workout_id, properties_length, points = header.unpack(raw)
+          length = header.size + properties_length + points * 8
+          result.append((workout_id, offset, length))
+          offset += length
+          f.seek(offset)
+      else:
+        offset = 0
+        for line in f:
+          match = TrackCollection._FEATURE_ID.match(line)
+          result.append((int(match.group(1)) if match else None, offset, len(line)))
+          offset += len(line)
+    return result
+
+  def close(self, keep: set = None) -> bool:
+    """
+    #### Description
+    Finishes the collection. Records of workouts not to be kept, and those replaced by a newer one, are dropped, rewriting the collection without them
+    #### Parameters
+    - `keep`: IDs of the workouts whose records are to be kept. If `None`, every record is
+    #### Returns
+    `True` if anything was appended or dropped since opened, `False` otherwise
+    """
+    if self._file is not None:
+      self._file.close()
+      self._file = None
+    if keep is not None:
+      records = TrackCollection.records(self)
+      if len(records) > len(keep):
+        latest = {x[0]: x for x in records if x[0] in keep}
+        tmp_file = f"{self.records_path}.tmp"
+        with open(self.records_path, mode="rb") as src, open(tmp_file, mode="wb", buffering=GpxWriter.BUFFER_SIZE) as dst:
+          if self.format == "binary":
+            dst.write(GeometryWriter.BINARY_MAGIC)
+          for workout_id, offset, length in records:
+            if latest.get(workout_id) == (workout_id, offset, length):
+              src.seek(offset)
+              dst.write(src.read(length))
+        os.replace(tmp_file, self.records_path)
+        self._changed = True
+    if self.format == "geojson" and (self._changed or not os.path.exists(self.path)) and os.path.exists(self.records_path):
+      tmp_file = f"{self.path}.tmp"
+      with open(self.records_path, mode="rb") as src, open(tmp_file, mode="wb", buffering=GpxWriter.BUFFER_SIZE) as dst:
+        dst.write(b'{"type":"FeatureCollection","features":[')
+        for index, line in enumerate(src):
+          dst.write(b",\n" if index else b"\n")
+          dst.write(line.rstrip(b"\n"))
+        dst.write(b"\n]}\n")
+      os.replace(tmp_file, self.path)
+    changed, self._changed = self._changed, False
+    return changed
+
+class TrackExports:
+  """
+  #### Description
+  This class exports tracks in formats other than gpx, from the very coordinates their gpx file is written from, so a single extraction pass produces them all.
+  Each track can get a file of its own in any of `FORMATS`, next to its gpx file, and be added to collections in any of `COLLECTIONS`, on a `Collections` folder.
+  The workout's metadata, as listed on `PROPERTIES`, is exported along with its track.
+  #### Available functions
+  - `close(manifest: ArtifactManifest = None) -> int`: finishes every collection written to
+  - `export(coordinates, properties: dict, output_file: str, kinds: list = None) -> dict`: writes a track's files, and encodes its collection records
+  - `kinds() -> list`: returns the manifest kinds of every format exported
+  - `properties(workout: dict) -> dict`: picks the properties to export from a workout
+  - `reconcile(manifest: ArtifactManifest)`: drops collections missing from disk from the manifest
+  - `record(workout_id: int, exported: dict, source_version: str, manifest: ArtifactManifest = None)`: appends a track's records to their collections, and records its exports
+  #### Notes
+  `export` only writes to its own files, so it's meant to be run on worker processes, while `record` and `close` run on this one.
+  Exports are recorded on the manifest along with gpx tracks, each as its own kind, such as `geojson` or `ndjson_collection`.
+  Collections are only rewritten once closed, and only if a workout in them was replaced or forgotten. Records of forgotten workouts
+  are kept until a collection is written to again.
+  """
+  FORMATS = ["geojson", "kml"]
+  COLLECTIONS = ["geojson", "ndjson", "binary"]
+  PROPERTIES = ["id", "name", "type", "sport_type", "start_date", "start_date_local", "timezone", "distance", "moving_time", "elapsed_time",
+                "total_elevation_gain", "average_speed", "max_speed", "gear_id", "commute", "trainer", "private"]
+
+  def __init__(self, tracks_dir: str, formats: list = None, collections: list = None):
+    """
+    #### Parameters
+    - `tracks_dir`: folder where tracks are extracted to
+    - `formats`: formats to write a file for each track in, out of `FORMATS`. Unknown ones are ignored
+    - `collections`: formats to keep a collection of every track in, out of `COLLECTIONS`. Unknown ones are ignored
+    """
+    for name, requested, known in (("format", formats, TrackExports.FORMATS), ("collection", collections, TrackExports.COLLECTIONS)):
+      for x in set(requested or []) - set(known):
+        print(f"\033[93m⚠️  Unknown track export {name} \"{x}\". Ignoring it\033[0m")
+    self.formats = [x for x in TrackExports.FORMATS if x in (formats or [])]
+    self.collections = [x for x in TrackExports.COLLECTIONS if x in (collections or [])]
+    self.collections_dir = f"{tracks_dir}/Collections"
+    self._open = {}
+
+  def kinds(self) -> list:
+    """
+    #### Description
+    Returns the manifest kinds of every format exported
+    #### Returns
+    A list with a kind for each format, followed by one for each collection
+    """
+    return self.formats + [f"{x}_collection" for x in self.collections]
+
+  def properties(self, workout: dict) -> dict:
+    """
+    #### Description
+    Picks the properties to export from a workout
+    #### Parameters
+    - `workout`: the workout's data, either as downloaded or as stored from its summary
+    #### Returns
+    A dict with every property on `PROPERTIES`. Those missing from the workout are `None`
+    """
+    return {x: workout.get(x) for x in TrackExports.PROPERTIES}
+
+  def export(self, coordinates, properties: dict, output_file: str, kinds: list = None) -> dict:
+    """
+    #### Description
+    Writes a track's files, next to its gpx file, and encodes its collection records
+    #### Parameters
+    - `coordinates`: the track's flat coordinate buffer, as decoded by `PolylineDecoder`
+    - `properties`: the track's properties, as returned by `properties`
+    - `output_file`: full path of the track's gpx file. Other files are named after it
+    - `kinds`: the kinds to export, out of those returned by `kinds`, such as those a track already extracted is missing. Defaults to them all
+    #### Returns
+    A dict where its key is the kind of export, and its value a `(path, size, sha256, record)` tuple.
+    `path` is `None` for collections, and `record` for files
+    """
+    decoder = PolylineDecoder()
+    writer = GeometryWriter()
+    exported = {}
+    stem = os.path.splitext(output_file)[0]
+    for name in [x for x in self.formats if kinds is None or x in kinds]:
+      path = f"{stem}.{name}"
+      getattr(writer, f"write_{name}")(decoder.pairs(coordinates), properties, path)
+      exported[name] = (path, *helpers.file_digest(self, path), None)
+    feature = None
+    for name in [x for x in self.collections if kinds is None or f"{x}_collection" in kinds]:
+      if name == "binary":
+        record = writer.binary_record(decoder.pairs(coordinates), properties)
+      else:
+        feature = feature or f"{writer.feature(decoder.pairs(coordinates), properties)}\n".encode("utf8")
+        record = feature
+      exported[f"{name}_collection"] = (None, len(record), hashlib.sha256(record).hexdigest(), record)
+    return exported
+
+  def record(self, workout_id: int, exported: dict, source_version: str, manifest = None):
+    """
+    #### Description
+    Appends a track's records to their collections, and records its exports on the manifest
+    #### Parameters
+    - `workout_id`: the workout's ID
+    - `exported`: the track's exports, as returned by `export`
+    - `source_version`: version of the source the track was extracted from
+    - `manifest`: an `ArtifactManifest` where to record exports. Optional
+    """
+    for kind, (path, size, sha256, record) in exported.items():
+      if record is not None:
+        if kind not in self._open:
+          self._open[kind] = TrackCollection(self.collections_dir, kind.removesuffix("_collection"))
+        self._open[kind].append(record)
+        path = self._open[kind].path
+      if manifest is not None:
+        manifest.record(workout_id=workout_id, path=path, size=size, sha256=sha256, source_version=source_version, kind=kind)
+
+  def close(self, manifest = None) -> int:
+    """
+    #### Description
+    Finishes every collection written to since last closed. Records of workouts no longer on the manifest, or replaced since, are dropped from them
+    #### Parameters
+    - `manifest`: an `ArtifactManifest` where exports are recorded. Optional. Without it, replaced records are kept
+    #### Returns
+    How many collections changed
+    """
+    if manifest is not None:
+      manifest.commit()
+    changed = 0
+    for kind, collection in self._open.items():
+      if collection.close(keep=manifest.workouts(kind=kind) if manifest is not None else None):
+        changed += 1
+        print(f"📚 Updated the {collection.format} collection at \033[1;90m{collection.path}\033[0m")
+    self._open = {}
+    return changed
+
+  def reconcile(self, manifest):
+    """
+    #### Description
+    Drops collections missing from disk from the manifest, so every track is exported to them again
+    #### Parameters
+    - `manifest`: an `ArtifactManifest` where exports are recorded
+    """
+    for name in self.collections:
+      if manifest.count(kind=f"{name}_collection") and not os.path.exists(TrackCollection(self.collections_dir, name).path):
+        manifest.reconcile(paths=[], kind=f"{name}_collection")
+
+  def __getstate__(self) -> dict:
+    # Open collections stay on this process. Worker processes only export
+    return {k: v for k, v in self.__dict__.items() if k != "_open"} | {"_open": {}}
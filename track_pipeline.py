@@ -0,0 +1,185 @@
+"""
+Track pipeline module, extracting tracks from workouts as soon as they're downloaded.
+"""
+import queue
+import threading
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from helpers import Helpers as helpers
+from artifact_manifest import ArtifactManifest
+from strava_workouts import StravaWorkouts
+from track_exports import TrackExports
+from track_simplifier import TrackSimplifier
+from spatial_index import SpatialIndex, TrackBounds
+
+# Extraction settings, plus the queue, pool and thread they're run with.
+# pylint: disable=too-many-instance-attributes
+class TrackPipeline:
+  """
+  #### Description
+  This class extracts tracks from workouts as they're downloaded, so decoding and writing them overlaps with waiting for strava,
+  and workouts just written to disk don't have to be read back from it.
+  Download workers hand workouts over through a bounded queue, so whenever extraction falls behind they wait for it, instead of piling workouts up in memory.
+  #### Available functions
+  - `close()`: waits for every queued workout to be extracted, then stops the pipeline
+  - `extracted(workout_id: int) -> bool`: tells whether a workout's track was extracted by the pipeline
+  - `start()`: starts extracting workouts as they're submitted
+  - `submit(workout_id: int, workout_name: str, workout: dict)`: queues a downloaded workout for its track to be extracted
+  #### Notes
+  Tracks are named, written and recorded on the manifest the same way `extract_all_tracks` does, which skips them afterwards.
+  Workouts without a polyline aren't queued, so `extract_all_tracks` still reports them. Safe to submit workouts from several threads at once.
+  """
+
+  def __init__(self, strava_workouts: StravaWorkouts, tracks_dir: str, *, manifest: ArtifactManifest = None, gpx_writer: str = "stream",
+               workers: int = 1, queue_size: int = 64, chunk_size: int = 16, metrics = None, exports: TrackExports = None,
+               simplifier: TrackSimplifier = None, spatial_index: SpatialIndex = None):
+    """
+    #### Parameters
+    - `strava_workouts`: what to extract tracks with
+    - `tracks_dir`: folder where to place extracted tracks
+    - `manifest`: where to record extracted tracks. Optional
+    - `gpx_writer`: either `stream` or `gpxpy`. See `StravaWorkouts.write_gpx_from_polyline`
+    - `workers`: how many processes to extract tracks with. `1` extracts them on a thread of this process
+    - `queue_size`: how many workouts may be waiting for extraction before download workers are held back
+    - `chunk_size`: how many queued workouts to hand to a worker process at once, at most
+    - `metrics`: a `Metrics` to record extracted tracks on. Optional
+    - `exports`: other formats to export tracks in, besides gpx. Optional. Collections are finished once the pipeline is closed
+    - `simplifier`: the geometry stage to run tracks through before writing them. Optional. How much it shrank them is reported once closed
+    - `spatial_index`: where to index extracted tracks. Optional
+    """
+    self.strava_workouts = strava_workouts
+    self.tracks_dir = tracks_dir
+    self.manifest = manifest
+    self.gpx_writer = gpx_writer
+    self.workers = max(int(workers), 1)
+    self.chunk_size = max(int(chunk_size), 1)
+    self.metrics = metrics
+    self.exports = exports
+    self.simplifier = simplifier
+    self.spatial_index = spatial_index
+    self._points = [0, 0, 0]
+    self._queue = queue.Queue(maxsize=max(int(queue_size), 1))
+    self._extracted = set()
+    self._failed = 0
+    self._pool = None
+    self._thread = None
+
+  def start(self):
+    """
+    #### Description
+    Starts extracting workouts as they're submitted, on a background thread
+    #### Notes
+    Meant to be called before download workers are started, so worker processes are forked while this process has a single thread.
+    """
+    if self.workers > 1:
+      self._pool = ProcessPoolExecutor(max_workers=self.workers)
+      self._pool.submit(int).result()
+    self._thread = threading.Thread(target=self._run, name="track-pipeline", daemon=True)
+    self._thread.start()
+
+  def submit(self, workout_id: int, workout_name: str, workout: dict):
+    """
+    #### Description
+    Queues a downloaded workout for its track to be extracted. Waits for room on the queue if it's full
+    #### Parameters
+    - `workout_id`: the workout's ID
+    - `workout_name`: the workout's name, as it was stored with
+    - `workout`: the workout's data
+    """
+    workout_map = workout.get("map") or {}
+    workout_polyline = workout_map.get("polyline") or workout_map.get("summary_polyline")
+    if not workout_polyline:
+      return
+    gpx_file = f"{workout_id}-{helpers.sanitize_filename(self, filename=workout_name)}.gpx"
+    properties = self.exports.properties(workout) if self.exports is not None else None
+    self._queue.put(((int(workout_id), gpx_file, workout_polyline, f"{self.tracks_dir}/{gpx_file}", None), properties))
+
+  def extracted(self, workout_id: int) -> bool:
+    """
+    #### Description
+    Tells whether a workout's track was extracted by the pipeline
+    #### Parameters
+    - `workout_id`: the workout's ID
+    #### Returns
+    `True` if extracted, `False` otherwise
+    """
+    return int(workout_id) in self._extracted
+
+  def close(self):
+    """
+    #### Description
+    Waits for every queued workout to be extracted, then stops the pipeline and prints how it went
+    """
+    if self._thread is None:
+      return
+    self._queue.put(None)
+    self._thread.join()
+    self._thread = None
+    if self.manifest is not None:
+      self.manifest.commit()
+    if self.exports is not None:
+      self.exports.close(self.manifest)
+    if self.spatial_index is not None:
+      self.spatial_index.commit()
+    if self._extracted:
+      print(f"\033[92m✅ {len(self._extracted)} track{'s' if len(self._extracted) != 1 else ''} extracted while downloading\033[0m")
+      if self.simplifier is not None:
+        self.simplifier.report(decoded=self._points[0], written=self._points[1], written_bytes=self._points[2])
+    if self._failed > 0:
+      print(f"\033[91m🚫 Failed to extract {self._failed} track{'s' if self._failed != 1 else ''} while downloading. Retrying later on\033[0m")
+
+  def _next_batch(self) -> tuple:
+    # Waits for a workout, then takes whatever else is already queued, up to a chunk
+    batch = []
+    item = self._queue.get()
+    while item is not None:
+      batch.append(item)
+      if len(batch) >= self.chunk_size:
+        break
+      try:
+        item = self._queue.get_nowait()
+      except queue.Empty:
+        break
+    return batch, item is None
+
+  def _record(self, batch: list, results: list):
+    for (track, _), result in zip(batch, results):
+      if StravaWorkouts.record_extraction(self.strava_workouts, track=track, result=result, manifest=self.manifest, metrics=self.metrics,
+                                          exports=self.exports, spatial_index=self.spatial_index):
+        self._extracted.add(track[0])
+        self._points = [self._points[0] + result[6][0], self._points[1] + result[6][1], self._points[2] + result[1]]
+      else:
+        self._failed += 1
+
+  def _run(self):
+    # Extracts on this thread, or keeps up to one batch per worker process in flight
+    pool = self._pool
+    in_flight = deque()
+    done = False
+    try:
+      while not done:
+        batch, done = TrackPipeline._next_batch(self)
+        if not batch:
+          continue
+        args = ([x[0][2] for x in batch], [x[0][3] for x in batch], self.gpx_writer)
+        kwargs = {"exports": self.exports, "workout_properties": [x[1] for x in batch], "simplifier": self.simplifier,
+                  "bounds": TrackBounds() if self.spatial_index is not None else None}
+        if pool is None:
+          TrackPipeline._record(self, batch, self.strava_workouts.extract_tracks(*args, **kwargs))
+          continue
+        in_flight.append((batch, pool.submit(self.strava_workouts.extract_tracks, *args, **kwargs)))
+        while len(in_flight) > self.workers:
+          batch, future = in_flight.popleft()
+          TrackPipeline._record(self, batch, future.result())
+      while in_flight:
+        batch, future = in_flight.popleft()
+        TrackPipeline._record(self, batch, future.result())
+    except Exception as e: # pylint: disable=broad-exception-caught
+      # Tracks left unextracted are picked up by extract_all_tracks. Keep the queue moving, so download workers aren't held back forever
+      print(f"\033[91m🚫 Extracting tracks while downloading stopped ({e.__class__.__name__}: {e}). Retrying later on\033[0m")
+      while not done:
+        done = self._queue.get() is None
+    finally:
+      if pool is not None:
+        pool.shutdown(cancel_futures=True)
+        self._pool = None
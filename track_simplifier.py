@@ -0,0 +1,165 @@
+"""
+Track simplifier module, containing the geometry stage tracks go through between being decoded and being written.
+"""
+import heapq
+import math
+from array import array
+from itertools import compress, repeat
+from operator import mul, ne, or_
+
+class TrackSimplifier:
+  """
+  #### Description
+  This class shrinks decoded tracks before they're written, by rounding their coordinates, dropping consecutive duplicate points,
+  and simplifying them with either the Douglas-Peucker or the Visvalingam-Whyatt algorithm, within a tolerance in metres.
+  #### Available functions
+  - `report(decoded: int, written: int, written_bytes: int)`: prints how much tracks were shrunk
+  - `simplify(buffer) -> tuple`: runs a flat coordinate buffer through the stage
+  - `take(values, indices: list) -> array`: picks the values of a stream that go along with the points kept
+  #### Notes
+  Works on the same flat `[lat0, lon0, lat1, lon1, ...]` buffers `PolylineDecoder` decodes to, a whole column at a time, same as the decoder does.
+  Distances are measured on an equirectangular projection centered on each track, which is accurate to well under a metre at the scale of a workout.
+  The first and last points of a track are always kept.
+  """
+  METHODS = ["douglas_peucker", "visvalingam"]
+  EARTH_RADIUS = 6371008.8
+
+  def __init__(self, method: str = None, tolerance: float = 0.0, precision: int = None, drop_duplicates: bool = False):
+    """
+    #### Parameters
+    - `method`: either `douglas_peucker`, `visvalingam`, or `None` not to simplify tracks. Unknown ones are ignored
+    - `tolerance`: how far, in metres, simplified tracks may stray from the original one. For Visvalingam-Whyatt, points whose triangle
+    with their neighbours has an area under the tolerance squared are dropped
+    - `precision`: how many decimals to round coordinates to. `None` leaves them as they are. `5` is about a metre, and strava's polyline precision
+    - `drop_duplicates`: whether to drop points with the same coordinates as the one before. Checked after rounding
+    """
+    if method is not None and method not in TrackSimplifier.METHODS:
+      print(f"\033[93m⚠️  Unknown track simplification method \"{method}\". Tracks won't be simplified\033[0m")
+    self.method = method if method in TrackSimplifier.METHODS else None
+    self.tolerance = float(tolerance or 0.0)
+    self.precision = precision
+    self.drop_duplicates = drop_duplicates
+
+  def simplify(self, buffer) -> tuple:
+    """
+    #### Description
+    Runs a flat coordinate buffer through the stage: rounding, then dropping duplicates, then simplifying
+    #### Parameters
+    - `buffer`: a coordinate buffer, either an `array('d')` or a `memoryview` of one
+    #### Returns
+    A tuple containing the resulting `array('d')` and the indices of the points kept, in order. Indices are `None` if every point was kept.
+    Points missing their coordinates are never kept
+    """
+    view = memoryview(buffer)
+    lats, lons = array('d', view[0::2]), array('d', view[1::2])
+    if self.precision is not None:
+      lats = array('d', map(round, lats, repeat(self.precision)))
+      lons = array('d', map(round, lons, repeat(self.precision)))
+    kept = range(len(lats))
+    # Points missing their coordinates, as streams may have them, are left out, same as writers do. They'd make every distance NaN otherwise
+    if any(map(math.isnan, lats)) or any(map(math.isnan, lons)):
+      kept = [x for x in kept if not (math.isnan(lats[x]) or math.isnan(lons[x]))]
+    if self.drop_duplicates and len(kept) > 1:
+      kept_lats, kept_lons = list(map(lats.__getitem__, kept)), list(map(lons.__getitem__, kept))
+      moved = map(or_, map(ne, kept_lats[1:], kept_lats), map(ne, kept_lons[1:], kept_lons))
+      kept = [kept[0], *compress(kept[1:], moved)]
+    if self.method is not None and self.tolerance > 0 and len(kept) > 2:
+      scale = math.pi / 180 * TrackSimplifier.EARTH_RADIUS
+      ys = array('d', map(mul, map(lats.__getitem__, kept), repeat(scale)))
+      xs = array('d', map(mul, map(lons.__getitem__, kept), repeat(scale * math.cos(math.radians(sum(ys) / len(ys) / scale)))))
+      simplified = getattr(TrackSimplifier, f"_{self.method}")(self, xs, ys)
+      kept = list(map(kept.__getitem__, simplified))
+
+    result = array('d', bytes(16 * len(kept)))
+    result[0::2] = array('d', map(lats.__getitem__, kept))
+    result[1::2] = array('d', map(lons.__getitem__, kept))
+    return result, None if len(kept) == len(lats) else list(kept)
+
+  def report(self, decoded: int, written: int, written_bytes: int):
+    """
+    #### Description
+    Prints how much tracks were shrunk by the stage
+    #### Parameters
+    - `decoded`: how many points the tracks had once decoded
+    - `written`: how many points were written
+    - `written_bytes`: how many bytes the gpx files written take
+    """
+    dropped = 1 - written / decoded if decoded else 0.0
+    # Gpx files grow about linearly with their points, which is what the estimate goes by
+    saved = written_bytes * (decoded / written - 1) if written else 0
+    print(f"\033[94m✂️  Kept {written} of {decoded} track points ({dropped:.1%} fewer). {written_bytes / 1048576:.1f} MB written, " \
+          f"about {saved / 1048576:.1f} MB less than unsimplified\033[0m")
+
+  def take(self, values, indices: list) -> array:
+    """
+    #### Description
+    Picks the values of a stream, such as elevation or heart rate, that go along with the points kept
+    #### Parameters
+    - `values`: the stream's values, one per point of the original track
+    - `indices`: indices of the points kept, as returned by `simplify`. `None` keeps them all
+    #### Returns
+    The values picked, on an `array` of the same type if `values` is one
+    """
+    if indices is None:
+      return values
+    if isinstance(values, array):
+      return array(values.typecode, map(values.__getitem__, indices))
+    return list(map(values.__getitem__, indices))
+
+  def _douglas_peucker(self, xs: array, ys: array) -> list:
+    # Iterative, so long tracks don't run out of stack. Squared distances spare a square root per point
+    tolerance = self.tolerance * self.tolerance
+    kept = bytearray(len(xs))
+    kept[0] = kept[-1] = 1
+    stack = [(0, len(xs) - 1)]
+    while stack:
+      first, last = stack.pop()
+      if last - first < 2:
+        continue
+      distances = TrackSimplifier._segment_distances(self, xs, ys, first, last)
+      farthest = max(range(len(distances)), key=distances.__getitem__)
+      if distances[farthest] > tolerance:
+        split = first + 1 + farthest
+        kept[split] = 1
+        stack.append((first, split))
+        stack.append((split, last))
+    return list(compress(range(len(xs)), kept))
+
+  def _segment_distances(self, xs: array, ys: array, first: int, last: int) -> list:
+    # Squared distances to the segment, not to its line, so the far end of an out-and-back isn't mistaken for being on the way.
+    # Loops end where they start, so they're measured to that point
+    ax, ay = xs[first], ys[first]
+    dx, dy = xs[last] - ax, ys[last] - ay
+    length = dx * dx + dy * dy
+    inverse = 1 / length if length else 0.0
+    return [(x - ax - (t := min(max(((x - ax) * dx + (y - ay) * dy) * inverse, 0.0), 1.0)) * dx) ** 2 + (y - ay - t * dy) ** 2
+            for x, y in zip(xs[first + 1:last], ys[first + 1:last])]
+
+  def _visvalingam(self, xs: array, ys: array) -> list:
+    # Drops the point with the smallest triangle until none is under the threshold. Stale heap entries are told apart by their area
+    count = len(xs)
+    previous, following = list(range(-1, count - 1)), list(range(1, count + 1))
+
+    def area(index: int) -> float:
+      a, c = previous[index], following[index]
+      return abs((xs[a] - xs[index]) * (ys[c] - ys[index]) - (xs[c] - xs[index]) * (ys[a] - ys[index])) / 2
+
+    areas = [math.inf] + [area(x) for x in range(1, count - 1)] + [math.inf]
+    heap = [(areas[x], x) for x in range(1, count - 1)]
+    heapq.heapify(heap)
+    removed = bytearray(count)
+    while heap:
+      smallest, index = heapq.heappop(heap)
+      if removed[index] or smallest != areas[index]:
+        continue
+      if smallest >= self.tolerance * self.tolerance:
+        break
+      removed[index] = 1
+      a, c = previous[index], following[index]
+      following[a], previous[c] = c, a
+      for neighbour in (a, c):
+        if 0 < neighbour < count - 1:
+          # Neighbours never get a smaller area than the point just dropped, so they're dropped in order
+          areas[neighbour] = max(area(neighbour), smallest)
+          heapq.heappush(heap, (areas[neighbour], neighbour))
+    return [x for x in range(count) if not removed[x]]
@@ -0,0 +1,435 @@
+"""
+Webhook module, containing the receiver for strava's push subscription events, the durable queue they're kept on, and the worker syncing them.
+"""
+import json
+import os
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+from helpers import Helpers as helpers
+from state_store import Database, StateStore
+from artifact_manifest import ArtifactManifest
+from rate_limiter import RateLimiter
+from strava_workouts import StravaWorkouts
+from track_exports import TrackExports
+from track_simplifier import TrackSimplifier
+from spatial_index import SpatialIndex, TrackBounds
+
+class EventQueue(Database):
+  """
+  #### Description
+  This class keeps strava's push subscription events on a SQLite database until they're synced, so none is lost if the exporter stops before getting to them.
+  #### Available functions
+  - `commit()`: does nothing. Every change is written right away
+  - `complete(event_id: int)`: flags an event as synced
+  - `counts() -> dict`: returns how many events are on each state
+  - `fail(event_id: int)`: returns an event to the queue, or gives up on it once it failed too many times
+  - `pending(count: int = 50, after: int = 0) -> list`: returns the oldest events still to be synced
+  - `put(event: dict) -> int`: adds an event to the queue
+  #### Notes
+  Events are `pending`, `done` or `failed`. They're synced in the order they were received, and stay `pending` while being synced,
+  so any left half done are synced again on the next start. Syncing an event twice does no harm.
+  """
+
+  def __init__(self, db_file: str, max_attempts: int = 3):
+    """
+    #### Parameters
+    - `db_file`: full path to the database file. Created if missing
+    - `max_attempts`: how many times an event may fail before giving up on it
+    """
+    super().__init__(db_file=db_file)
+    self._max_attempts = max_attempts
+    self._db.execute("CREATE TABLE IF NOT EXISTS webhook_events (event_id INTEGER PRIMARY KEY AUTOINCREMENT, object_type TEXT NOT NULL, " \
+                     "object_id INTEGER NOT NULL, aspect_type TEXT NOT NULL, owner_id INTEGER, updates TEXT, event_time INTEGER, " \
+                     "received_at INTEGER NOT NULL, state TEXT NOT NULL, attempts INTEGER NOT NULL DEFAULT 0)")
+    self._db.execute("CREATE INDEX IF NOT EXISTS webhook_events_state ON webhook_events (state, event_id)")
+
+  def put(self, event: dict) -> int:
+    """
+    #### Description
+    Adds an event to the queue. It's on disk by the time this returns
+    #### Parameters
+    - `event`: the event, as posted by strava
+    #### Returns
+    The event's ID on the queue
+    """
+    with self._lock, self._transaction():
+      return self._db.execute("INSERT INTO webhook_events (object_type, object_id, aspect_type, owner_id, updates, event_time, received_at, state) " \
+                              "VALUES (?, ?, ?, ?, ?, ?, ?, 'pending')",
+                              (event["object_type"], int(event["object_id"]), event["aspect_type"], event.get("owner_id"),
+                               json.dumps(event.get("updates") or {}), event.get("event_time"), int(time.time()))).lastrowid
+
+  def pending(self, count: int = 50, after: int = 0) -> list:
+    """
+    #### Description
+    Returns the oldest events still to be synced
+    #### Parameters
+    - `count`: how many events to return at most
+    - `after`: only return events queued after the one with this ID
+    #### Returns
+    A list of dicts holding each event's `event_id`, `object_type`, `object_id`, `aspect_type`, `owner_id` and `updates`, oldest first
+    """
+    with self._lock:
+      rows = self._db.execute("SELECT event_id, object_type, object_id, aspect_type, owner_id, updates FROM webhook_events " \
+                              "WHERE state = 'pending' AND event_id > ? ORDER BY event_id LIMIT ?", (int(after), int(count))).fetchall()
+    return [{"event_id": x[0], "object_type": x[1], "object_id": x[2], "aspect_type": x[3], "owner_id": x[4], "updates": json.loads(x[5])} for x in rows]
+
+  def complete(self, event_id: int):
+    """
+    #### Description
+    Flags an event as synced
+    #### Parameters
+    - `event_id`: the event's ID on the queue
+    """
+    with self._lock:
+      self._db.execute("UPDATE webhook_events SET state = 'done' WHERE event_id = ?", (int(event_id),))
+
+  def fail(self, event_id: int):
+    """
+    #### Description
+    Returns an event to the queue, so it's retried later on, or gives up on it once it failed too many times
+    #### Parameters
+    - `event_id`: the event's ID on the queue
+    """
+    with self._lock:
+      self._db.execute("UPDATE webhook_events SET state = CASE WHEN attempts + 1 >= ? THEN 'failed' ELSE 'pending' END, attempts = attempts + 1 " \
+                       "WHERE event_id = ?", (self._max_attempts, int(event_id)))
+
+  def counts(self) -> dict:
+    """
+    #### Description
+    Returns how many events are on each state
+    #### Returns
+    A dict where its key is the state and its value the amount of events on it
+    """
+    result = {"pending": 0, "done": 0, "failed": 0}
+    with self._lock:
+      result.update(self._db.execute("SELECT state, COUNT(*) FROM webhook_events GROUP BY state").fetchall())
+    return result
+
+  def commit(self):
+    """
+    #### Description
+    Does nothing. Every change is written right away
+    """
+
+# Where to listen, and what to do with what's received.
+# pylint: disable=too-many-instance-attributes
+class WebhookReceiver:
+  """
+  #### Description
+  This class serves the callback URL of strava's push subscriptions. Events posted to it are put on an `EventQueue`, then acknowledged right away,
+  since strava only waits two seconds for them to be. Subscription validation requests are answered too.
+  #### Available functions
+  - `start() -> str`: starts serving on a background thread, and returns the callback URL
+  - `stop()`: stops serving
+  #### Notes
+  Push subscriptions are per app, so events of every athlete authorizing it are posted. Only those of `athlete_id` are queued, if set.
+  Malformed events get a `400`, so they show up on strava's side.
+  """
+
+  def __init__(self, event_queue: EventQueue, host: str = "0.0.0.0", port: int = 8080, path: str = "/webhook", *,
+               verify_token: str = None, athlete_id: int = None, on_event = None):
+    """
+    #### Parameters
+    - `event_queue`: where to put received events
+    - `host`: address to listen on
+    - `port`: port to listen on. `0` picks a free one
+    - `path`: path the callback URL is served on
+    - `verify_token`: token the subscription was created with. Validation requests carrying any other are rejected, as are all of them if not set
+    - `athlete_id`: athlete to queue events of. Optional. Events of every athlete are queued if not set
+    - `on_event`: called with no arguments once an event is queued, such as `WebhookWorker.notify`. Optional
+    """
+    self.event_queue = event_queue
+    self.host = host
+    self.port = port
+    self.path = path
+    self.verify_token = verify_token
+    self.athlete_id = athlete_id
+    self.on_event = on_event
+    self._server = None
+    self._thread = None
+
+  def start(self) -> str:
+    """
+    #### Description
+    Starts serving on a background thread
+    #### Returns
+    The callback URL, such as `http://0.0.0.0:8080/webhook`
+    """
+    self._server = ThreadingHTTPServer((self.host, self.port), _make_handler(self))
+    self._server.daemon_threads = True
+    self.port = self._server.server_address[1]
+    self._thread = threading.Thread(target=self._server.serve_forever, name="webhook-receiver", daemon=True)
+    self._thread.start()
+    return f"http://{self.host}:{self.port}{self.path}"
+
+  def stop(self):
+    """
+    #### Description
+    Stops serving. Events already queued are kept
+    """
+    if self._server is not None:
+      self._server.shutdown()
+      self._server.server_close()
+      self._thread.join()
+      self._server, self._thread = None, None
+
+  def _validate(self, query: dict) -> tuple:
+    # Strava sends a GET with a challenge when creating the subscription, and expects it echoed back
+    if query.get("hub.mode") != ["subscribe"] or self.verify_token is None or query.get("hub.verify_token") != [self.verify_token]:
+      print("\033[91m🚫 Rejected a push subscription validation request. Check \"webhook_verify_token\" matches the subscription's\033[0m", flush=True)
+      return 403, {"message": "Forbidden"}
+    print("\033[92m✅ Push subscription validated\033[0m", flush=True)
+    return 200, {"hub.challenge": query.get("hub.challenge", [""])[0]}
+
+  def _receive(self, body: bytes) -> tuple:
+    try:
+      event = json.loads(body)
+      if event["object_type"] not in ("activity", "athlete") or event["aspect_type"] not in ("create", "update", "delete"):
+        raise ValueError(f"unknown event {event['object_type']}:{event['aspect_type']}")
+      int(event["object_id"])
+    except (ValueError, KeyError, TypeError) as e:
+      print(f"\033[93m🟡 Ignored a malformed push event ({e.__class__.__name__}: {e})\033[0m", flush=True)
+      return 400, {"message": "Bad Request"}
+    if self.athlete_id is not None and event.get("owner_id") is not None and int(event["owner_id"]) != int(self.athlete_id):
+      return 200, {}
+    self.event_queue.put(event)
+    if self.on_event is not None:
+      self.on_event()
+    return 200, {}
+
+def _make_handler(receiver: WebhookReceiver):
+  class RequestHandler(BaseHTTPRequestHandler):
+    """
+    Request handler for strava's push subscription requests
+    """
+    def log_message(self, format, *args):
+      # Suppress logging by overriding the log_message method
+      pass
+
+    def do_GET(self):
+      """
+      Answers subscription validation requests
+      """
+      url = urlparse(self.path)
+      if url.path != receiver.path:
+        self._reply(404, {"message": "Not Found"})
+        return
+      self._reply(*receiver._validate(parse_qs(url.query)))
+
+    def do_POST(self):
+      """
+      Queues posted events
+      """
+      body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+      if urlparse(self.path).path != receiver.path:
+        self._reply(404, {"message": "Not Found"})
+        return
+      self._reply(*receiver._receive(body))
+
+    def _reply(self, status: int, payload: dict):
+      data = json.dumps(payload).encode()
+      self.send_response(status)
+      self.send_header("Content-Type", "application/json; charset=utf-8")
+      self.send_header("Content-Length", str(len(data)))
+      self.end_headers()
+      self.wfile.write(data)
+
+  return RequestHandler
+
+# Everything syncing an event touches, plus what wakes the worker up.
+# pylint: disable=too-many-instance-attributes
+class WebhookWorker:
+  """
+  #### Description
+  This class syncs the events on an `EventQueue`, as they come in. Only the workout each event is about gets downloaded, instead of listing them all.
+  Created and updated workouts are downloaded, and their tracks extracted again, along with their exports. Deleted ones get their track removed.
+  #### Available functions
+  - `notify()`: wakes the worker up, so it syncs events queued since
+  - `process(event: dict) -> str`: syncs a single event
+  - `run() -> bool`: syncs events as they're queued, until stopped
+  - `run_pending() -> int`: syncs every event queued so far
+  - `stop()`: stops the worker once done with the event being synced
+  - `submit(workout_id: int, workout_name: str, workout: dict)`: extracts a downloaded workout's track
+  #### Notes
+  Workouts deleted on strava are kept on the workouts folder, same as when found missing on a full listing. Only their track is removed.
+  An athlete deauthorizing the app stops the worker, since there's nothing it can sync from then on.
+  """
+
+  def __init__(self, strava_workouts: StravaWorkouts, event_queue: EventQueue, *, storage, state_store: StateStore, manifest: ArtifactManifest,
+               tracks_dir: str, access_token: str, rate_limiter: RateLimiter = None, gpx_writer: str = "stream", poll_interval: int = 60, metrics = None,
+               exports: TrackExports = None, simplifier: TrackSimplifier = None, spatial_index: SpatialIndex = None):
+    """
+    #### Parameters
+    - `strava_workouts`: what to download workouts and extract tracks with
+    - `event_queue`: where to take events from
+    - `storage`: where to store workouts, either a `WorkoutFiles` or a `WorkoutArchive`
+    - `state_store`: sync state, where downloaded workouts are flagged, and their fingerprints kept
+    - `manifest`: where extracted tracks are recorded
+    - `tracks_dir`: folder where to place extracted tracks
+    - `access_token`: strava's access token
+    - `rate_limiter`: ratelimit budget to draw from. Optional
+    - `gpx_writer`: either `stream` or `gpxpy`. See `StravaWorkouts.write_gpx_from_polyline`
+    - `poll_interval`: seconds between checks for events queued without a `notify`, such as by another process
+    - `metrics`: a `Metrics` to record extracted tracks on. Optional
+    - `exports`: other formats to export tracks in, besides gpx. Optional. Collections are finished after every batch of events
+    - `simplifier`: the geometry stage to run tracks through before writing them. Optional
+    - `spatial_index`: where to index extracted tracks. Optional. Tracks removed are dropped from it
+    """
+    self.strava_workouts = strava_workouts
+    self.event_queue = event_queue
+    self.storage = storage
+    self.state_store = state_store
+    self.manifest = manifest
+    self.tracks_dir = tracks_dir
+    self.headers = {'Authorization': f'Bearer {access_token}'}
+    self.rate_limiter = rate_limiter if rate_limiter is not None else RateLimiter()
+    self.gpx_writer = gpx_writer
+    self.poll_interval = poll_interval
+    self.metrics = metrics
+    self.exports = exports
+    self.simplifier = simplifier
+    self.spatial_index = spatial_index
+    self.deauthorized = False
+    self._wake = threading.Event()
+    self._stopped = False
+
+  def notify(self):
+    """
+    #### Description
+    Wakes the worker up, so it syncs events queued since. Safe to be called from any thread
+    """
+    self._wake.set()
+
+  def stop(self):
+    """
+    #### Description
+    Stops the worker once done with the event being synced. Safe to be called from any thread
+    """
+    self._stopped = True
+    self._wake.set()
+
+  def process(self, event: dict) -> str:
+    """
+    #### Description
+    Syncs a single event
+    #### Parameters
+    - `event`: the event, as returned by `EventQueue.pending`
+    #### Returns
+    `"done"` if synced or nothing to do, `"failed"` if it couldn't be, `"daily_limit"` if the daily ratelimit was reached first,
+    or `"deauthorized"` if the athlete deauthorized the app
+    """
+    if event["object_type"] == "athlete":
+      if str(event["updates"].get("authorized", "")).lower() == "false":
+        return "deauthorized"
+      return "done"
+
+    workout_id = int(event["object_id"])
+    if event["aspect_type"] == "delete":
+      WebhookWorker._remove_track(self, workout_id)
+      self.state_store.forget(workout_id)
+      print(f"🗑️  Activity {workout_id} was deleted on strava. Its track was removed")
+      return "done"
+
+    status = self.strava_workouts.download_workout(self.storage, workout_id, None, self.headers, self.rate_limiter, pipeline=self)
+    if status == "downloaded":
+      self.state_store.mark_downloaded(workout_id)
+      self.state_store.commit()
+      return "done"
+    return status
+
+  def submit(self, workout_id: int, workout_name: str, workout: dict):
+    """
+    #### Description
+    Extracts a downloaded workout's track, replacing its previous one, and records its fingerprint, so the next listing doesn't download it again.
+    `StravaWorkouts.download_workout` hands workouts over to it, same as to a `TrackPipeline`
+    #### Parameters
+    - `workout_id`: the workout's ID
+    - `workout_name`: the workout's name, as it was stored with
+    - `workout`: the workout's data
+    """
+    self.state_store.write_fingerprints({int(workout_id): StravaWorkouts.get_fingerprint(self.strava_workouts, summary=workout)})
+    previous = [self.manifest.get(workout_id, kind=x) for x in ["gpx", *TrackExports.FORMATS]]
+    workout_map = workout.get("map") or {}
+    workout_polyline = workout_map.get("polyline") or workout_map.get("summary_polyline")
+    if not workout_polyline:
+      WebhookWorker._remove_track(self, workout_id)
+      return
+    gpx_file = f"{workout_id}-{helpers.sanitize_filename(self, filename=workout_name)}.gpx"
+    track = (int(workout_id), gpx_file, workout_polyline, f"{self.tracks_dir}/{gpx_file}", None)
+    properties = [self.exports.properties(workout)] if self.exports is not None else None
+    result = self.strava_workouts.extract_tracks([track[2]], [track[3]], self.gpx_writer, exports=self.exports, workout_properties=properties,
+                                                 simplifier=self.simplifier, bounds=TrackBounds() if self.spatial_index is not None else None)[0]
+    if StravaWorkouts.record_extraction(self.strava_workouts, track=track, result=result, manifest=self.manifest, metrics=self.metrics, exports=self.exports,
+                                        spatial_index=self.spatial_index):
+      self.manifest.commit()
+      if self.spatial_index is not None:
+        self.spatial_index.commit()
+      # A renamed workout gets a new track name, so get rid of the old one, and its exports
+      current = {x[0] for x in result[5].values()} | {track[3]}
+      for artifact in previous:
+        if artifact is not None and artifact["path"] not in current and os.path.dirname(artifact["path"]) == self.tracks_dir and os.path.exists(artifact["path"]):
+          os.remove(artifact["path"])
+
+  def run_pending(self) -> int:
+    """
+    #### Description
+    Syncs every event queued so far, oldest first. Events that fail are retried on the next call
+    #### Returns
+    How many events were synced, successfully or not
+    """
+    synced, last = 0, 0
+    while not self._stopped:
+      events = self.event_queue.pending(after=last)
+      if not events:
+        break
+      for event in events:
+        last = event["event_id"]
+        status = WebhookWorker.process(self, event)
+        match status:
+          case "done":
+            self.event_queue.complete(event["event_id"])
+          case "deauthorized":
+            self.event_queue.complete(event["event_id"])
+            print("\033[91m🚫 The athlete deauthorized this app on strava. Stopping\033[0m", flush=True)
+            self.deauthorized, self._stopped = True, True
+            return synced + 1
+          case "daily_limit":
+            # Left on the queue. Nothing else can be synced until tomorrow
+            wait = helpers.seconds_to_next_window(self, window=86400) + 1
+            print(f"\033[91m💥 Daily ratelimit reached! Resuming in {helpers.format_duration(self, wait)}\033[0m", flush=True)
+            self._wake.wait(wait)
+            return synced
+          case _:
+            self.event_queue.fail(event["event_id"])
+        synced += 1
+        if self._stopped:
+          break
+    return synced
+
+  def run(self) -> bool:
+    """
+    #### Description
+    Syncs events as they're queued, until stopped
+    #### Returns
+    `True` if stopped because the athlete deauthorized the app, `False` otherwise
+    """
+    while not self._stopped:
+      self._wake.clear()
+      WebhookWorker.run_pending(self)
+      if self.exports is not None:
+        self.exports.close(self.manifest)
+      if not self._stopped:
+        self._wake.wait(self.poll_interval)
+    return self.deauthorized
+
+  def _remove_track(self, workout_id: int):
+    for kind in ["gpx", *TrackExports.FORMATS]:
+      artifact = self.manifest.get(workout_id, kind=kind)
+      if artifact is not None and os.path.dirname(artifact["path"]) == self.tracks_dir and os.path.exists(artifact["path"]):
+        os.remove(artifact["path"])
+    self.manifest.forget(workout_id)
+    if self.spatial_index is not None:
+      self.spatial_index.forget(workout_id)
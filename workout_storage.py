@@ -0,0 +1,516 @@
+"""
+Workout storage module, containing the backends workouts can be stored on.
+"""
+import gzip
+import json
+import mmap
+import os
+import struct
+import sys
+import threading
+import zlib
+from array import array
+from helpers import Helpers as helpers
+
+# A projection only needs to be applied.
+# pylint: disable=too-few-public-methods
+class FieldProjection:
+  """
+  #### Description
+  This class trims workouts down to the fields we care about, before storing them.
+  Fields are given as dotted paths, such as `map.polyline`. Paths going through lists apply to each of their items, so `laps.distance` keeps or drops every lap's distance.
+  #### Available functions
+  - `apply(workout: dict) -> dict`: returns a trimmed copy of a workout
+  #### Notes
+  Fields needed for extracting tracks and naming files (`id`, `name`, `start_date`, `map.polyline` and `map.summary_polyline`) are always kept.
+  """
+  REQUIRED_FIELDS = ["id", "name", "start_date", "map.polyline", "map.summary_polyline"]
+
+  def __init__(self, keep: list = None, drop: list = None):
+    """
+    #### Parameters
+    - `keep`: if set, only these fields are kept, plus the required ones
+    - `drop`: fields to be removed. Paths leading to a required field are ignored
+    """
+    self._keep = FieldProjection._tree(self, (keep or []) + FieldProjection.REQUIRED_FIELDS) if keep else None
+    self._drop = FieldProjection._tree(self, [x for x in (drop or []) if not any(f"{y}.".startswith(f"{x}.") for y in FieldProjection.REQUIRED_FIELDS)])
+
+  def apply(self, workout: dict) -> dict:
+    """
+    #### Description
+    Returns a trimmed copy of a workout
+    #### Parameters
+    - `workout`: the workout's data
+    #### Returns
+    The workout, with only the selected fields on it
+    """
+    if self._keep is not None:
+      workout = FieldProjection._apply_keep(self, workout, self._keep)
+    if self._drop:
+      workout = FieldProjection._apply_drop(self, workout, self._drop)
+    return workout
+
+  def _tree(self, paths: list) -> dict:
+    # ["map.polyline", "laps"] -> {"map": {"polyline": None}, "laps": None}. None stands for the whole field
+    tree = {}
+    for path in paths:
+      node = tree
+      keys = path.split(".")
+      for key in keys[:-1]:
+        if key in node and node[key] is None:
+          break
+        node = node.setdefault(key, {})
+      else:
+        node[keys[-1]] = None
+    return tree
+
+  def _apply_keep(self, value, tree: dict):
+    if tree is None:
+      return value
+    if isinstance(value, list):
+      return [FieldProjection._apply_keep(self, x, tree) for x in value]
+    if isinstance(value, dict):
+      return {k: FieldProjection._apply_keep(self, value[k], v) for k, v in tree.items() if k in value}
+    return value
+
+  def _apply_drop(self, value, tree: dict):
+    if isinstance(value, list):
+      return [FieldProjection._apply_drop(self, x, tree) for x in value]
+    if isinstance(value, dict):
+      result = {}
+      for k, v in value.items():
+        if k not in tree:
+          result[k] = v
+        elif tree[k] is not None:
+          result[k] = FieldProjection._apply_drop(self, v, tree[k])
+      return result
+    return value
+
+class WorkoutFiles:
+  """
+  #### Description
+  This class stores each workout on its own JSON file, named `{workout ID}-{workout name}.json`. This is the default storage.
+  Files can be written pretty-printed (the default), as compact JSON, or as gzip-compressed compact JSON (named `.json.gz`).
+  #### Available functions
+  - `close()`: releases any resources held by the storage
+  - `index() -> dict`: returns a dict where its key is the `workout ID` and its value the workout's file name, without extension
+  - `iter_workouts()`: yields a `(workout ID, file name, workout)` tuple for each stored workout
+  - `load(workout_id: int) -> dict`: loads a stored workout
+  - `save(workout_id: int, workout_name: str, workout: dict)`: stores a workout, replacing any previous version of it
+  #### Notes
+  Safe to be used from several threads at once, as download workers do.
+  """
+
+  def __init__(self, workdir: str, projection: FieldProjection = None, serialization: str = "pretty"):
+    """
+    #### Parameters
+    - `workdir`: folder where workout files are stored
+    - `projection`: fields to keep on stored workouts. Optional, keeps them all by default
+    - `serialization`: either `pretty`, `compact` or `gzip`
+    """
+    self.workdir = workdir
+    self._projection = projection
+    self._serialization = serialization
+    self._lock = threading.Lock()
+    self._index = None
+
+  def save(self, workout_id: int, workout_name: str, workout: dict):
+    """
+    #### Description
+    Stores a workout, replacing any previous version of it
+    #### Parameters
+    - `workout_id`: the workout's ID
+    - `workout_name`: the workout's name. Used for naming its file
+    - `workout`: the workout's data
+    """
+    if self._projection is not None:
+      workout = self._projection.apply(workout)
+    with self._lock:
+      previous = WorkoutFiles._index_locked(self).get(int(workout_id))
+    stem = f"{workout_id}-{helpers.sanitize_filename(self, filename=workout_name)}"
+    match self._serialization:
+      case "gzip":
+        filename = f"{stem}.json.gz"
+        with gzip.open(f"{self.workdir}/{filename}", 'wt', encoding="utf8") as f:
+          json.dump(workout, f, separators=(",", ":"))
+      case "compact":
+        filename = f"{stem}.json"
+        with open(f"{self.workdir}/{filename}", 'w', encoding="utf8") as f:
+          json.dump(workout, f, separators=(",", ":"))
+      case _:
+        filename = f"{stem}.json"
+        with open(f"{self.workdir}/{filename}", 'w', encoding="utf8") as f:
+          json.dump(workout, f, indent=2)
+    with self._lock:
+      # A renamed workout gets a new file name, so get rid of the old one
+      if previous is not None and previous != filename and os.path.exists(f"{self.workdir}/{previous}"):
+        os.remove(f"{self.workdir}/{previous}")
+      self._index[int(workout_id)] = filename
+
+  def load(self, workout_id: int) -> dict:
+    """
+    #### Description
+    Loads a stored workout
+    #### Parameters
+    - `workout_id`: the workout's ID
+    #### Returns
+    A dict containing the workout's data
+    """
+    with self._lock:
+      filename = f"{self.workdir}/{WorkoutFiles._index_locked(self)[int(workout_id)]}"
+    if filename.endswith(".gz"):
+      with gzip.open(filename, mode="rt", encoding="utf8") as f:
+        return json.load(f)
+    with open(filename, mode="r", encoding="utf8") as f:
+      return json.load(f)
+
+  def index(self) -> dict:
+    """
+    #### Description
+    Returns all stored workouts
+    #### Returns
+    A `dict` where its `key` is the `workout ID` and its `value` the workout's file name, without extension
+    """
+    with self._lock:
+      return {k: v.removesuffix(".gz").removesuffix(".json") for k, v in WorkoutFiles._index_locked(self).items()}
+
+  def iter_workouts(self):
+    """
+    #### Description
+    Yields a `(workout ID, file name, workout)` tuple for each stored workout
+    """
+    for workout_id, stem in self.index().items():
+      yield workout_id, stem, self.load(workout_id)
+
+  def close(self):
+    """
+    #### Description
+    Releases any resources held by the storage. Nothing to do for plain files
+    """
+
+  def _index_locked(self) -> dict:
+    # Built on first use, then kept up to date by save. Only published once whole, so no worker ever sees it half-built
+    if self._index is None:
+      found = {}
+      for filename in os.listdir(self.workdir):
+        workout_id = filename.split("-", 1)[0].strip()
+        if filename.endswith((".json", ".json.gz")) and workout_id.isdigit():
+          found[int(workout_id)] = filename
+      self._index = found
+    return self._index
+
+# Index entries are followed by the workout's file name, encoded as utf-8
+# (workout ID, segment number, offset, length, file name length)
+_INDEX_ENTRY = struct.Struct("<qIQIH")
+
+# The archive keeps its segment and index files open for as long as it's in use.
+# pylint: disable=too-many-instance-attributes, consider-using-with
+class WorkoutArchive:
+  """
+  #### Description
+  This class packs workouts into a few large segment files, each workout stored as a zlib-compressed, compact JSON record.
+  An append-only index maps each workout ID to its record's segment and offset, so any workout can be read without scanning the archive.
+  #### Available functions
+  - `close()`: closes all open segment and index files
+  - `export_files(dest_dir: str) -> int`: writes every archived workout to `dest_dir` on the per-file layout
+  - `import_files(src_dir: str) -> int`: packs every workout on the per-file layout found on `src_dir` into the archive
+  - `index() -> dict`: returns a dict where its key is the `workout ID` and its value the workout's file name, without extension
+  - `iter_workouts()`: yields a `(workout ID, file name, workout)` tuple for each archived workout, in storage order
+  - `load(workout_id: int) -> dict`: loads an archived workout
+  - `save(workout_id: int, workout_name: str, workout: dict)`: archives a workout, replacing any previous version of it
+  #### Notes
+  Files live on `{workdir}/archive`. Replaced workouts leave their previous record behind on its segment, as segments are append-only.
+  """
+
+  def __init__(self, workdir: str, segment_size: int = 64 * 1024 * 1024, projection: FieldProjection = None):
+    """
+    #### Parameters
+    - `workdir`: folder where the archive is to be stored
+    - `segment_size`: size, in bytes, after which a new segment file is started
+    - `projection`: fields to keep on archived workouts. Optional, keeps them all by default
+    """
+    self._projection = projection
+    self.archive_dir = f"{workdir}/archive"
+    os.makedirs(self.archive_dir, exist_ok=True)
+    self._segment_size = segment_size
+    self._lock = threading.Lock()
+    self._index = {}
+    self._maps = {}
+    self._segment = 1
+    self._load_index()
+    self._writer = open(self._segment_file(self._segment), mode="ab")
+    self._index_writer = open(f"{self.archive_dir}/index.bin", mode="ab")
+
+  def save(self, workout_id: int, workout_name: str, workout: dict):
+    """
+    #### Description
+    Archives a workout, replacing any previous version of it
+    #### Parameters
+    - `workout_id`: the workout's ID
+    - `workout_name`: the workout's name. Used for naming its file when exported
+    - `workout`: the workout's data
+    #### Notes
+    Safe to be called from several threads at once.
+    """
+    if self._projection is not None:
+      workout = self._projection.apply(workout)
+    record = zlib.compress(json.dumps(workout, separators=(",", ":")).encode("utf-8"))
+    stem = f"{workout_id}-{helpers.sanitize_filename(self, filename=workout_name)}"
+    encoded_stem = stem.encode("utf-8")
+
+    with self._lock:
+      offset = self._writer.tell()
+      if offset > 0 and offset + len(record) > self._segment_size:
+        self._writer.close()
+        self._segment += 1
+        self._writer = open(self._segment_file(self._segment), mode="ab")
+        offset = 0
+      # Data goes first, so the index never points to a record that isn't there
+      self._writer.write(record)
+      self._writer.flush()
+      self._index_writer.write(_INDEX_ENTRY.pack(int(workout_id), self._segment, offset, len(record), len(encoded_stem)) + encoded_stem)
+      self._index_writer.flush()
+      self._index[int(workout_id)] = (self._segment, offset, len(record), stem)
+
+  def load(self, workout_id: int) -> dict:
+    """
+    #### Description
+    Loads an archived workout
+    #### Parameters
+    - `workout_id`: the workout's ID
+    #### Returns
+    A dict containing the workout's data
+    """
+    with self._lock:
+      segment, offset, length, _ = self._index[int(workout_id)]
+      record = self._map(segment, offset + length)[offset:offset + length]
+    return json.loads(zlib.decompress(record))
+
+  def index(self) -> dict:
+    """
+    #### Description
+    Returns all archived workouts
+    #### Returns
+    A `dict` where its `key` is the `workout ID` and its `value` the workout's file name, without extension
+    """
+    with self._lock:
+      return {k: v[3] for k, v in self._index.items()}
+
+  def iter_workouts(self):
+    """
+    #### Description
+    Yields a `(workout ID, file name, workout)` tuple for each archived workout, in storage order
+    #### Notes
+    Segments are read sequentially, so this is the fastest way of going through the whole archive.
+    """
+    with self._lock:
+      entries = sorted(self._index.items(), key=lambda x: x[1][:2])
+    for workout_id, (segment, offset, length, stem) in entries:
+      with self._lock:
+        record = self._map(segment, offset + length)[offset:offset + length]
+      yield workout_id, stem, json.loads(zlib.decompress(record))
+
+  def export_files(self, dest_dir: str) -> int:
+    """
+    #### Description
+    Writes every archived workout to `dest_dir` on the per-file layout, as `{workout ID}-{workout name}.json`
+    #### Parameters
+    - `dest_dir`: folder where workout files are to be written
+    #### Returns
+    The amount of workouts exported
+    """
+    os.makedirs(dest_dir, exist_ok=True)
+    exported = 0
+    for _, stem, workout in self.iter_workouts():
+      with open(f"{dest_dir}/{stem}.json", 'w', encoding="utf8") as f:
+        json.dump(workout, f, indent=2)
+      exported += 1
+    return exported
+
+  def import_files(self, src_dir: str) -> int:
+    """
+    #### Description
+    Packs every workout on the per-file layout found on `src_dir` into the archive
+    #### Parameters
+    - `src_dir`: folder where workout files are stored
+    #### Returns
+    The amount of workouts imported
+    """
+    imported = 0
+    for workout_id, stem, workout in WorkoutFiles(src_dir).iter_workouts():
+      self.save(workout_id, workout.get("name", stem.split("-", 1)[-1]), workout)
+      imported += 1
+    return imported
+
+  def close(self):
+    """
+    #### Description
+    Closes all open segment and index files
+    """
+    with self._lock:
+      for mapped in self._maps.values():
+        mapped.close()
+      self._maps = {}
+      self._writer.close()
+      self._index_writer.close()
+
+  def _segment_file(self, segment: int) -> str:
+    return f"{self.archive_dir}/segment-{segment:06d}.bin"
+
+  def _map(self, segment: int, size: int) -> mmap.mmap:
+    # Segments only grow, so a mapping only needs refreshing when it's too short for the record being read
+    mapped = self._maps.get(segment)
+    if mapped is None or len(mapped) < size:
+      if mapped is not None:
+        mapped.close()
+      if segment == self._segment:
+        self._writer.flush()
+      with open(self._segment_file(segment), mode="rb") as f:
+        mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+      self._maps[segment] = mapped
+    return mapped
+
+  def _load_index(self):
+    index_file = f"{self.archive_dir}/index.bin"
+    if not os.path.exists(index_file):
+      return
+    segment_sizes = {}
+    with open(index_file, mode="rb") as f:
+      data = f.read()
+    position = 0
+    while position + _INDEX_ENTRY.size <= len(data):
+      workout_id, segment, offset, length, stem_length = _INDEX_ENTRY.unpack_from(data, position)
+      if position + _INDEX_ENTRY.size + stem_length > len(data):
+        break
+      stem = data[position + _INDEX_ENTRY.size:position + _INDEX_ENTRY.size + stem_length].decode("utf-8")
+      if segment not in segment_sizes:
+        segment_file = self._segment_file(segment)
+        segment_sizes[segment] = os.path.getsize(segment_file) if os.path.exists(segment_file) else 0
+      # Skip entries whose record never made it to disk
+      if offset + length <= segment_sizes[segment]:
+        self._index[workout_id] = (segment, offset, length, stem)
+      self._segment = max(self._segment, segment)
+      position += _INDEX_ENTRY.size + stem_length
+    if position < len(data):
+      # Drop a half-written entry left behind by a crash, so new ones start on a clean boundary
+      with open(index_file, mode="r+b") as f:
+        f.truncate(position)
+
+class StreamStore:
+  """
+  #### Description
+  This class stores each workout's streams, such as its coordinates, timestamps and heart rate, on its own file under `streams/` on the workouts folder.
+  Streams are kept as columnar arrays, one per stream, rather than as JSON lists, and compressed with zlib.
+  #### Available functions
+  - `has(workout_id: int) -> bool`: checks whether a workout's streams have already been stored
+  - `index() -> set`: returns the IDs of all workouts whose streams are stored
+  - `load(workout_id: int) -> dict`: loads a workout's streams
+  - `save(workout_id: int, streams: dict)`: stores a workout's streams, replacing any previous version of them
+  #### Notes
+  Each file holds a JSON header line describing its arrays, followed by their raw contents. `latlng` is laid out as `[lat0, lon0, lat1, lon1, ...]`.
+  Missing values are stored as `NaN` on float streams, and as `-1` on integer ones.
+  Workouts without streams, such as manual ones, are stored too, with none, so they aren't requested again.
+  """
+  KEYS = ["latlng", "time", "altitude", "heartrate", "cadence", "watts"]
+  TYPECODES = {"latlng": "d", "time": "i", "altitude": "d", "heartrate": "h", "cadence": "h", "watts": "h"}
+
+  def __init__(self, workdir: str):
+    """
+    #### Parameters
+    - `workdir`: folder where workouts are stored. Streams go to its `streams` subfolder
+    """
+    self.streams_dir = f"{workdir}/streams"
+    os.makedirs(self.streams_dir, exist_ok=True)
+    self._lock = threading.Lock()
+    self._index = None
+
+  def has(self, workout_id: int) -> bool:
+    """
+    #### Description
+    Checks whether a workout's streams have already been stored
+    #### Parameters
+    - `workout_id`: the workout's ID
+    #### Returns
+    `True` if stored, `False` otherwise
+    """
+    return int(workout_id) in self.index()
+
+  def index(self) -> set:
+    """
+    #### Description
+    Returns the IDs of all workouts whose streams are stored
+    #### Returns
+    A `set(int)` of workout IDs
+    """
+    with self._lock:
+      if self._index is None:
+        self._index = {int(x.removesuffix(".bin")) for x in os.listdir(self.streams_dir) if x.endswith(".bin") and x.removesuffix(".bin").isdigit()}
+      return self._index
+
+  def save(self, workout_id: int, streams: dict):
+    """
+    #### Description
+    Stores a workout's streams, replacing any previous version of them
+    #### Parameters
+    - `workout_id`: the workout's ID
+    - `streams`: streams as returned by strava with `key_by_type=true`. Unknown ones are ignored
+    """
+    header, body = {"byteorder": sys.byteorder}, []
+    for key in StreamStore.KEYS:
+      if key not in streams:
+        continue
+      data = streams[key].get("data") or []
+      typecode = StreamStore.TYPECODES[key]
+      missing, convert = (float("nan"), float) if typecode == "d" else (-1, round)
+      if key == "latlng":
+        data = [y for x in data for y in (x or [missing, missing])]
+      values = array(typecode, (missing if x is None else convert(x) for x in data))
+      header[key] = [typecode, len(values)]
+      body.append(values.tobytes())
+    record = zlib.compress(json.dumps(header).encode("utf8") + b"\n" + b"".join(body))
+
+    # Write to a temporary file first, so an interrupted run can't leave half-written streams behind
+    filename = f"{self.streams_dir}/{int(workout_id)}.bin"
+    with open(f"{filename}.tmp", mode="wb") as f:
+      f.write(record)
+    os.replace(f"{filename}.tmp", filename)
+    with self._lock:
+      if self._index is not None:
+        self._index.add(int(workout_id))
+
+  def __getstate__(self) -> dict:
+    # Locks can't cross process boundaries. Worker processes only load streams, so they get a fresh one
+    state = self.__dict__.copy()
+    state["_lock"] = None
+    return state
+
+  def __setstate__(self, state: dict):
+    self.__dict__.update(state)
+    self._lock = threading.Lock()
+
+  def load(self, workout_id: int) -> dict:
+    """
+    #### Description
+    Loads a workout's streams
+    #### Parameters
+    - `workout_id`: the workout's ID
+    #### Returns
+    A dict where its key is the stream type and its value an `array` holding the stream. Streams strava didn't provide are missing
+    """
+    with open(f"{self.streams_dir}/{int(workout_id)}.bin", mode="rb") as f:
+      record = zlib.decompress(f.read())
+    header_end = record.index(b"\n")
+    header = json.loads(record[:header_end])
+    offset = header_end + 1
+    streams = {}
+    for key in StreamStore.KEYS:
+      if key not in header:
+        continue
+      typecode, length = header[key]
+      values = array(typecode)
+      values.frombytes(record[offset:offset + length * values.itemsize])
+      if header["byteorder"] != sys.byteorder:
+        values.byteswap()
+      offset += length * values.itemsize
+      streams[key] = values
+    return streams